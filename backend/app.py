@@ -1,17 +1,29 @@
 # app.py
+import io
+import gzip
 import json
-from flask import Flask, request, jsonify
+import hashlib
+import re
+import time
+import threading
+from flask import Flask, request, jsonify, send_file, url_for, g, Response, stream_with_context
 from flask_cors import CORS
 import os
 from pathlib import Path
-from services.utils import convert_pdf_to_images
-from services.hash_service import sha256_bytes
-from services.pdf_service import extract_pdf_words_boxes, get_tokens_ids, extract_pdf_tables
-from services.llm_service import process_tokens
-from services.db_service import get_extraction_by_id, update_extraction_with_correction, insert_placeholder, complete_extraction, store_embeddings
+from services.utils import convert_pdf_to_images, render_pdf_page
+from services.pdf_service import parse_pdf, get_tokens_ids, extract_pdf_tables, get_page_count
+from services.model_router import extract_rows
+from services.db_service import get_extraction_by_id, update_extraction_with_correction, get_extraction_version, complete_extraction, store_embeddings, get_job
 from services.chunking_service import create_chunks
 from services.embedding_service import generate_embeddings
-from services.similarity_service import get_most_similar_document_ids, get_similar_examples
+from services.similarity_service import get_most_similar_document_ids, get_similar_examples, index_document_embeddings
+from services.template_service import extract_with_templates, learn_document_template
+from services.fingerprint_service import find_duplicate
+from services.token_store import save_token_pages, token_page_path
+from services.artifact_store import get_artifacts, save_artifacts, load_tokens, load_tables
+from services.job_service import submit_job, start_job_reaper, get_job_events, live_job_ids, QueueFullError, JOB_STAGES
+from services.storage_service import UPLOAD_DIR, upload_path, spool_upload, store_upload, discard_upload, touch_document, start_storage_gc
+from services import metrics, artifact_writer
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -19,20 +31,50 @@ load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
 app = Flask(__name__)
-CORS(app, resources={r"/extract": {"origins": "http://127.0.0.1:8081"}, r"/correct": {"origins": "http://127.0.0.1:8081"}})
+# Taille maximale d'un upload (au-delà : 413)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", "100")) * 1024 * 1024
+CORS(app, resources={r"/extract": {"origins": "http://127.0.0.1:8081"}, r"/correct": {"origins": "http://127.0.0.1:8081"}, r"/jobs/*": {"origins": "http://127.0.0.1:8081"}, r"/tokens/*": {"origins": "http://127.0.0.1:8081"}, r"/documents/*": {"origins": "http://127.0.0.1:8081"}})
 
-UPLOAD_DIR = "uploads"
+FRONTEND_DIR = Path("../frontend")
 DATA_DIR = "../frontend/data"
 IMAGE_DIR = "../frontend/images_pdf"
+# Rendu des pages à la demande (GET /pages/<documentId>/<n>) plutôt que pendant l'extraction
+LAZY_PAGE_RENDERING = os.getenv("LAZY_PAGE_RENDERING", "false").lower() == "true"
+DOCUMENT_ID_RE = re.compile(r"[0-9a-f]{64}")
+STREAMED_ENDPOINTS = {"job_events"}
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.job_timings = []
+    metrics.start_request_timings()
+    # Réponses en streaming (SSE) non profilées : la vue retourne avant que le générateur ne s'exécute
+    g.profiler = None if request.endpoint in STREAMED_ENDPOINTS else metrics.start_profile()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_start
+    metrics.observe("http_request_duration_seconds", elapsed, "Durée des requêtes HTTP",
+                    endpoint=request.endpoint or "unknown", method=request.method, status=response.status_code)
+    # Server-Timing : appels mesurés pendant la requête, étapes du job le cas échéant, total
+    timings = metrics.request_timings() + g.job_timings + [("total", elapsed)]
+    response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # teardown_request s'exécute aussi quand la vue lève une exception (after_request est alors ignoré)
+    metrics.stop_profile(g.pop("profiler", None), f"{request.method}-{request.endpoint}")
+
 def get_similar_documents_examples(document_id: str, embedding_vectors: list[list[float]], top_k_docs: int = 3, top_k_per_doc: int = 3):
     """
     Récupère des exemples d'extraction depuis les documents similaires.
-    Retourne une liste d'exemples pour alimenter le prompt LLM.
+    Retourne (IDs des documents similaires, exemples pour alimenter le prompt LLM).
     """
+    similar_doc_ids = []
     try:
         # Vérifier que document_id est défini
         if not document_id:
@@ -45,120 +87,379 @@ def get_similar_documents_examples(document_id: str, embedding_vectors: list[lis
         examples = get_similar_examples(similar_doc_ids, top_k_per_doc=top_k_per_doc)
         
         print(f"Exemples récupérés : {len(examples)} lignes")
-        return examples[:6]  # Maximum 6 exemples au total pour limiter les tokens
+        return similar_doc_ids, examples[:6]  # Maximum 6 exemples au total pour limiter les tokens
         
     except Exception as e:
         print(f"Erreur lors de la récupération des exemples similaires : {str(e)}")
-        return []
+        return similar_doc_ids, []
 
-@app.route("/extract", methods=["POST"])
-def extract():
-    if "file" not in request.files:
-        return jsonify({"error": "Aucun fichier fourni"}), 400
+def run_extraction_pipeline(job, document_id: str, file_name: str | None):
+    """
+    Pipeline d'extraction exécuté par un worker de job_service.
+    Chaque étape est enregistrée dans l'état du job ; retourne le résultat stocké avec le job.
+    """
+    filepath = str(upload_path(document_id))
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"PDF '{filepath}' introuvable")
 
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"error": "Nom de fichier vide"}), 400
+    # 1-2) Artefacts déjà calculés pour ce hash : pas de parsing ni de rendu
+    artifacts = get_artifacts(document_id, FRONTEND_DIR)
+    if artifacts:
+        print(f"Artefacts en cache pour {document_id}")
+        tokens_data = load_tokens(artifacts, FRONTEND_DIR)
+        tables = load_tables(document_id)
+        tokens_dict = get_tokens_ids(tokens_data)
+        job.skip("tokens")
+        job.skip("images")
+    else:
+        page_count = get_page_count(filepath)
 
-    # 1) Lire les bytes et calculer le hash → documentId
-    file_bytes = file.read()
-    document_id = sha256_bytes(file_bytes)
-    print(f"Calculé documentId : {document_id}")
+        # 1) Extraction des tokens et des tableaux en une seule passe → dictionnaire id->texte
+        with job.stage("tokens"):
+            tokens_data, tables = parse_pdf(filepath)
+            tokens_dict = get_tokens_ids(tokens_data)
+            print(f"Extraction des tokens réussie pour {document_id}")
 
-    # 2) Sauvegarder le PDF localement pour debug/audit
-    filepath = os.path.join(UPLOAD_DIR, f"{document_id}.pdf")
-    with open(filepath, "wb") as f:
-        f.write(file_bytes)
-    print(f"Fichier sauvegardé : {filepath}")
+            # Sauvegarde des tokens avec bboxes dans frontend/data/<hash> (colonnaire, une page par fichier)
+            tokens_dir = save_token_pages(tokens_data, Path(DATA_DIR) / document_id, page_count)
+            print(f"Tokens sauvegardés dans : {tokens_dir}")
 
-    # 3) Extraction des tokens → dictionnaire id->texte (toujours généré)
-    try:
-        tokens_data = extract_pdf_words_boxes(filepath)
-        tokens_dict = get_tokens_ids(tokens_data)
-        print(f"Extraction des tokens réussie pour {document_id}")
-        
-        # Sauvegarde des tokens avec bboxes dans frontend/data
-        pdf_filename = Path(file.filename).stem
-        tokens_json_path = Path(DATA_DIR) / f"{pdf_filename}.json"
-        with open(tokens_json_path, "w", encoding="utf-8") as f:
-            json.dump(tokens_data, f, indent=2, ensure_ascii=False)
-        print(f"Tokens sauvegardés dans : {tokens_json_path}")
-    except Exception as e:
-        print(f"Erreur lors de l'extraction des tokens : {str(e)}")
-        return jsonify({"error": "Erreur lors de l'extraction des tokens"}), 500
+        # 2) Conversion du PDF en images (ou rendu à la demande via /pages)
+        if LAZY_PAGE_RENDERING:
+            image_paths = []
+            job.skip("images")
+        else:
+            with job.stage("images"):
+                image_paths = convert_pdf_to_images(Path(filepath), Path(IMAGE_DIR), page_count=page_count)
+                print(f"Conversion en images réussie, images générées : {len(image_paths)}")
 
-    # 4) Conversion du PDF en images (toujours générée)
-    try:
-        pdf_path = Path(filepath)
-        image_paths = convert_pdf_to_images(pdf_path, Path(IMAGE_DIR))
-        print(f"Conversion en images réussie, images générées : {len(image_paths)}")
-    except Exception as e:
-        print(f"Erreur lors de la conversion en images : {str(e)}")
-        return jsonify({"error": "Erreur lors de la conversion en images"}), 500
+        artifacts = save_artifacts(document_id, tokens_dir, image_paths, FRONTEND_DIR,
+                                   tables=tables, page_count=page_count)
+
+    # Chemins relatifs des images et des tokens pour la réponse
+    result = {"images": artifacts["images"], "pageCount": artifacts["pageCount"], "tokens": artifacts["tokens"]}
 
-    # 5) Vérifier si existe déjà en DB
+    # 3) Vérifier si l'extraction existe déjà en DB
     existing = get_extraction_by_id(document_id)
-    if existing:
+    if existing and existing.get("finalData") is not None:
         print(f"Document {document_id} déjà existant, utilisation de finalData existant")
-        results = existing.get("finalData", [])
-    else:
-        # **NOUVEAU : Document inexistant - Workflow avec RAG**
-        print(f"Nouveau document {document_id}, lancement du workflow RAG")
-        
-        # 6) Insérer un placeholder pour réserver l'ID
-        try:
-            insert_placeholder(document_id, file.filename)
-            print(f"Placeholder inséré pour {document_id}")
-        except Exception as e:
-            print(f"Erreur lors de l'insertion du placeholder : {str(e)}")
-            return jsonify({"error": "Erreur lors de l'insertion du placeholder"}), 500
+        for stage in ("embeddings", "examples", "llm", "save"):
+            job.skip(stage)
+        return result
+
+    # 4) Même contenu qu'un document déjà extrait (PDF ré-exporté, ré-imprimé) : finalData
+    #    réutilisé et remappé sur les ids des nouveaux tokens, sans appel d'API
+    try:
+        duplicate_data, duplicate_meta, near_duplicates = find_duplicate(document_id, tokens_data)
+    except Exception as e:
+        print(f"Erreur lors de la recherche de doublons : {str(e)}")
+        duplicate_data, duplicate_meta, near_duplicates = None, None, []
+    if duplicate_data is not None:
+        print(f"Contenu identique à {duplicate_meta['duplicateOf']}, réutilisation de son finalData")
+        for stage in ("embeddings", "examples", "llm"):
+            job.skip(stage)
+        with job.stage("save"):
+            raw_data = [{"id": str(k), "text": v} for k, v in tokens_dict.items()]
+            job.ensure_lease()
+            # Exemple enregistré avec la source du document d'origine (un doublon d'un document corrigé reste "corrected")
+            complete_extraction(document_id, raw_data, duplicate_data, meta=duplicate_meta)
+        return result
+
+    # **Document inexistant - Workflow avec RAG**
+    print(f"Nouveau document {document_id}, lancement du workflow RAG")
 
-        # 7) Générer et stocker les embeddings
+    # 5) Générer et stocker les embeddings
+    embedding_vectors = []
+    with job.stage("embeddings"):
         try:
-            tables = extract_pdf_tables(filepath)
+            if tables is None:
+                tables = extract_pdf_tables(filepath)
             chunks = create_chunks(tables)
             embedding_vectors = generate_embeddings(chunks, api_key=api_key)
             store_embeddings(document_id, chunks, embedding_vectors)
+            index_document_embeddings(document_id, embedding_vectors)
             print(f"Embeddings générés et stockés pour {document_id}")
         except Exception as e:
             print(f"Erreur lors du stockage des embeddings : {str(e)}")
             # Continue même si les embeddings échouent
 
-        # 8) Récupérer des exemples depuis les documents similaires
-        examples = get_similar_documents_examples(document_id, embedding_vectors)
-        
-        # 9) Passage LLM avec exemples (si disponibles)
+    # 6) Récupérer des exemples depuis les documents similaires
+    with job.stage("examples"):
+        similar_doc_ids, examples = get_similar_documents_examples(document_id, embedding_vectors)
+
+    # 7) Passage LLM avec exemples (si disponibles), sauf si un gabarit appris sur un document
+    #    similaire (quasi-doublons en premier) reconnaît la mise en page avec une confiance suffisante
+    with job.stage("llm"):
         try:
+            template_docs = near_duplicates + [doc_id for doc_id in similar_doc_ids if doc_id not in near_duplicates]
+            template_match = extract_with_templates(template_docs, tokens_data)
+        except Exception as e:
+            print(f"Erreur lors de l'application des gabarits : {str(e)}")
+            template_match = None
+        if template_match:
+            results, template_id, confidence = template_match
+            print(f"Gabarit {template_id[:12]} reconnu (confiance {confidence:.3f}), extraction sans LLM")
+            for row in results:
+                job.emit_row(row)
+        else:
             if examples:
                 print(f"Utilisation de {len(examples)} exemples pour guider l'extraction")
-                results = process_tokens(tokens_dict, examples=examples)
             else:
                 print("Aucun exemple disponible, extraction sans guide")
-                results = process_tokens(tokens_dict)
+                examples = None
+            # Modèle rapide puis grand modèle pour les pages en échec (documents longs : fenêtres en parallèle)
+            results = extract_rows(tokens_dict, tokens_data, examples=examples, on_row=job.emit_row,
+                                   on_reset=job.reset_rows)
             print(f"Processing LLM réussi pour {document_id}")
-        except Exception as e:
-            print(f"Erreur lors du processing LLM : {str(e)}")
-            return jsonify({"error": "Erreur lors du processing LLM"}), 500
 
-        # 10) Mise à jour avec les résultats finaux
+    # 8) Mise à jour avec les résultats finaux
+    with job.stage("save"):
+        # Convert tokens_dict to a list of [id, text] pairs to ensure string keys
+        raw_data = [{"id": str(k), "text": v} for k, v in tokens_dict.items()]
+        # Un worker qui a perdu le bail n'écrase pas le résultat du nouveau détenteur
+        job.ensure_lease()
+        complete_extraction(document_id, raw_data, results)
+        print(f"Mise à jour avec extraction finale réussie pour {document_id}")
+
+    return result
+
+def _page_images(document_id: str, images: list[str], page_count: int) -> list[str]:
+    """Images déjà rendues, ou URLs de rendu à la demande (/pages) en mode lazy."""
+    if images:
+        return images
+    return [url_for("get_page", document_id=document_id, page_number=n, _external=True) for n in range(1, page_count + 1)]
+
+def _serialize_job(doc: dict) -> dict:
+    job = doc.get("job") or {}
+    stages = job.get("stages", {})
+    done = sum(1 for name in JOB_STAGES if stages.get(name, {}).get("status") in ("done", "skipped"))
+    return {
+        "jobId": doc["documentId"],
+        "documentId": doc["documentId"],
+        "status": job.get("status"),
+        "stage": job.get("stage"),
+        "stages": [{"name": name, **stages.get(name, {"status": "pending"})} for name in JOB_STAGES],
+        "progress": round(100 * done / len(JOB_STAGES)),
+        "error": job.get("error")
+    }
+
+@app.route("/extract", methods=["POST"])
+def extract():
+    if "file" not in request.files:
+        return jsonify({"error": "Aucun fichier fourni"}), 400
+
+    file = request.files["file"]
+    if file.filename == "":
+        return jsonify({"error": "Nom de fichier vide"}), 400
+
+    # 1) Recevoir le PDF par blocs dans un fichier temporaire (hash calculé au passage → documentId)
+    document_id, tmp_path = spool_upload(file.stream)
+    print(f"Calculé documentId : {document_id}")
+
+    # 2) Document déjà connu (artefacts + extraction) : réponse immédiate, le fichier temporaire est
+    #    supprimé sans être stocké, ni parsing ni rendu
+    try:
+        artifacts = get_artifacts(document_id, FRONTEND_DIR)
+        existing = get_extraction_by_id(document_id) if artifacts else None
+    except BaseException:
+        discard_upload(tmp_path)
+        raise
+    if existing and existing.get("finalData") is not None:
+        print(f"Document {document_id} en cache, réponse directe")
+        discard_upload(tmp_path)
+        touch_document(document_id)
+        return jsonify({
+            "jobId": document_id,
+            "documentId": document_id,
+            "status": "done",
+            "data": existing["finalData"],
+            "images": _page_images(document_id, artifacts["images"], artifacts["pageCount"]),
+            "tokens": url_for("get_token_index", document_id=document_id, _external=True)
+        })
+
+    # 3) Stocker le PDF dans le stockage adressé par contenu
+    filepath = store_upload(document_id, tmp_path)
+    print(f"Fichier sauvegardé : {filepath}")
+
+    # 4) Soumettre le job d'extraction : la réponse part immédiatement
+    try:
+        job_id = submit_job(document_id, file.filename, run_extraction_pipeline)
+    except QueueFullError:
+        return jsonify({"error": "File d'extraction pleine, réessayez plus tard"}), 503
+    except Exception as e:
+        print(f"Erreur lors de la soumission du job : {str(e)}")
+        return jsonify({"error": "Erreur lors de la soumission du job"}), 500
+
+    return jsonify({"jobId": job_id, "documentId": document_id, "status": "queued"}), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    doc = get_job(job_id)
+    if not doc or not doc.get("job"):
+        return jsonify({"error": "Job introuvable"}), 404
+    return jsonify(_serialize_job(doc))
+
+def _sse(event_type: str, data: dict, event_id: int | None = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event_type}", f"data: {json.dumps(data, ensure_ascii=False, default=str)}"]
+    return "\n".join(lines) + "\n\n"
+
+def _poll_job_events(job_id: str, interval: float = 1.0):
+    """Job exécuté par un autre process : progression relue dans MongoDB (sans les lignes)."""
+    last = None
+    while True:
+        status = _serialize_job(get_job(job_id))
+        current = (status["stage"], status["status"], status["progress"])
+        if current != last:
+            last = current
+            yield _sse("stage", {"stage": status["stage"], "status": status["status"], "progress": status["progress"]})
+        if status["status"] in ("done", "failed"):
+            yield _sse(status["status"], {"jobId": job_id, "error": status["error"]})
+            return
+        time.sleep(interval)
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Flux Server-Sent Events du job : "stage" (progression), "row" (ligne comptable
+    extraite, dès que sa page est validée), "rows_reset" (lignes déjà envoyées retirées,
+    document ré-extrait), puis "done" ou "failed".
+    Last-Event-ID permet de reprendre le flux après une reconnexion.
+    """
+    doc = get_job(job_id)
+    if not doc or not doc.get("job"):
+        return jsonify({"error": "Job introuvable"}), 404
+
+    events = get_job_events(job_id)
+    last_event_id = request.headers.get("Last-Event-ID", default=-1, type=int)
+
+    def stream():
+        if events is None:
+            yield from _poll_job_events(job_id)
+            return
+        for event in events.iter_from(last_event_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            event_id, event_type, data = event
+            yield _sse(event_type, data, event_id)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    doc = get_job(job_id)
+    if not doc or not doc.get("job"):
+        return jsonify({"error": "Job introuvable"}), 404
+    if doc["job"].get("status") != "done":
+        return jsonify(_serialize_job(doc)), 409
+
+    extraction = get_extraction_by_id(job_id)
+    result = doc["job"].get("result") or {}
+    # Images évincées par le GC depuis la fin du job : rendu à la demande via /pages
+    artifacts = get_artifacts(job_id, FRONTEND_DIR)
+    images = artifacts["images"] if artifacts else []
+    touch_document(job_id)
+    g.job_timings = [
+        (f"stage.{name}", stage["durationMs"] / 1000)
+        for name, stage in doc["job"].get("stages", {}).items() if stage.get("durationMs") is not None
+    ]
+    return jsonify({
+        "data": extraction.get("finalData") or [],
+        "images": _page_images(job_id, images, result.get("pageCount", 0)),
+        "tokens": url_for("get_token_index", document_id=job_id, _external=True),
+        "documentId": job_id
+    })
+
+@app.route("/pages/<document_id>/<int:page_number>", methods=["GET"])
+def get_page(document_id, page_number):
+    """Rend une page au premier appel puis la sert depuis le cache disque."""
+    if not DOCUMENT_ID_RE.fullmatch(document_id) or page_number < 1:
+        return jsonify({"error": "Page introuvable"}), 404
+    pdf_path = upload_path(document_id)
+    if not pdf_path.exists():
+        return jsonify({"error": "Page introuvable"}), 404
+
+    try:
+        img_path = render_pdf_page(pdf_path, Path(IMAGE_DIR), page_number)
+    except Exception as e:
+        print(f"Erreur lors du rendu de la page {page_number} de {document_id} : {str(e)}")
+        return jsonify({"error": "Page introuvable"}), 404
+
+    return send_file(img_path.resolve(), mimetype="image/jpeg", max_age=86400)
+
+def _send_artifact(path: Path, mimetype: str):
+    """Artefact servi depuis le disque, ou depuis la mémoire si son écriture est encore en file."""
+    data = artifact_writer.pending(path)
+    if data is None:
+        return send_file(path.resolve(), mimetype=mimetype, max_age=86400)
+    return send_file(io.BytesIO(data), mimetype=mimetype, max_age=86400,
+                     etag=hashlib.sha256(data).hexdigest()[:32])
+
+_token_rebuild_lock = threading.Lock()
+
+def _restore_token_pages(document_id: str) -> bool:
+    """
+    Tokens évincés par le GC : nouveau parsing du PDF conservé, comme le rendu à la demande de /pages.
+    False si le PDF est absent ou si les tokens obtenus ne sont plus ceux de l'extraction enregistrée.
+    """
+    tokens_dir = Path(DATA_DIR) / document_id
+    if artifact_writer.exists(tokens_dir / "index.json"):
+        return True
+    pdf_path = upload_path(document_id)
+    if not pdf_path.exists():
+        return False
+    with _token_rebuild_lock:
+        if artifact_writer.exists(tokens_dir / "index.json"):
+            return True  # reconstruit entre-temps par une autre requête
         try:
-            # Convert tokens_dict to a list of [id, text] pairs to ensure string keys
-            raw_data = [{"id": str(k), "text": v} for k, v in tokens_dict.items()]
-            updated_doc = complete_extraction(document_id, raw_data, results)
-            print(f"Mise à jour avec extraction finale réussie pour {document_id}")
+            tokens_data, tables = parse_pdf(str(pdf_path))
+            page_count = get_page_count(str(pdf_path))
         except Exception as e:
-            print(f"Erreur lors de la mise à jour finale : {str(e)}")
-            return jsonify({"error": "Erreur lors de la mise à jour finale"}), 500
-
-    # 11) Préparer la réponse avec les chemins relatifs des images et documentId
-    base_path = Path("../frontend")
-    response_data = {
-        "data": results,
-        "images": [str(img_path.relative_to(base_path)) for img_path in image_paths],
-        "documentId": document_id
-    }
+            print(f"Erreur lors de la reconstruction des tokens de {document_id} : {str(e)}")
+            return False
+        # finalData référence les ids des tokens : ils doivent correspondre au raw enregistré
+        extraction = get_extraction_by_id(document_id)
+        raw = (extraction or {}).get("raw")
+        if raw is not None and {item["id"]: item["text"] for item in raw} != \
+                {str(k): v for k, v in get_tokens_ids(tokens_data).items()}:
+            print(f"Tokens reconstruits différents de l'extraction enregistrée pour {document_id}")
+            metrics.inc("token_pages_rebuilt_total", 1, "Tokens évincés reconstruits depuis le PDF", result="mismatch")
+            return False
+        save_token_pages(tokens_data, tokens_dir, page_count)
+        # Images évincées avec les tokens : pages rendues à la demande via /pages
+        save_artifacts(document_id, tokens_dir, [], FRONTEND_DIR, tables=tables, page_count=page_count)
+        metrics.inc("token_pages_rebuilt_total", 1, "Tokens évincés reconstruits depuis le PDF", result="ok")
+        print(f"Tokens reconstruits depuis le PDF pour {document_id}")
+    return True
+
+@app.route("/tokens/<document_id>", methods=["GET"])
+def get_token_index(document_id):
+    """Index des tokens : nombre de tokens par page (reconstruits depuis le PDF s'ils ont été évincés)."""
+    index_path = Path(DATA_DIR) / document_id / "index.json"
+    if not DOCUMENT_ID_RE.fullmatch(document_id) or not _restore_token_pages(document_id):
+        return jsonify({"error": "Tokens introuvables"}), 404
+    touch_document(document_id)
+    return _send_artifact(index_path, "application/json")
 
-    return jsonify(response_data)
+@app.route("/tokens/<document_id>/<int:page>", methods=["GET"])
+def get_token_page(document_id, page):
+    """Tokens d'une page au format colonnaire, servis compressés (gzip) avec ETag."""
+    page_path = None
+    if DOCUMENT_ID_RE.fullmatch(document_id) and _restore_token_pages(document_id):
+        page_path = token_page_path(Path(DATA_DIR) / document_id, page)
+    if not page_path:
+        return jsonify({"error": "Tokens introuvables"}), 404
+
+    if "gzip" in request.accept_encodings:
+        response = _send_artifact(page_path, "application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = app.response_class(gzip.decompress(artifact_writer.read_bytes(page_path)),
+                                      mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route("/correct", methods=["PATCH"])
 def correct():
@@ -179,13 +480,46 @@ def correct():
         print(f"Erreur lors de la mise à jour : {str(e)}")
         return jsonify({"error": "Erreur lors de la mise à jour"}), 500
 
+    # Gabarit de mise en page appris sur la version corrigée (fast path des documents similaires)
+    try:
+        artifacts = get_artifacts(document_id, FRONTEND_DIR)
+        if artifacts:
+            template = learn_document_template(document_id, new_final_data, load_tokens(artifacts, FRONTEND_DIR))
+            if template:
+                print(f"Gabarit {template['templateId'][:12]} appris sur {document_id}")
+    except Exception as e:
+        print(f"Erreur lors de l'apprentissage du gabarit : {str(e)}")
+
+    # Réponse légère : le client possède déjà finalData
     return jsonify({
         "documentId": document_id,
-        "finalData": updated_doc["finalData"],
-        "raw": updated_doc["raw"],
         "source": "corrected",
-        "corrections": updated_doc.get("corrections", [])
+        "version": updated_doc["version"],
+        "changes": updated_doc["changes"]
     })
 
+@app.route("/documents/<document_id>/versions/<int:version>", methods=["GET"])
+def get_document_version(document_id, version):
+    """finalData reconstruit à une version donnée (0 = résultat de l'extraction)."""
+    if not DOCUMENT_ID_RE.fullmatch(document_id):
+        return jsonify({"error": "documentId invalide"}), 400
+    final_data = get_extraction_version(document_id, version)
+    if final_data is None:
+        return jsonify({"error": "Version introuvable"}), 404
+    return jsonify({"documentId": document_id, "version": version, "finalData": final_data})
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Histogrammes de latence et compteurs au format texte Prometheus."""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+# Reprendre les jobs interrompus (redémarrage, worker disparu) en arrière-plan, puis périodiquement :
+# le démarrage n'attend pas MongoDB (avec le reloader Flask, seul le process enfant WERKZEUG_RUN_MAIN exécute les jobs)
+if __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    start_job_reaper(run_extraction_pipeline)
+    # Éviction périodique des artefacts dérivés (images, tokens) selon leur âge et le budget disque
+    # (chaque worker le lance : les jobs des autres workers sont protégés via leur heartbeat MongoDB)
+    start_storage_gc(DATA_DIR, IMAGE_DIR, live_job_ids)
+
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
\ No newline at end of file
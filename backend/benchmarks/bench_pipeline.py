@@ -0,0 +1,274 @@
+"""
+Benchmark de bout en bout hors-ligne : OpenAI et MongoDB sont remplacés par des
+stand-ins locaux (benchmarks.standins), les PDF sont générés (benchmarks.synthetic_pdf).
+
+Deux phases :
+  services   chaque service appelé directement, document par document
+             (latence p50/p95 et pic mémoire tracemalloc par étape) ;
+  endpoints  POST /extract (file de jobs) puis PATCH /correct via le client de test Flask
+             (débit, latence de bout en bout, durées des étapes enregistrées par les jobs).
+
+    cd backend
+    python -m benchmarks.bench_pipeline [--docs 10] [--pages 20] [--rows 55] \\
+        [--llm-latency 0.5] [--embedding-latency 0.05] [--phase all|services|endpoints] [--json out.json]
+
+Le pic mémoire ne couvre que le process principal (pas les workers du pool de parsing)
+et tracemalloc ralentit les mesures : --no-memory pour des latences sans instrumentation.
+Sans pdftoppm, le rendu des pages est désactivé (LAZY_PAGE_RENDERING).
+Les durées des étapes db.* mesurent mongomock : à comparer entre deux runs, pas à une vraie base.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from .standins import FakeOpenAIServer, install_mongo_standin
+from .synthetic_pdf import make_ledger_pdf
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+
+
+class StageStats:
+    """Latences et pics mémoire collectés pour une étape."""
+
+    def __init__(self):
+        self.durations = []
+        self.peaks = []
+        self.items = 0
+
+    def summary(self) -> dict:
+        durations = np.array(self.durations) if self.durations else np.zeros(1)
+        total = float(durations.sum())
+        return {
+            "count": len(self.durations),
+            "p50Ms": float(np.percentile(durations, 50) * 1000),
+            "p95Ms": float(np.percentile(durations, 95) * 1000),
+            "maxMs": float(durations.max() * 1000),
+            "itemsPerSecond": self.items / total if total and self.items else None,
+            "peakMiB": max(self.peaks) / 2 ** 20 if self.peaks else None
+        }
+
+
+class Recorder:
+    def __init__(self, memory: bool):
+        self.memory = memory
+        self.stages = {}
+
+    def measure(self, stage: str, func, *args, items: int = 0, **kwargs):
+        stats = self.stages.setdefault(stage, StageStats())
+        if self.memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        stats.durations.append(time.perf_counter() - start)
+        stats.items += items
+        if self.memory:
+            stats.peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        return result
+
+    def summary(self) -> dict:
+        return {stage: stats.summary() for stage, stats in self.stages.items()}
+
+
+def setup_environment(args, workspace: Path, server: FakeOpenAIServer):
+    """Variables d'environnement lues à l'import des services : à définir avant tout import."""
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": server.base_url,
+        "OPENAI_API_BASE": server.base_url,
+        "MONGODB_URI": "mongodb://bench-standin",
+        "MONGODB_DB": "pdf_extraction_bench",
+        "ARTIFACT_DIR": str(workspace / "backend" / "artifacts"),
+        "LLM_CACHE_PATH": str(workspace / "backend" / "cache" / "llm_cache.sqlite3"),
+        "LLM_CACHE_MODE": "readwrite" if args.llm_cache else "off",
+        "METRICS_PROFILE_SAMPLE_RATE": "0",
+        "EMBEDDING_CHECK_CTX_LENGTH": "false",
+    })
+    if not args.render or not shutil.which("pdftoppm"):
+        os.environ["LAZY_PAGE_RENDERING"] = "true"
+    install_mongo_standin()
+    sys.path.insert(0, str(BACKEND_DIR))
+    # app.py utilise des chemins relatifs (uploads/, ../frontend/) : espace de travail jetable
+    (workspace / "backend").mkdir(parents=True)
+    (workspace / "frontend").mkdir()
+    os.chdir(workspace / "backend")
+
+
+def bench_services(pdfs: list[Path], recorder: Recorder):
+    from services.pdf_service import parse_pdf, get_page_count
+    from services.token_store import save_token_pages
+    from services.chunking_service import create_chunks
+    from services.embedding_service import generate_embeddings
+    from services.similarity_service import index_document_embeddings, get_most_similar_document_ids, get_similar_examples
+    from services.llm_service import process_tokens, process_tokens_chunked, LLM_CHUNK_MAX_TOKENS
+    from services.db_service import insert_placeholder, complete_extraction, store_embeddings
+
+    for number, pdf_path in enumerate(pdfs):
+        document_id = f"{number:064x}"
+        page_count = get_page_count(pdf_path)
+        tokens, tables = recorder.measure("pdf.parse", parse_pdf, str(pdf_path), items=page_count)
+        recorder.measure("tokens.save", save_token_pages, tokens, Path("tokens") / document_id, page_count,
+                         items=len(tokens))
+        chunks = recorder.measure("chunks", create_chunks, tables)
+        vectors = recorder.measure("embeddings", generate_embeddings, chunks, api_key=os.environ["OPENAI_API_KEY"],
+                                   items=len(chunks))
+        recorder.measure("db.store_embeddings", store_embeddings, document_id, chunks, vectors, items=len(chunks))
+        index_document_embeddings(document_id, vectors)
+        similar = recorder.measure("similarity.search", get_most_similar_document_ids, vectors,
+                                   exclude_doc_id=document_id, items=len(vectors))
+        examples = recorder.measure("similarity.examples", get_similar_examples, similar)[:6]
+
+        tokens_dict = {token["id"]: token["text"] for token in tokens}
+        if len(tokens) > LLM_CHUNK_MAX_TOKENS:
+            results = recorder.measure("llm", process_tokens_chunked, tokens, examples=examples, items=len(tokens))
+        else:
+            results = recorder.measure("llm", process_tokens, tokens_dict, examples=examples,
+                                       tokens_data=tokens, items=len(tokens))
+        insert_placeholder(document_id, pdf_path.name)
+        raw_data = [{"id": str(k), "text": v} for k, v in tokens_dict.items()]
+        recorder.measure("db.complete_extraction", complete_extraction, document_id, raw_data, results)
+        print(f"[services] {pdf_path.name} : {page_count} pages, {len(tokens)} tokens, {len(chunks)} chunks")
+
+
+def _wait_for_job(client, job_id: str, poll_interval: float) -> dict:
+    while True:
+        status = client.get(f"/jobs/{job_id}").get_json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(poll_interval)
+
+
+def bench_endpoints(pdfs: list[Path], recorder: Recorder, poll_interval: float) -> dict:
+    import app as app_module
+
+    client = app_module.app.test_client()
+    submitted = {}
+    start = time.perf_counter()
+    for pdf_path in pdfs:
+        while True:
+            with open(pdf_path, "rb") as f:
+                response = recorder.measure("http.extract", client.post, "/extract",
+                                            data={"file": (f, pdf_path.name)}, content_type="multipart/form-data")
+            if response.status_code != 503:
+                break
+            time.sleep(poll_interval)  # file de jobs pleine
+        submitted[response.get_json()["jobId"]] = time.perf_counter()
+
+    failed = 0
+    for job_id, submitted_at in submitted.items():
+        status = _wait_for_job(client, job_id, poll_interval)
+        stats = recorder.stages.setdefault("job.end_to_end", StageStats())
+        stats.durations.append(time.perf_counter() - submitted_at)
+        failed += status["status"] == "failed"
+        for stage in status["stages"]:
+            if stage.get("durationMs") is not None:
+                recorder.stages.setdefault(f"job.{stage['name']}", StageStats()).durations.append(stage["durationMs"] / 1000)
+    wall_time = time.perf_counter() - start
+
+    # Corrections : on modifie une ligne du résultat de chaque document
+    for job_id in submitted:
+        final_data = client.get(f"/jobs/{job_id}/result").get_json().get("data") or []
+        if not final_data:
+            continue
+        final_data[0] = {**final_data[0], "compte": ["999999", final_data[0].get("compte", [None, None])[1]]}
+        recorder.measure("http.correct", client.patch, "/correct",
+                         json={"documentId": job_id, "finalData": final_data})
+
+    # Nouvel envoi d'un document déjà traité : chemin rapide (artefacts et finalData existants)
+    with open(pdfs[0], "rb") as f:
+        recorder.measure("http.extract_cached", client.post, "/extract",
+                         data={"file": (f, pdfs[0].name)}, content_type="multipart/form-data")
+
+    return {"documents": len(pdfs), "failed": failed, "wallSeconds": wall_time,
+            "documentsPerSecond": len(pdfs) / wall_time}
+
+
+def print_report(title: str, summary: dict):
+    print(f"\n{title}")
+    print(f"{'étape':<26}{'n':>5}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}{'items/s':>12}{'pic MiB':>10}")
+    for stage, stats in summary.items():
+        rate = f"{stats['itemsPerSecond']:,.0f}" if stats["itemsPerSecond"] else "-"
+        peak = f"{stats['peakMiB']:.1f}" if stats["peakMiB"] is not None else "-"
+        print(f"{stage:<26}{stats['count']:>5}{stats['p50Ms']:>11.1f}{stats['p95Ms']:>11.1f}"
+              f"{stats['maxMs']:>11.1f}{rate:>12}{peak:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=10, help="documents distincts")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=55, help="lignes par page")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="latence simulée d'un appel chat (s)")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="latence simulée d'un appel embeddings (s)")
+    parser.add_argument("--dims", type=int, default=256, help="dimension des embeddings factices")
+    parser.add_argument("--phase", choices=["all", "services", "endpoints"], default="all")
+    parser.add_argument("--llm-cache", action="store_true", help="garder le cache de réponses LLM actif")
+    parser.add_argument("--render", action="store_true", help="rendre les images des pages (pdftoppm requis)")
+    parser.add_argument("--no-memory", action="store_true", help="désactiver tracemalloc")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--json", help="écrire le rapport JSON dans ce fichier")
+    parser.add_argument("--keep", action="store_true", help="conserver l'espace de travail temporaire")
+    args = parser.parse_args()
+    json_path = Path(args.json).resolve() if args.json else None
+
+    workspace = Path(tempfile.mkdtemp(prefix="bench-pipeline-"))
+    server = FakeOpenAIServer(args.llm_latency, args.embedding_latency, args.dims).start()
+    setup_environment(args, workspace, server)
+    pdfs = [make_ledger_pdf(workspace / f"ledger-{n:03d}.pdf", args.pages, args.rows, seed=n) for n in range(args.docs)]
+    print(f"Espace de travail : {workspace} ; {args.docs} document(s) de {args.pages} page(s) x {args.rows} lignes")
+
+    if not args.no_memory:
+        tracemalloc.start()
+    report = {"config": vars(args)}
+    try:
+        if args.phase in ("all", "services"):
+            recorder = Recorder(memory=not args.no_memory)
+            bench_services(pdfs, recorder)
+            report["services"] = recorder.summary()
+            print_report("Services", report["services"])
+
+        if args.phase in ("all", "endpoints"):
+            from services import db_service, similarity_service
+            # Phase indépendante : caches, documents et gabarits de la phase services effacés, index de
+            # similarité oublié (sinon documents similaires supprimés et extraction par gabarit sans LLM)
+            for collection in (db_service.extractions, db_service.embeddings, db_service.embedding_cache,
+                               db_service.examples, db_service.templates):
+                collection.delete_many({})
+            if similarity_service.VECTOR_SNAPSHOT_DIR:
+                shutil.rmtree(similarity_service.VECTOR_SNAPSHOT_DIR, ignore_errors=True)
+            similarity_service.reset_similarity_index()
+            recorder = Recorder(memory=not args.no_memory)
+            if not args.no_memory:
+                tracemalloc.reset_peak()
+            report["endpoints"] = bench_endpoints(pdfs, recorder, args.poll_interval)
+            if not args.no_memory:
+                report["endpoints"]["peakMiB"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            report["endpoints"]["stages"] = recorder.summary()
+            print_report("Endpoints", report["endpoints"]["stages"])
+            print(f"\nDébit : {report['endpoints']['documentsPerSecond']:.2f} document(s)/s "
+                  f"({report['endpoints']['failed']} échec(s))")
+    finally:
+        server.stop()
+        if not args.keep:
+            os.chdir(BACKEND_DIR)
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report["openaiRequests"] = server.requests
+    report["maxRssMiB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Appels OpenAI simulés : {server.requests} ; RSS max : {report['maxRssMiB']:.0f} MiB")
+    if json_path:
+        json_path.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 1 if report.get("endpoints", {}).get("failed") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Rappel et coût des formats de stockage des embeddings (cf. services.vector_codec) par rapport à float32.
+
+Pour chaque format : octets par vecteur en BSON, temps de décodage du corpus (documents BSON ->
+index), rappel@k des documents similaires par rapport à l'index float32, puis chargement de
+l'instantané local mappé en mémoire (vector_index.load_snapshot).
+
+    cd backend
+    python -m benchmarks.bench_quantization [--docs 500] [--chunks 40] [--dims 1536] \\
+        [--queries 50] [--top-k 3] [--from-db]
+
+Par défaut le corpus est synthétique (documents regroupés par thèmes, comme des balances proches) ;
+--from-db utilise la collection embeddings (MONGODB_URI) : la référence n'est alors float32 que pour
+les vecteurs encore stockés dans l'ancien format.
+"""
+import sys
+import time
+import argparse
+import tempfile
+
+import bson
+import numpy as np
+
+from services.vector_codec import encode_embedding, decode_embedding, VECTOR_FORMATS
+from services.vector_index import SimilarityIndex, save_snapshot, load_snapshot
+
+
+def synthetic_corpus(docs: int, chunks: int, dims: int, topics: int, seed: int = 0) -> dict[str, np.ndarray]:
+    """Vecteurs de chunks par document : thème + particularités du document + bruit par chunk."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dims)).astype(np.float32)
+    corpus = {}
+    for n in range(docs):
+        base = centers[rng.integers(topics)] + 0.6 * rng.standard_normal(dims).astype(np.float32)
+        corpus[f"doc-{n:05d}"] = base + 0.8 * rng.standard_normal((chunks, dims)).astype(np.float32)
+    return corpus
+
+
+def corpus_from_db(limit: int) -> dict[str, np.ndarray]:
+    from services.db_service import embeddings
+    from services.vector_codec import EMBEDDING_FIELDS
+
+    grouped = {}
+    for doc in embeddings.find({}, {"document_id": 1, **EMBEDDING_FIELDS}).sort("_id", 1).limit(limit):
+        grouped.setdefault(doc["document_id"], []).append(decode_embedding(doc))
+    return {document_id: np.stack(vectors) for document_id, vectors in grouped.items()}
+
+
+def build_index(corpus: dict[str, np.ndarray]) -> SimilarityIndex:
+    index = SimilarityIndex()
+    for document_id, vectors in corpus.items():
+        index.add(document_id, vectors)
+    return index
+
+
+def recall_at_k(reference: SimilarityIndex, candidate: SimilarityIndex, queries: list[np.ndarray],
+                excluded: list[str], top_k: int) -> float:
+    hits = total = 0
+    for query, document_id in zip(queries, excluded):
+        expected = {doc for doc, _ in reference.search(query, exclude_doc_id=document_id, top_k=top_k)}
+        found = {doc for doc, _ in candidate.search(query, exclude_doc_id=document_id, top_k=top_k)}
+        hits += len(expected & found)
+        total += len(expected)
+    return hits / total if total else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=500)
+    parser.add_argument("--chunks", type=int, default=40, help="chunks par document")
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=50, help="documents utilisés comme requêtes")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--from-db", action="store_true", help="corpus lu dans la collection embeddings")
+    parser.add_argument("--limit", type=int, default=200000, help="chunks lus au plus avec --from-db")
+    args = parser.parse_args()
+
+    corpus = corpus_from_db(args.limit) if args.from_db else \
+        synthetic_corpus(args.docs, args.chunks, args.dims, args.topics)
+    if not corpus:
+        print("Corpus vide")
+        return 1
+    total_chunks = sum(len(vectors) for vectors in corpus.values())
+    rng = np.random.default_rng(1)
+    query_ids = list(rng.choice(list(corpus), size=min(args.queries, len(corpus)), replace=False))
+    reference = build_index(corpus)
+    print(f"Corpus : {len(corpus)} documents, {total_chunks} chunks de dimension {next(iter(corpus.values())).shape[1]}")
+
+    print(f"\n{'format':<10}{'octets/vecteur':>16}{'réduction':>11}{'décodage ms':>13}{'rappel@' + str(args.top_k):>11}")
+    baseline_bytes = None
+    for storage_format in sorted(VECTOR_FORMATS, key=lambda name: name != "float32"):  # référence en premier
+        # Documents tels que stockés puis relus depuis MongoDB (BSON)
+        payloads = [bson.encode(encode_embedding(vector, storage_format))
+                    for vectors in corpus.values() for vector in vectors]
+        size = sum(len(payload) for payload in payloads) / len(payloads)
+        baseline_bytes = baseline_bytes or size
+
+        start = time.perf_counter()
+        decoded, position = {}, 0
+        for document_id, vectors in corpus.items():
+            decoded[document_id] = np.stack([decode_embedding(bson.decode(payload))
+                                             for payload in payloads[position:position + len(vectors)]])
+            position += len(vectors)
+        decode_ms = (time.perf_counter() - start) * 1000
+
+        queries = [decoded[document_id] for document_id in query_ids]
+        recall = recall_at_k(reference, build_index(decoded), queries, query_ids, args.top_k)
+        print(f"{storage_format:<10}{size:>16.0f}{'x' + format(baseline_bytes / size, '.1f'):>11}"
+              f"{decode_ms:>13.0f}{recall:>11.3f}")
+
+    # Instantané local : float16 normalisé, chargé par np.load(mmap_mode="r")
+    with tempfile.TemporaryDirectory(prefix="vectors-") as directory:
+        save_snapshot(reference, directory, None)
+        start = time.perf_counter()
+        mapped = SimilarityIndex()
+        load_snapshot(directory, mapped)
+        load_ms = (time.perf_counter() - start) * 1000
+        queries = [corpus[document_id] for document_id in query_ids]
+        recall = recall_at_k(reference, mapped, queries, query_ids, args.top_k)
+        start = time.perf_counter()
+        for query, document_id in zip(queries, query_ids):
+            mapped.search(query, exclude_doc_id=document_id, top_k=args.top_k)
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"\nInstantané mappé : chargement {load_ms:.1f} ms, recherche {search_ms:.1f} ms/requête, "
+          f"rappel@{args.top_k} {recall:.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
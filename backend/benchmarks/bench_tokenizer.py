@@ -0,0 +1,120 @@
+"""
+Micro-benchmark du moteur de fusion des nombres (services.tokenizer).
+
+Compare la sortie avec l'ancienne boucle de extract_pdf_words_boxes (implémentation de
+référence ci-dessous) sur un corpus synthétique et, optionnellement, sur des PDF réels,
+puis mesure le débit en mots par seconde.
+
+    cd backend
+    python -m benchmarks.bench_tokenizer [--pages 40] [--repeat 5] [fichier.pdf ...]
+"""
+import argparse
+import random
+import re
+import sys
+import time
+
+from services.tokenizer import merge_number_tokens
+
+
+def reference_merge(words, max_gap=10):
+    """Ancienne boucle de fusion (avant services.tokenizer), sortie au format (text, x0, y0, x1, y1)."""
+    merged = []
+    i = 0
+    while i < len(words):
+        word = words[i]
+        text = word["text"]
+        if re.match(r"^-?\d{1,3}$", text):
+            number_parts = [text]
+            start_word = word
+            j = i + 1
+            while j < len(words):
+                next_word = words[j]
+                next_text = next_word["text"]
+                close_enough = int(next_word["x0"]) - int(word["x1"]) < max_gap
+                same_line = abs(int(next_word["top"]) - int(word["top"])) < 3
+                if not (close_enough and same_line):
+                    break
+                if re.match(r"^\d{3}$", next_text) or re.match(r"^\d{1,3}[,.]\d{1,2}-?$", next_text):
+                    number_parts.append(next_text)
+                    word = next_word
+                    j += 1
+                else:
+                    break
+            full_number = " ".join(number_parts)
+            if re.match(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$", full_number):
+                merged.append((full_number, int(start_word["x0"]), int(start_word["top"]), int(word["x1"]), int(word["bottom"])))
+                i = j
+                continue
+        if re.match(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$", text):
+            merged.append((text, int(word["x0"]), int(word["top"]), int(word["x1"]), int(word["bottom"])))
+            i += 1
+            continue
+        merged.append((text, int(word["x0"]), int(word["top"]), int(word["x1"]), int(word["bottom"])))
+        i += 1
+    return merged
+
+
+def synthetic_page(rng: random.Random, rows: int = 60) -> list[dict]:
+    """Page de balance synthétique : comptes, libellés et montants découpés en groupes de chiffres."""
+    words = []
+    top = 40.0
+    for _ in range(rows):
+        x = 30.0
+        cells = [str(rng.randint(100000, 799999)), rng.choice(["Total", "classe", "Fournisseurs", "Clients", "TVA"])]
+        for _ in range(4):
+            amount = f"{rng.randint(0, 999_999_999):,}".replace(",", " ")
+            cells.append(amount + rng.choice([",00", ",5", ".25", ",00-", ""]))
+        for cell in cells:
+            for part in cell.split(" "):
+                width = 4.7 * len(part)
+                words.append({"text": part, "x0": x, "top": top + rng.uniform(-2.5, 2.5), "x1": x + width, "bottom": top + 9.1})
+                x += width + rng.choice([2.4, 3.1, 9.5, 12.0])
+            x += rng.uniform(20, 60)
+        top += rng.choice([11.8, 12.2, 14.0])
+    return words
+
+
+def pdf_pages(paths: list[str]) -> list[list[dict]]:
+    import pdfplumber
+    pages = []
+    for path in paths:
+        with pdfplumber.open(path) as pdf:
+            pages.extend(page.extract_words() for page in pdf.pages)
+    return pages
+
+
+def words_per_second(merge, pages, repeat: int) -> float:
+    total_words = sum(len(page) for page in pages)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            merge(page)
+        best = min(best, time.perf_counter() - start)
+    return total_words / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdfs", nargs="*", help="PDF du corpus de régression")
+    parser.add_argument("--pages", type=int, default=40, help="pages synthétiques")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pages = [synthetic_page(rng) for _ in range(args.pages)] + pdf_pages(args.pdfs)
+
+    mismatches = sum(1 for page in pages if merge_number_tokens(page) != reference_merge(page))
+    print(f"Corpus : {len(pages)} pages, {sum(len(p) for p in pages)} mots, {mismatches} page(s) divergente(s)")
+
+    reference = words_per_second(reference_merge, pages, args.repeat)
+    engine = words_per_second(merge_number_tokens, pages, args.repeat)
+    print(f"Référence  : {reference:,.0f} mots/s")
+    print(f"Tokenizer  : {engine:,.0f} mots/s  (x{engine / reference:.2f})")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
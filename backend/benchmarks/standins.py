@@ -0,0 +1,196 @@
+"""
+Remplaçants locaux des services externes pour les benchmarks hors-ligne :
+
+- FakeOpenAIServer : serveur HTTP compatible /v1/chat/completions et /v1/embeddings,
+  réponses déterministes et latence configurable (le SDK openai y est redirigé via OPENAI_BASE_URL) ;
+- install_mongo_standin : remplace pymongo.MongoClient par une base mongomock en mémoire
+  (à appeler avant le premier accès à une collection : les services se connectent à la demande,
+  cf. db_service.get_db, et mettent le client en cache).
+"""
+import re
+import json
+import time
+import base64
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+ACCOUNT_RE = re.compile(r"^\d{6}$")
+AMOUNT_RE = re.compile(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$")
+# "a-b: t1 | t2" (format rows), "id:t1 | id:t2" (ids explicites) ou "id: texte" (format lines)
+ROW_LINE_RE = re.compile(r"^(\d+)(?:-(\d+))?: (.*)$")
+EXPLICIT_TOKEN_RE = re.compile(r"^(\d+):(.*)$")
+STREAM_CHUNK_CHARS = 24  # taille des deltas en mode streaming
+
+
+def prompt_tokens(prompt: str) -> list[tuple[int, str]]:
+    """Relit les (id, texte) des tokens sérialisés dans un prompt d'extraction."""
+    tokens = []
+    for line in prompt.splitlines():
+        match = ROW_LINE_RE.match(line)
+        if match:
+            first_id = int(match.group(1))
+            texts = match.group(3).split(" | ") if match.group(2) else [match.group(3)]
+            tokens.extend((first_id + k, text) for k, text in enumerate(texts))
+        elif " | " in line and all(EXPLICIT_TOKEN_RE.match(part) for part in line.split(" | ")):
+            for part in line.split(" | "):
+                token_id, text = EXPLICIT_TOKEN_RE.match(part).groups()
+                tokens.append((int(token_id), text))
+    return tokens
+
+
+def fake_extraction(prompt: str) -> list[dict]:
+    """Extraction déterministe : une ligne par numéro de compte, montants pris dans l'ordre."""
+    rows = []
+    for token_id, text in prompt_tokens(prompt):
+        if ACCOUNT_RE.match(text):
+            rows.append({"compte": [text, token_id], "solde_an": [None, None], "solde": [None, None],
+                         "débit": [0, None], "crédit": [0, None]})
+        elif rows and AMOUNT_RE.match(text):
+            row = rows[-1]
+            for field in ("solde_an", "débit", "crédit", "solde"):
+                if row[field][1] is None:
+                    row[field] = [text, token_id]
+                    break
+    return rows
+
+
+def fake_embedding(text, dims: int) -> list[float]:
+    """Vecteur unitaire déterministe dérivé du SHA-256 du texte (ou des ids de tokens)."""
+    seed = int(hashlib.sha256(json.dumps(text).encode("utf-8")).hexdigest()[:16], 16)
+    vector = np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeOpenAIServer:
+    """Serveur OpenAI factice, démarré dans un thread (port libre choisi par l'OS)."""
+
+    def __init__(self, llm_latency: float = 0.0, embedding_latency: float = 0.0, dims: int = 256):
+        self.llm_latency = llm_latency
+        self.embedding_latency = embedding_latency
+        self.dims = dims
+        self.requests = {"chat": 0, "embeddings": 0}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+
+    def _count(self, kind: str):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def chat_response(self, body: dict, delay: bool = True) -> dict:
+        self._count("chat")
+        if delay:
+            time.sleep(self.llm_latency)
+        prompt = body["messages"][-1]["content"]
+        content = "```json\n" + json.dumps(fake_extraction(prompt), ensure_ascii=False) + "\n```"
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4}
+        }
+
+    def chat_stream_events(self, body: dict):
+        """
+        Même réponse que chat_response, découpée en chunks "chat.completion.chunk" (stream=True).
+        La latence simulée est répartie entre les chunks, comme une génération progressive.
+        """
+        response = self.chat_response(body, delay=False)
+        content = response["choices"][0]["message"]["content"]
+        base = {"id": response["id"], "object": "chat.completion.chunk", "created": response["created"],
+                "model": response["model"]}
+        starts = range(0, len(content), STREAM_CHUNK_CHARS)
+        for start in starts:
+            time.sleep(self.llm_latency / len(starts))
+            delta = {"content": content[start:start + STREAM_CHUNK_CHARS]}
+            yield {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        yield {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield {**base, "choices": [], "usage": response["usage"]}
+
+    def embeddings_response(self, body: dict) -> dict:
+        self._count("embeddings")
+        time.sleep(self.embedding_latency)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_embedding(text, self.dims)
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(str(text)) for text in inputs) // 4
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.endswith("/chat/completions") and body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for event in server.chat_stream_events(body):
+                        self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.close_connection = True
+                    return
+                if self.path.endswith("/chat/completions"):
+                    payload = server.chat_response(body)
+                elif self.path.endswith("/embeddings"):
+                    payload = server.embeddings_response(body)
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def install_mongo_standin():
+    """Remplace pymongo.MongoClient par un client mongomock partagé (base en mémoire)."""
+    try:
+        import mongomock
+        import mongomock.collection
+    except ImportError:
+        raise SystemExit("Le benchmark nécessite mongomock : pip install mongomock")
+    import pymongo
+
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+    # Les UpdateOne récents de pymongo passent un argument "sort" inconnu de mongomock
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+    def add_update_compat(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    mongomock.collection.BulkOperationBuilder.add_update = add_update_compat
+    return client
@@ -0,0 +1,109 @@
+"""
+Budget de démarrage d'un worker : temps d'import de app.py dans un interpréteur neuf
+(ce que paie chaque nouveau process gunicorn/forké), sans secrets ni réseau.
+
+    cd backend
+    python -m benchmarks.startup_time [--runs 5] [--budget 1.0] [--top 10]
+
+Échoue (code 1) si la médiane dépasse le budget, ou si un module lourd dont l'import
+doit rester différé (client OpenAI, langchain, pdf2image) est chargé au démarrage.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "1.0"))
+# Modules importés à la première requête qui en a besoin, jamais au démarrage
+DEFERRED_MODULES = ["openai", "langchain_openai", "langchain_text_splitters", "pdf2image"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": sorted(m for m in sys.modules if "." not in m)}))
+"""
+
+
+def _environment() -> dict:
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("OPENAI_API_KEY", "MONGODB_URI", "WERKZEUG_RUN_MAIN")}
+    env["PYTHONPATH"] = str(BACKEND_DIR)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def measure_import(workdir: Path, importtime: bool = False) -> tuple[dict, str]:
+    """Importe app dans un process neuf (répertoire de travail jetable) ; retourne (mesure, stderr)."""
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE]
+    proc = subprocess.run(cmd, cwd=workdir, env=_environment(), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise SystemExit(f"Import de app impossible :\n{proc.stderr[-2000:]}")
+    # Les threads lancés à l'import (reprise des jobs, GC) peuvent écrire après la mesure
+    line = next(line for line in reversed(proc.stdout.splitlines()) if line.startswith('{"seconds"'))
+    return json.loads(line), proc.stderr
+
+
+def top_imports(importtime_log: str, count: int) -> list[tuple[str, float]]:
+    """Imports directs de app les plus coûteux (temps cumulé, -X importtime)."""
+    children = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # ligne d'en-tête
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        # Sortie en post-ordre : les imports d'un module précèdent sa propre ligne
+        if depth == 1:
+            children.append((name.strip(), int(cumulative) / 1e6))
+        elif depth == 0:
+            if name.strip() == "app":
+                return sorted(children, key=lambda item: -item[1])[:count]
+            children = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_SECONDS, help="médiane maximale (s)")
+    parser.add_argument("--top", type=int, default=10, help="imports les plus coûteux à afficher")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="startup-") as tmp:
+        # app.py crée uploads/ et ../frontend/ relativement au répertoire courant
+        workdir = Path(tmp) / "backend"
+        workdir.mkdir()
+        measure_import(workdir)  # échauffement (cache disque, bytecode)
+        timings, modules = [], []
+        for _ in range(args.runs):
+            result, _ = measure_import(workdir)
+            timings.append(result["seconds"])
+            modules = result["modules"]
+        _, importtime_log = measure_import(workdir, importtime=True)
+
+    median = statistics.median(timings)
+    print(f"Import de app : médiane {median * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms "
+          f"({args.runs} runs, budget {args.budget * 1000:.0f} ms)")
+    print("Imports les plus coûteux :")
+    for name, seconds in top_imports(importtime_log, args.top):
+        print(f"  {name:<32} {seconds * 1000:8.1f} ms")
+
+    eager = [name for name in DEFERRED_MODULES if name in modules]
+    if eager:
+        print(f"Modules chargés au démarrage alors qu'ils devraient être différés : {', '.join(eager)}")
+    if median > args.budget:
+        print("Budget de démarrage dépassé")
+    return 1 if eager or median > args.budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Générateur de balances comptables PDF synthétiques (sans dépendance : PDF écrit à la main).
+
+Chaque page contient un tableau quadrillé (détecté par pdfplumber) de lignes
+compte / libellé / solde AN / débit / crédit / solde, avec des montants au format
+français ("1 234 567,89") que le tokenizer doit refusionner.
+
+    cd backend
+    python -m benchmarks.synthetic_pdf sortie.pdf --pages 20 --rows 55
+"""
+import argparse
+import random
+from pathlib import Path
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+FONT_SIZE = 7
+ROW_HEIGHT = 13
+TOP_MARGIN = 40
+# (titre, x de début de colonne)
+COLUMNS = [("Compte", 30), ("Libelle", 95), ("Solde AN", 245), ("Debit", 330), ("Credit", 415), ("Solde", 500)]
+TABLE_RIGHT = 575
+LABELS = ["Fournisseurs divers", "Clients", "TVA deductible", "TVA collectee", "Banque", "Caisse",
+          "Achats de marchandises", "Ventes de produits", "Charges sociales", "Total classe 4",
+          "Total classe 6", "Capital social", "Report a nouveau", "Dotations aux amortissements"]
+
+
+def format_amount(value: float) -> str:
+    """1234567.891 -> "1 234 567,89" (négatif : "-1 234,00")."""
+    sign = "-" if value < 0 else ""
+    integer, decimals = f"{abs(value):.2f}".split(".")
+    groups = []
+    while integer:
+        groups.insert(0, integer[-3:])
+        integer = integer[:-3]
+    return f"{sign}{' '.join(groups)},{decimals}"
+
+
+def ledger_rows(rng: random.Random, count: int) -> list[list[str]]:
+    rows = []
+    for _ in range(count):
+        debit = rng.choice([0, rng.uniform(0, 2_000_000)])
+        credit = rng.choice([0, rng.uniform(0, 2_000_000)])
+        opening = rng.uniform(-500_000, 500_000)
+        rows.append([
+            str(rng.randint(100000, 799999)),
+            rng.choice(LABELS),
+            format_amount(opening),
+            format_amount(debit) if debit else "",
+            format_amount(credit) if credit else "",
+            format_amount(opening + debit - credit)
+        ])
+    return rows
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _page_stream(rows: list[list[str]], ruled: bool) -> bytes:
+    ops = []
+    y = PAGE_HEIGHT - TOP_MARGIN
+    table = [[title for title, _ in COLUMNS]] + rows
+    for row in table:
+        baseline = y - ROW_HEIGHT + 4
+        for (_, x), cell in zip(COLUMNS, row):
+            if cell:
+                ops.append(f"BT /F1 {FONT_SIZE} Tf {x + 2} {baseline} Td ({_escape(cell)}) Tj ET")
+        y -= ROW_HEIGHT
+
+    if ruled:
+        top, bottom = PAGE_HEIGHT - TOP_MARGIN, y
+        ops.append("0.5 w")
+        for k in range(len(table) + 1):
+            line_y = top - k * ROW_HEIGHT
+            ops.append(f"{COLUMNS[0][1]} {line_y} m {TABLE_RIGHT} {line_y} l S")
+        for x in [x for _, x in COLUMNS] + [TABLE_RIGHT]:
+            ops.append(f"{x} {top} m {x} {bottom} l S")
+    return "\n".join(ops).encode("latin-1")
+
+
+def make_ledger_pdf(path, pages: int = 5, rows: int = 55, seed: int = 0, ruled: bool = True) -> Path:
+    """Écrit une balance synthétique de `pages` pages de `rows` lignes et retourne son chemin."""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # arbre des pages, complété une fois les pages connues
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"
+    ]
+    page_refs = []
+    for _ in range(pages):
+        stream = _page_stream(ledger_rows(rng, rows), ruled)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_ref = len(objects)
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_ref} 0 R >>"
+        ).encode("ascii"))
+        page_refs.append(len(objects))
+    kids = " ".join(f"{ref} 0 R" for ref in page_refs)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode("ascii")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+
+    path = Path(path)
+    path.write_bytes(bytes(out))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output")
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=55, help="lignes par page")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-rules", action="store_true", help="sans quadrillage (pas de tableaux détectés)")
+    args = parser.parse_args()
+    path = make_ledger_pdf(args.output, args.pages, args.rows, args.seed, ruled=not args.no_rules)
+    print(f"{path} : {args.pages} page(s) x {args.rows} lignes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+from datetime import datetime
+from pathlib import Path
+from dotenv import load_dotenv
+
+from . import token_store, artifact_writer
+
+load_dotenv()
+
+# Manifestes des artefacts dérivés d'un PDF, adressés par son SHA-256 (documentId)
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+
+
+def _manifest_path(document_id: str) -> Path:
+    # Répertoires sur 2 caractères pour éviter des dossiers trop volumineux
+    return Path(ARTIFACT_DIR) / document_id[:2] / f"{document_id}.json"
+
+
+def _json_bytes(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def _read_json(path: Path):
+    """JSON d'un artefact (écrit ou encore en file d'écriture), None s'il est absent ou illisible."""
+    try:
+        return json.loads(artifact_writer.read_bytes(path))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _tables_path(document_id: str) -> Path:
+    return Path(ARTIFACT_DIR) / document_id[:2] / f"{document_id}.tables.json"
+
+
+def save_artifacts(document_id: str, tokens_dir: Path, image_paths: list[Path], base_path: Path,
+                   tables: list[dict] | None = None, page_count: int | None = None):
+    """
+    Enregistre le manifeste des artefacts d'un document : tokens/bboxes (format colonnaire) et images des pages,
+    plus les tableaux extraits (utilisés pour les embeddings) s'ils sont fournis.
+    Les chemins sont stockés relativement à base_path (racine servie au frontend).
+    Une liste d'images vide signifie que les pages sont rendues à la demande.
+    Le manifeste est écrit en arrière-plan après les tableaux (et les tokens soumis avant lui).
+    """
+    files = []
+    if tables is not None:
+        files.append((_tables_path(document_id), _json_bytes(tables)))
+    manifest = {
+        "documentId": document_id,
+        "tokens": str(Path(tokens_dir).relative_to(base_path)),
+        "images": [str(Path(p).relative_to(base_path)) for p in image_paths],
+        "pageCount": page_count if page_count is not None else len(image_paths),
+        "createdAt": datetime.utcnow().isoformat()
+    }
+    files.append((_manifest_path(document_id), _json_bytes(manifest)))
+    artifact_writer.submit(files)
+    return manifest
+
+
+def get_artifacts(document_id: str, base_path: Path):
+    """
+    Retourne le manifeste si tous les artefacts référencés existent encore sur disque, sinon None.
+    """
+    manifest = _read_json(_manifest_path(document_id))
+    if manifest is None:
+        return None
+
+    manifest.setdefault("pageCount", len(manifest.get("images", [])))
+    tokens = manifest.get("tokens")
+    if not tokens or not artifact_writer.exists(base_path / tokens / "index.json"):
+        return None
+    if not all((base_path / rel).exists() for rel in manifest.get("images", [])):
+        return None
+    return manifest
+
+
+def load_tokens(manifest: dict, base_path: Path) -> list[dict]:
+    """Relit les tokens/bboxes référencés par le manifeste."""
+    return token_store.load_tokens(base_path / manifest["tokens"])
+
+
+def manifest_path(document_id: str) -> Path:
+    """Chemin du manifeste (sa date de modification sert de date de dernier usage du document)."""
+    return _manifest_path(document_id)
+
+
+def delete_artifacts(document_id: str):
+    """Supprime le manifeste et les tableaux : le document sera recalculé au prochain passage."""
+    for path in (_manifest_path(document_id), _tables_path(document_id)):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def load_tables(document_id: str):
+    """Relit les tableaux extraits du document, ou None s'ils n'ont pas été conservés."""
+    return _read_json(_tables_path(document_id))
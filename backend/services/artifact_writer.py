@@ -0,0 +1,137 @@
+import os
+import time
+import atexit
+import threading
+from collections import deque
+from pathlib import Path
+from dotenv import load_dotenv
+
+from .metrics import inc, observe, timer
+
+load_dotenv()
+
+# Écriture des artefacts dérivés (tokens, tableaux, manifestes) hors du chemin de la requête :
+# un thread unique les persiste dans l'ordre de soumission, par renommage atomique. L'index des
+# tokens et le manifeste sont donc toujours sur disque après les fichiers qu'ils référencent.
+ARTIFACT_WRITER_ENABLED = os.getenv("ARTIFACT_WRITER_ENABLED", "true").lower() == "true"
+# Octets en attente d'écriture au-delà desquels les producteurs attendent (backpressure)
+ARTIFACT_WRITER_MAX_PENDING_MB = float(os.getenv("ARTIFACT_WRITER_MAX_PENDING_MB", "64"))
+
+_lock = threading.Condition()
+_queue = deque()  # lots [(clé, chemin, octets)], retirés une fois écrits
+_pending = {}     # clé (chemin absolu) -> octets pas encore sur disque, servis depuis la mémoire
+_pending_bytes = 0
+_thread = None
+
+
+def _key(path) -> str:
+    return os.path.abspath(path)
+
+
+def write_atomic(path: Path, data: bytes):
+    """Écriture synchrone : fichier temporaire dans le même dossier puis os.replace."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _write_batch(batch):
+    for _, path, data in batch:
+        try:
+            with timer("artifacts.write"):
+                write_atomic(path, data)
+        except OSError as e:
+            # Le reste du lot n'est pas écrit : un index ou un manifeste ne référence jamais un fichier absent
+            print(f"[ARTIFACTS] Échec de l'écriture de {path} : {str(e)}")
+            inc("artifact_writes_total", 1, "Fichiers d'artefacts écrits en arrière-plan", result="error")
+            return
+        inc("artifact_writes_total", 1, "Fichiers d'artefacts écrits en arrière-plan", result="ok")
+
+
+def _run():
+    global _pending_bytes
+    while True:
+        with _lock:
+            _lock.wait_for(lambda: _queue)
+            batch = _queue[0]
+        _write_batch(batch)
+        with _lock:
+            _queue.popleft()
+            for key, _, data in batch:
+                # Un fichier réécrit entre-temps garde sa version la plus récente en mémoire
+                if _pending.get(key) is data:
+                    del _pending[key]
+            _pending_bytes -= sum(len(data) for _, _, data in batch)
+            _lock.notify_all()
+
+
+def _ensure_thread():
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        _thread = threading.Thread(target=_run, name="artifact-writer", daemon=True)
+        _thread.start()
+
+
+def submit(files: list[tuple[Path, bytes]]):
+    """
+    Programme l'écriture d'un lot de fichiers (dans l'ordre donné) et rend la main aussitôt ;
+    leur contenu reste lisible (read_bytes) jusqu'à l'écriture. Bloque tant que plus de
+    ARTIFACT_WRITER_MAX_PENDING_MB sont en attente.
+    """
+    global _pending_bytes
+    if not ARTIFACT_WRITER_ENABLED:
+        for path, data in files:
+            write_atomic(path, data)
+        return
+
+    size = sum(len(data) for _, data in files)
+    limit = ARTIFACT_WRITER_MAX_PENDING_MB * 1024 * 1024
+    with _lock:
+        _ensure_thread()
+        if _pending_bytes and _pending_bytes + size > limit:
+            inc("artifact_writer_backpressure_total", 1, "Soumissions mises en attente, file d'écriture pleine")
+            start = time.perf_counter()
+            _lock.wait_for(lambda: not _pending_bytes or _pending_bytes + size <= limit)
+            observe("duration_seconds", time.perf_counter() - start, name="artifacts.backpressure")
+        batch = [(_key(path), Path(path), data) for path, data in files]
+        for key, _, data in batch:
+            _pending[key] = data
+        _pending_bytes += size
+        _queue.append(batch)
+        _lock.notify_all()
+
+
+def pending(path) -> bytes | None:
+    """Contenu d'un fichier soumis mais pas encore écrit, sinon None."""
+    with _lock:
+        return _pending.get(_key(path))
+
+
+def read_bytes(path) -> bytes:
+    """Contenu d'un artefact, depuis la mémoire s'il n'est pas encore écrit (FileNotFoundError s'il n'existe pas)."""
+    data = pending(path)
+    if data is not None:
+        return data
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def exists(path) -> bool:
+    return pending(path) is not None or Path(path).exists()
+
+
+def flush(timeout: float | None = None) -> bool:
+    """Attend que toutes les écritures soumises soient terminées ; False si timeout est atteint avant."""
+    with _lock:
+        return _lock.wait_for(lambda: not _queue, timeout)
+
+
+# Arrêt du process : les artefacts en file sont écrits avant de quitter
+atexit.register(flush, 30)
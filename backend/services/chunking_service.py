@@ -1,21 +1,89 @@
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import re
 
 from .pdf_service import normalize_table_rows
 
+# Séparateurs de RecursiveCharacterTextSplitter (LangChain), du plus grossier au plus fin
+SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+def _split_keep_separator(text: str, separator: str) -> list[str]:
+    """Découpe sur `separator` en le gardant en tête du morceau suivant (keep_separator="start")."""
+    if not separator:
+        return list(text)
+    parts = re.split(f"({re.escape(separator)})", text)
+    splits = [parts[0]] + [parts[i] + parts[i + 1] for i in range(1, len(parts), 2)]
+    return [s for s in splits if s]
+
+
+def _merge_splits(splits: list[str], chunk_size: int, chunk_overlap: int) -> list[str]:
+    """Regroupe les morceaux en chunks d'au plus chunk_size caractères, avec chevauchement."""
+    chunks = []
+    current = []
+    total = 0
+    for split in splits:
+        if total + len(split) > chunk_size:
+            if current:
+                chunk = "".join(current).strip()
+                if chunk:
+                    chunks.append(chunk)
+                while total > chunk_overlap or (total + len(split) > chunk_size and total > 0):
+                    total -= len(current[0])
+                    current = current[1:]
+        current.append(split)
+        total += len(split)
+    chunk = "".join(current).strip()
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_text(text: str, chunk_size: int = 200, chunk_overlap: int = 50, separators: list[str] = SEPARATORS) -> list[str]:
+    """
+    Découpage récursif identique à RecursiveCharacterTextSplitter(chunk_size, chunk_overlap)
+    avec ses paramètres par défaut, sans dépendance à LangChain.
+    """
+    if len(text) <= chunk_size:
+        # Cas courant (une ligne de tableau) : un seul chunk, le texte nettoyé
+        text = text.strip()
+        return [text] if text else []
+
+    # Premier séparateur présent dans le texte ; "" découpe caractère par caractère
+    separator, remaining = separators[-1], []
+    for i, candidate in enumerate(separators):
+        if not candidate:
+            separator = candidate
+            break
+        if candidate in text:
+            separator, remaining = candidate, separators[i + 1:]
+            break
+
+    chunks = []
+    short_splits = []
+    for split in _split_keep_separator(text, separator):
+        if len(split) < chunk_size:
+            short_splits.append(split)
+            continue
+        if short_splits:
+            chunks.extend(_merge_splits(short_splits, chunk_size, chunk_overlap))
+            short_splits = []
+        if remaining:
+            chunks.extend(split_text(split, chunk_size, chunk_overlap, remaining))
+        else:
+            chunks.append(split)
+    if short_splits:
+        chunks.extend(_merge_splits(short_splits, chunk_size, chunk_overlap))
+    return chunks
+
+
 def create_chunks(tables: list[dict], chunk_size: int = 200, chunk_overlap: int = 50) -> list[str]:
     """
     Convert table rows into text chunks using a text splitter.
     Returns a list of text chunks.
     """
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
-    )
     chunks = []
     for table in tables:
         normalized_rows = normalize_table_rows(table["rows"])  # Directly normalize rows here
         for row in normalized_rows:
             row_text = " | ".join(row)
-            row_chunks = splitter.split_text(row_text)
-            chunks.extend(row_chunks)
-    return chunks
\ No newline at end of file
+            chunks.extend(split_text(row_text, chunk_size, chunk_overlap))
+    return chunks
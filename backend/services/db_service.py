@@ -1,26 +1,75 @@
 import os
 from datetime import datetime
-from pymongo import MongoClient, ASCENDING
+from functools import lru_cache
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv
 
+from .row_patch import diff_rows, apply_patch
+from .vector_codec import encode_embedding, decode_embedding, EMBEDDING_FIELDS, EMBEDDING_STORAGE_FORMAT, EMBEDDING_CACHE_FORMAT, CACHE_FORMATS
+from .metrics import timed
+
 load_dotenv()
 
 MONGODB_URI = os.getenv("MONGODB_URI")
 MONGODB_DB = os.getenv("MONGODB_DB", "pdf_extraction")
+# Nombre d'opérations par bulk_write
+MONGODB_BULK_BATCH_SIZE = int(os.getenv("MONGODB_BULK_BATCH_SIZE", "500"))
+DUPLICATE_KEY_ERROR = 11000
+# Nombre de lignes de finalData conservées par document dans le store d'exemples
+EXAMPLE_MAX_ROWS = int(os.getenv("EXAMPLE_MAX_ROWS", "5"))
+
+
+@lru_cache(maxsize=1)
+def get_db():
+    """
+    Connexion MongoDB et création des index au premier accès à une collection :
+    l'import du module ne nécessite ni réseau ni secrets (démarrage rapide des workers).
+    """
+    if not MONGODB_URI:
+        raise ValueError("⚠️ MONGODB_URI manquant dans .env")
+    database = MongoClient(MONGODB_URI)[MONGODB_DB]
+
+    # Index unique sur documentId (hash) pour extractions
+    database.files.create_index([("documentId", ASCENDING)], unique=True)
+
+    # Empreintes de contenu : égalité exacte et bandes du SimHash (quasi-doublons)
+    database.files.create_index([("fingerprint.content", ASCENDING)])
+    database.files.create_index([("fingerprint.bands", ASCENDING)])
+
+    # Jobs non terminés, relus périodiquement par chaque worker (reprise des baux expirés, GC)
+    database.files.create_index([("job.status", ASCENDING)])
+
+    # Index sur document_id et chunk_id pour embeddings (pour éviter les doublons)
+    database.embeddings.create_index([("document_id", ASCENDING), ("chunk_id", ASCENDING)], unique=True)
+
+    # Un exemple par document
+    database.examples.create_index([("documentId", ASCENDING)], unique=True)
+
+    # Index unique sur la clé du cache d'embeddings
+    database.embedding_cache.create_index([("key", ASCENDING)], unique=True)
 
-if not MONGODB_URI:
-    raise ValueError("⚠️ MONGODB_URI manquant dans .env")
+    # Un gabarit par mise en page ; recherche par document source
+    database.templates.create_index([("templateId", ASCENDING)], unique=True)
+    database.templates.create_index([("sourceDocumentIds", ASCENDING)])
+    return database
 
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
-extractions = db.files
-embeddings = db.embeddings  # Collection pour les embeddings
 
-# Index unique sur documentId (hash) pour extractions
-extractions.create_index([("documentId", ASCENDING)], unique=True)
+class LazyCollection:
+    """Collection résolue au premier usage (cf. get_db)."""
 
-# Index sur document_id et chunk_id pour embeddings (pour éviter les doublons)
-embeddings.create_index([("document_id", ASCENDING), ("chunk_id", ASCENDING)], unique=True)
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_db()[self.name], attr)
+
+
+extractions = LazyCollection("files")
+embeddings = LazyCollection("embeddings")  # Collection pour les embeddings
+embedding_cache = LazyCollection("embedding_cache")  # Cache des vecteurs par empreinte (modèle + texte du chunk)
+examples = LazyCollection("examples")  # Exemples few-shot précalculés (premières lignes de finalData par document)
+templates = LazyCollection("templates")  # Gabarits de mise en page appris sur les documents corrigés
 
 def get_extractions_by_ids(document_ids: list[str]) -> list[dict]:
     """
@@ -36,6 +85,34 @@ def get_extraction_by_id(document_id: str):
     """Récupère tout le document (sans _id) par documentId."""
     return extractions.find_one({"documentId": document_id}, {"_id": 0})
 
+def save_fingerprint(document_id: str, fingerprint: dict):
+    """Enregistre l'empreinte de contenu d'un document (cf. fingerprint_service)."""
+    extractions.update_one({"documentId": document_id}, {"$set": {"fingerprint": fingerprint}})
+
+def find_exact_fingerprints(document_id: str, fingerprint: dict) -> list[dict]:
+    """Documents finalisés de même empreinte de contenu exacte (index fingerprint.content, sans limite)."""
+    return list(extractions.find(
+        {"fingerprint.content": fingerprint["content"], "documentId": {"$ne": document_id}, "finalData": {"$ne": None}},
+        {"_id": 0, "documentId": 1, "version": 1, "meta.source": 1}
+    ))
+
+def find_fingerprint_candidates(document_id: str, fingerprint: dict, limit: int = 50) -> list[dict]:
+    """
+    Documents finalisés partageant une bande de SimHash (quasi-doublons), hors empreinte exacte.
+    Des relevés d'une même banque partagent souvent une bande : la recherche est bornée à `limit`
+    documents, les plus récemment mis à jour d'abord (ordre déterministe).
+    """
+    return list(extractions.find(
+        {
+            "fingerprint.bands": {"$in": fingerprint["bands"]},
+            "fingerprint.content": {"$ne": fingerprint["content"]},
+            "documentId": {"$ne": document_id},
+            "finalData": {"$ne": None}
+        },
+        {"_id": 0, "documentId": 1, "fingerprint.simhash": 1}
+    ).sort([("updatedAt", DESCENDING), ("documentId", ASCENDING)]).limit(limit))
+
+@timed("db.insert_placeholder")
 def insert_placeholder(document_id: str, file_name: str | None = None):
     """
     Insert initial placeholder: only documentId and optional fileName, null/empty for others.
@@ -52,15 +129,22 @@ def insert_placeholder(document_id: str, file_name: str | None = None):
         "meta": {},
         "corrections": []
     }
-    extractions.insert_one(doc)
-    return get_extraction_by_id(document_id)
+    try:
+        extractions.insert_one(doc)
+    except DuplicateKeyError:
+        # Upload concurrent du même PDF : le placeholder existe déjà
+        return get_extraction_by_id(document_id)
+    doc.pop("_id", None)  # insert_one ajoute _id au dict : pas de relecture nécessaire
+    return doc
 
+@timed("db.complete_extraction")
 def complete_extraction(document_id: str, raw_data, final_data, meta: dict | None = None):
     """
     Complete the extraction after RAG and LLM processing: set raw, finalData, meta.
-    Retourne le document mis à jour (sans _id).
+    meta["source"] ("llm" par défaut, "corrected" pour un doublon d'un document corrigé) est la source de l'exemple.
+    Retourne True si le document existait (sinon rien n'est écrit).
     """
-    extractions.update_one(
+    result = extractions.update_one(
         {"documentId": document_id},
         {
             "$set": {
@@ -71,7 +155,10 @@ def complete_extraction(document_id: str, raw_data, final_data, meta: dict | Non
             }
         }
     )
-    return get_extraction_by_id(document_id)
+    if not result.matched_count:
+        return False
+    store_example(document_id, final_data, source=(meta or {}).get("source", "llm"))
+    return True
 
 def insert_extraction(document_id: str, file_name: str, raw_data, meta: dict | None = None):
     """
@@ -90,58 +177,320 @@ def insert_extraction(document_id: str, file_name: str, raw_data, meta: dict | N
         "corrections": []          # initialisation vide
     }
     extractions.insert_one(doc)
-    return get_extraction_by_id(document_id)
+    doc.pop("_id", None)
+    return doc
 
-def update_extraction_with_correction(document_id: str, new_final_data):
+def _correction_state(document_id: str):
+    """finalData courant et numéro de version (legacy : nombre d'entrées de corrections)."""
+    docs = list(extractions.aggregate([
+        {"$match": {"documentId": document_id}},
+        {"$project": {
+            "_id": 0,
+            "finalData": 1,
+            "version": 1,
+            "correctionCount": {"$size": {"$ifNull": ["$corrections", []]}}
+        }}
+    ]))
+    return docs[0] if docs else None
+
+@timed("db.update_correction")
+def update_extraction_with_correction(document_id: str, new_final_data, max_retries: int = 3):
     """
-    Ajoute une correction avec timestamp et met à jour finalData.
-    Retourne le document mis à jour (sans _id).
+    Met à jour finalData et ajoute au journal des corrections (append-only, $push atomique)
+    le patch inverse ligne à ligne qui permet de retrouver la version précédente.
+    La version du document sert de verrou optimiste : une correction concurrente provoque un nouvel essai.
+    Retourne {"version", "changes"}, ou None si le document n'existe pas.
     """
-    doc = get_extraction_by_id(document_id)
-    if not doc:
-        return None
+    for _ in range(max_retries):
+        state = _correction_state(document_id)
+        if state is None:
+            return None
 
-    # Ajouter l'ancienne version de finalData dans corrections
-    correction_entry = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "finalData": doc.get("finalData", [])
-    }
+        has_version = "version" in state
+        version = state["version"] if has_version else state["correctionCount"]
+        old_final_data = state.get("finalData") or []
+        reverse_patch = diff_rows(new_final_data, old_final_data)
+        if not reverse_patch:
+            return {"version": version, "changes": 0}
+
+        now = datetime.utcnow()
+        result = extractions.update_one(
+            {"documentId": document_id, "version": version if has_version else {"$exists": False}},
+            {
+                "$set": {"finalData": new_final_data, "version": version + 1, "updatedAt": now},
+                "$push": {"corrections": {
+                    "version": version + 1,
+                    "timestamp": now.isoformat(),
+                    "patch": reverse_patch
+                }}
+            }
+        )
+        if result.modified_count == 1:
+            store_example(document_id, new_final_data, source="corrected")
+            return {"version": version + 1, "changes": len(reverse_patch)}
+    raise Exception(f"Correction concurrente sur {document_id}, abandon après {max_retries} essais")
+
+def get_extraction_version(document_id: str, version: int):
+    """
+    Reconstruit finalData tel qu'il était à une version donnée (0 = résultat initial),
+    en appliquant les patchs inverses depuis la version courante.
+    Retourne None si le document ou la version n'existe pas.
+    """
+    state = _correction_state(document_id)
+    if state is None:
+        return None
+    current = state["version"] if "version" in state else state["correctionCount"]
+    if version < 0 or version > current:
+        return None
 
-    corrections = doc.get("corrections", [])
-    corrections.append(correction_entry)
+    final_data = state.get("finalData")
+    if version == current:
+        return final_data
 
-    # Mise à jour de finalData et corrections
-    extractions.update_one(
+    # Seules les entrées postérieures à la version demandée sont lues
+    doc = extractions.find_one(
         {"documentId": document_id},
-        {
-            "$set": {
-                "finalData": new_final_data,
-                "corrections": corrections,
-                "updatedAt": datetime.utcnow()
-            }
-        }
+        {"_id": 0, "corrections": {"$slice": [version, current - version]}}
     )
+    for entry in reversed(doc.get("corrections", [])):
+        if "patch" in entry:
+            final_data = apply_patch(final_data, entry["patch"])
+        else:
+            # Ancien format : copie complète de la version précédente
+            final_data = entry.get("finalData")
+    return final_data
 
-    # Retourner le document mis à jour
-    return get_extraction_by_id(document_id)
+def store_example(document_id: str, final_data, source: str = "llm"):
+    """
+    Matérialise l'exemple few-shot d'un document (premières lignes de finalData).
+    Un exemple issu d'une correction n'est jamais remplacé par un résultat du LLM.
+    """
+    if not isinstance(final_data, list) or not final_data:
+        return
+    query = {"documentId": document_id}
+    if source != "corrected":
+        query["source"] = {"$ne": "corrected"}
+    try:
+        examples.update_one(
+            query,
+            {"$set": {"rows": final_data[:EXAMPLE_MAX_ROWS], "source": source, "updatedAt": datetime.utcnow()}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # exemple corrigé déjà présent
 
+def get_examples(document_ids: list[str]) -> dict[str, dict]:
+    """
+    Exemples précalculés des documents demandés (documentId -> {"rows", "source"}), en une requête.
+    Les documents finalisés avant l'existence du store sont matérialisés au passage.
+    """
+    if not document_ids:
+        return {}
+    found = {
+        doc["documentId"]: doc
+        for doc in examples.find({"documentId": {"$in": document_ids}}, {"_id": 0, "documentId": 1, "rows": 1, "source": 1})
+    }
+    missing = [doc_id for doc_id in document_ids if doc_id not in found]
+    if missing:
+        for doc in extractions.find(
+            {"documentId": {"$in": missing}, "finalData": {"$ne": None}},
+            {"_id": 0, "documentId": 1, "finalData": {"$slice": EXAMPLE_MAX_ROWS}, "version": 1, "corrections": {"$slice": 1}}
+        ):
+            # Documents corrigés avant le versionnage : corrections non vides mais pas de version
+            source = "corrected" if doc.get("version") or doc.get("corrections") else "llm"
+            store_example(doc["documentId"], doc["finalData"], source=source)
+            if isinstance(doc["finalData"], list) and doc["finalData"]:
+                found[doc["documentId"]] = {"documentId": doc["documentId"], "rows": doc["finalData"], "source": source}
+    return found
+
+def store_template(template: dict, document_id: str):
+    """Enregistre un gabarit (un par mise en page) et rattache le document corrigé dont il est issu."""
+    fields = {key: value for key, value in template.items() if key != "templateId"}
+    try:
+        templates.update_one(
+            {"templateId": template["templateId"]},
+            {"$set": {**fields, "updatedAt": datetime.utcnow()}, "$addToSet": {"sourceDocumentIds": document_id}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # même gabarit enregistré en parallèle
+
+def get_templates(document_ids: list[str]) -> list[dict]:
+    """Gabarits appris sur les documents demandés (sans doublon), les plus récents en premier."""
+    if not document_ids:
+        return []
+    return list(templates.find({"sourceDocumentIds": {"$in": document_ids}}, {"_id": 0}).sort("updatedAt", -1))
+
+def _bulk_write(collection, operations: list, batch_size: int = MONGODB_BULK_BATCH_SIZE):
+    """
+    Exécute des opérations en bulk_write non ordonnés, par lots de batch_size.
+    Les doublons (clé unique déjà présente, ex. upsert concurrent) sont ignorés ;
+    toute autre erreur d'écriture est propagée.
+    """
+    for start in range(0, len(operations), batch_size):
+        try:
+            collection.bulk_write(operations[start:start + batch_size], ordered=False)
+        except BulkWriteError as e:
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY_ERROR]
+            if errors or e.details.get("writeConcernErrors"):
+                raise
+
+def embedding_update(fields: dict, embedding, storage_format: str = EMBEDDING_STORAGE_FORMAT) -> dict:
+    """Mise à jour $set des champs et du vecteur encodé (cf. vector_codec) ; retire les champs binaires obsolètes."""
+    encoded = encode_embedding(embedding, storage_format)
+    update = {"$set": {**fields, **encoded}}
+    if "embedding_format" not in encoded:
+        update["$unset"] = {"embedding_format": "", "embedding_scale": ""}
+    return update
+
+@timed("db.store_embeddings")
 def store_embeddings(document_id: str, chunks: list[str], embedding_vectors: list[list[float]]):
     """
     Store embeddings in the embeddings collection.
-    Each embedding document contains document_id, chunk_id, text, and embedding.
-    """
-    for chunk_id, (text, embedding) in enumerate(zip(chunks, embedding_vectors), 1):
-        embedding_doc = {
-            "document_id": document_id,
-            "chunk_id": chunk_id,
-            "text": text,
-            "embedding": embedding
+    Each embedding document contains document_id, chunk_id, text, and embedding
+    (BinData int8/float16 selon EMBEDDING_STORAGE_FORMAT, cf. vector_codec).
+    Upserts sur (document_id, chunk_id) envoyés en bulk : une relance remplace les chunks existants.
+    """
+    operations = [
+        UpdateOne(
+            {"document_id": document_id, "chunk_id": chunk_id},
+            embedding_update({"text": text}, embedding),
+            upsert=True
+        )
+        for chunk_id, (text, embedding) in enumerate(zip(chunks, embedding_vectors), 1)
+    ]
+    try:
+        _bulk_write(embeddings, operations)
+    except BulkWriteError as e:
+        raise Exception(f"Failed to store embeddings: {e.details.get('writeErrors', [])[:1]}")
+
+def get_cached_embeddings(keys: list[str]) -> dict[str, list[float]]:
+    """
+    Vecteurs déjà calculés pour ces clés de cache (clé -> embedding).
+    Les entrées int8 (écrites avant EMBEDDING_CACHE_FORMAT) sont ignorées : recalculées puis remplacées.
+    """
+    if not keys:
+        return {}
+    return {
+        doc["key"]: decode_embedding(doc).tolist()
+        for doc in embedding_cache.find({"key": {"$in": keys}, "embedding_format": {"$ne": "int8"}},
+                                        {"_id": 0, "key": 1, **EMBEDDING_FIELDS})
+    }
+
+@timed("db.store_cached_embeddings")
+def store_cached_embeddings(entries: list[dict]):
+    """
+    Ajoute des vecteurs au cache ({"key", "model", "embedding"}), encodés en EMBEDDING_CACHE_FORMAT
+    (EMBEDDING_STORAGE_FORMAT ne concerne que la collection embeddings).
+    Upsert avec $setOnInsert : une clé déjà présente (calculée en parallèle par un autre job) est conservée,
+    sauf une entrée int8 qui est remplacée.
+    """
+    if not entries:
+        return
+    if EMBEDDING_CACHE_FORMAT not in CACHE_FORMATS:
+        raise ValueError(f"Format du cache d'embeddings non supporté : {EMBEDDING_CACHE_FORMAT}")
+    now = datetime.utcnow()
+    operations = []
+    for entry in entries:
+        encoded = encode_embedding(entry["embedding"], EMBEDDING_CACHE_FORMAT)
+        operations.append(UpdateOne({"key": entry["key"], "embedding_format": "int8"}, {"$set": encoded}))
+        operations.append(UpdateOne(
+            {"key": entry["key"]},
+            {"$setOnInsert": {**entry, **encoded, "createdAt": now}},
+            upsert=True
+        ))
+    _bulk_write(embedding_cache, operations)
+
+###fonctions pour les jobs d'extraction
+
+def create_job(document_id: str, file_name: str | None, stages: list[str], owner: str, stale_before: datetime) -> bool:
+    """
+    Prend le bail d'extraction d'un document : crée (ou réinitialise) l'état du job dans le document files,
+    créé comme placeholder s'il n'existe pas encore (cf. insert_placeholder).
+    Échoue (False) si un job queued/running d'un autre worker a un heartbeat postérieur à stale_before :
+    ce worker possède déjà le pipeline et les demandes suivantes attendent son résultat.
+    """
+    now = datetime.utcnow()
+    job = {
+        "status": "queued",
+        "stage": None,
+        "stages": {name: {"status": "pending"} for name in stages},
+        "error": None,
+        "result": None,
+        "owner": owner,
+        "attempts": 1,
+        "submittedAt": now,
+        "heartbeatAt": now
+    }
+    lease_free = {"$or": [
+        {"job.status": {"$nin": ["queued", "running"]}},
+        {"job.heartbeatAt": {"$lt": stale_before}}
+    ]}
+    try:
+        result = extractions.update_one(
+            {"documentId": document_id, **lease_free},
+            {
+                "$setOnInsert": {
+                    "documentId": document_id,
+                    "fileName": file_name,
+                    "createdAt": now,
+                    "raw": None,
+                    "finalData": None,
+                    "meta": {},
+                    "corrections": []
+                },
+                "$set": {"job": job, "updatedAt": now}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Le document existe avec un bail actif : l'upsert a tenté une insertion concurrente
+        return False
+    return result.matched_count == 1 or result.upserted_id is not None
+
+def renew_job_lease(document_id: str, owner: str) -> bool:
+    """Prolonge le bail (heartbeat) ; False si le job a été repris par un autre worker."""
+    result = extractions.update_one(
+        {"documentId": document_id, "job.owner": owner, "job.status": {"$in": ["queued", "running"]}},
+        {"$set": {"job.heartbeatAt": datetime.utcnow()}}
+    )
+    return result.matched_count == 1
+
+def update_job(document_id: str, fields: dict, owner: str) -> bool:
+    """
+    Met à jour des champs de l'état du job (clés relatives à "job") et le heartbeat, seulement
+    si `owner` détient encore le bail ; False si le job a été repris par un autre worker.
+    """
+    update = {f"job.{key}": value for key, value in fields.items()}
+    update["job.heartbeatAt"] = datetime.utcnow()
+    result = extractions.update_one({"documentId": document_id, "job.owner": owner}, {"$set": update})
+    return result.matched_count == 1
+
+def get_job(document_id: str):
+    """Récupère uniquement l'état du job (sans raw/finalData/corrections)."""
+    return extractions.find_one({"documentId": document_id}, {"_id": 0, "documentId": 1, "job": 1})
+
+def find_unfinished_jobs() -> list[dict]:
+    """Jobs en file ou en cours, candidats à une reprise."""
+    return list(extractions.find(
+        {"job.status": {"$in": ["queued", "running"]}},
+        {"_id": 0, "documentId": 1, "fileName": 1, "job": 1}
+    ))
+
+def find_live_job_ids(heartbeat_after: datetime) -> list[str]:
+    """Jobs en file ou en cours, tous workers confondus, dont le heartbeat est postérieur à heartbeat_after."""
+    return [doc["documentId"] for doc in extractions.find(
+        {"job.status": {"$in": ["queued", "running"]}, "job.heartbeatAt": {"$gt": heartbeat_after}},
+        {"_id": 0, "documentId": 1}
+    )]
+
+def claim_job(document_id: str, previous_owner: str | None, owner: str) -> bool:
+    """Réserve atomiquement la reprise d'un job : échoue si un autre process l'a déjà pris."""
+    result = extractions.update_one(
+        {"documentId": document_id, "job.owner": previous_owner, "job.status": {"$in": ["queued", "running"]}},
+        {
+            "$set": {"job.owner": owner, "job.status": "queued", "job.heartbeatAt": datetime.utcnow()},
+            "$inc": {"job.attempts": 1}
         }
-        try:
-            embeddings.insert_one(embedding_doc)
-        except Exception as e:
-            # Gérer les doublons potentiels (si l'index unique est violé)
-            if "duplicate key error" in str(e).lower():
-                print(f"Embedding for document_id={document_id}, chunk_id={chunk_id} already exists. Skipping.")
-            else:
-                raise Exception(f"Failed to store embedding: {str(e)}")
\ No newline at end of file
+    )
+    return result.modified_count == 1
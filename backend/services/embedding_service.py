@@ -1,12 +1,84 @@
-from langchain_openai import OpenAIEmbeddings
+import os
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
 
+from .db_service import get_cached_embeddings, store_cached_embeddings
+from .metrics import timed, inc
+
+load_dotenv()
+
+# Lots bornés en nombre de chunks et en caractères, envoyés en parallèle
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "100000"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+# Découpage par langchain (tiktoken) des textes dépassant le contexte du modèle ; inutile pour
+# des chunks de quelques centaines de caractères, et désactivable hors-ligne (tiktoken télécharge ses tables)
+EMBEDDING_CHECK_CTX_LENGTH = os.getenv("EMBEDDING_CHECK_CTX_LENGTH", "true").lower() == "true"
+
+
+@lru_cache(maxsize=8)
+def _get_embeddings_model(model: str, api_key: str | None) -> "OpenAIEmbeddings":
+    """Client réutilisé entre les appels (un par modèle / clé), langchain_openai importé au premier appel."""
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model=model, openai_api_key=api_key, check_embedding_ctx_length=EMBEDDING_CHECK_CTX_LENGTH)
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """Empreinte SHA-256 du modèle et du texte d'un chunk."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _batches(texts: list[str], batch_size: int, max_chars: int) -> list[list[str]]:
+    batches, current, current_chars = [], [], 0
+    for text in texts:
+        if current and (len(current) >= batch_size or current_chars + len(text) > max_chars):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(text)
+        current_chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _embed_batches(embeddings_model: "OpenAIEmbeddings", texts: list[str]) -> list[list[float]]:
+    batches = _batches(texts, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_CHARS)
+    if len(batches) == 1:
+        return embeddings_model.embed_documents(batches[0])
+    with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_CONCURRENCY, len(batches))) as pool:
+        results = pool.map(embeddings_model.embed_documents, batches)
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+
+@timed("embeddings.generate")
 def generate_embeddings(chunks: list[str], model: str = "text-embedding-3-small", api_key: str = None) -> list[list[float]]:
     """
     Generate embeddings for a list of text chunks using OpenAI's embedding model.
     Returns a list of embedding vectors.
+
+    Les chunks identiques ne sont calculés qu'une fois, et seuls les textes absents
+    du cache (collection embedding_cache) sont envoyés à l'API.
     """
     try:
-        embeddings_model = OpenAIEmbeddings(model=model, openai_api_key=api_key)
-        return embeddings_model.embed_documents(chunks)
+        keys = [embedding_cache_key(model, text) for text in chunks]
+        unique = dict(zip(keys, chunks))  # clé -> texte, sans doublons
+        vectors = get_cached_embeddings(list(unique))
+
+        missing = [key for key in unique if key not in vectors]
+        print(f"[Embeddings] {len(chunks)} chunks, {len(unique)} distincts, {len(missing)} à calculer")
+        inc("embedding_chunks_total", len(chunks), "Chunks à vectoriser")
+        inc("embedding_cache_misses_total", len(missing), "Chunks distincts absents du cache d'embeddings")
+        if missing:
+            new_vectors = _embed_batches(_get_embeddings_model(model, api_key), [unique[key] for key in missing])
+            computed = dict(zip(missing, new_vectors))
+            store_cached_embeddings([
+                {"key": key, "model": model, "embedding": vector} for key, vector in computed.items()
+            ])
+            vectors.update(computed)
+
+        return [vectors[key] for key in keys]
     except Exception as e:
-        raise Exception(f"Failed to generate embeddings: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to generate embeddings: {str(e)}")
@@ -0,0 +1,164 @@
+import os
+import re
+from statistics import median
+from dotenv import load_dotenv
+
+from .tokenizer import parse_amount
+from .llm_service import group_rows
+
+load_dotenv()
+
+EXTRACTION_FIELDS = ("compte", "solde_an", "solde", "débit", "crédit")
+# Écart toléré (en unité monétaire) entre valeurs, et sur l'équilibre solde = solde AN + débit - crédit
+AMOUNT_TOLERANCE = 0.005
+BALANCE_TOLERANCE = float(os.getenv("LLM_BALANCE_TOLERANCE", "0.02"))
+# Ligne de total qui clôt le tableau ("Total", "TOTAL GENERAL", "Totaux") et écart (pt) toléré
+# entre un montant de cette ligne et le bord droit de la colonne débit / crédit
+TOTAL_LABEL_RE = re.compile(r"^(total|totaux)\b", re.IGNORECASE)
+TOTAL_COLUMN_TOLERANCE = 15.0
+
+
+def as_amount(value):
+    """Montant d'une valeur extraite (nombre, "1 234,56", "1234.56", "12,5-") ; None si illisible."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    text = value.replace("\u00a0", " ").strip()
+    amount = parse_amount(text)
+    if amount is not None:
+        return amount
+    negative = text.startswith("-") or text.endswith("-")
+    try:
+        number = float(text.strip("-").replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+    return -number if negative else number
+
+
+def resolve_token_id(raw_id, tokens_dict):
+    """Clé de tokens_dict correspondant à l'id renvoyé par le LLM (int ou chaîne), None si inconnu."""
+    if raw_id is None or isinstance(raw_id, bool):
+        return None
+    if raw_id in tokens_dict:
+        return raw_id
+    if isinstance(raw_id, str) and raw_id.strip().isdigit() and int(raw_id) in tokens_dict:
+        return int(raw_id)
+    if isinstance(raw_id, int) and str(raw_id) in tokens_dict:
+        return str(raw_id)
+    return None
+
+
+def row_token_ids(row, tokens_dict) -> list:
+    """Ids existants référencés par une ligne, dans l'ordre des champs (compte en premier)."""
+    if not isinstance(row, dict):
+        return []
+    ids = []
+    for field in EXTRACTION_FIELDS:
+        pair = row.get(field)
+        if isinstance(pair, (list, tuple)) and len(pair) == 2:
+            token_id = resolve_token_id(pair[1], tokens_dict)
+            if token_id is not None:
+                ids.append(token_id)
+    return ids
+
+
+def validate_row(row, tokens_dict) -> list[str]:
+    """
+    Vérifications déterministes d'une ligne [valeur, id] ; retourne la liste des erreurs (vide si valide) :
+    format des champs, id présent dans tokens_dict, valeur égale au texte du token, équilibre du solde.
+    """
+    if not isinstance(row, dict):
+        return ["ligne non objet"]
+    errors = []
+    amounts = {}
+    for field in EXTRACTION_FIELDS:
+        pair = row.get(field)
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            errors.append(f"{field} : format [valeur, id] attendu")
+            continue
+        value, raw_id = pair
+        if raw_id is None:
+            if field == "compte":
+                errors.append("compte absent")
+            elif value not in (None, 0):
+                errors.append(f"{field} : valeur sans token")
+            else:
+                amounts[field] = 0.0
+            continue
+
+        token_id = resolve_token_id(raw_id, tokens_dict)
+        if token_id is None:
+            errors.append(f"{field} : id {raw_id} inexistant")
+            continue
+        text = str(tokens_dict[token_id]).strip()
+        if field == "compte":
+            if str(value).strip() != text:
+                errors.append(f"compte : {value!r} ne correspond pas au token {text!r}")
+            continue
+        amount, token_amount = as_amount(value), as_amount(text)
+        if amount is None or token_amount is None or abs(amount - token_amount) > AMOUNT_TOLERANCE:
+            errors.append(f"{field} : {value!r} ne correspond pas au token {text!r}")
+            continue
+        amounts[field] = amount
+
+    # Équilibre de la ligne, si les deux soldes sont présents (le solde peut être affiché sans signe)
+    opening, closing = row.get("solde_an"), row.get("solde")
+    if not errors and opening[1] is not None and closing[1] is not None:
+        expected = amounts["solde_an"] + amounts["débit"] - amounts["crédit"]
+        if min(abs(expected - amounts["solde"]), abs(abs(expected) - abs(amounts["solde"]))) > BALANCE_TOLERANCE:
+            errors.append(f"solde déséquilibré : {amounts['solde']} au lieu de {round(expected, 2)}")
+    return errors
+
+
+def _closing_total_row(rows, tokens_data, tokens_dict):
+    """
+    Dernière ligne visuelle commençant par « Total » et située sous la dernière ligne extraite :
+    les sous-totaux intermédiaires (ex. « Total classe 4 » au milieu du tableau) ne sont pas retenus.
+    """
+    position = {token["id"]: (token["page"], token["y0"]) for token in tokens_data}
+    anchors = [position[ids[0]] for ids in (row_token_ids(row, tokens_dict) for row in rows) if ids and ids[0] in position]
+    if not anchors:
+        return None
+    last = max(anchors)
+    for visual_row in reversed(group_rows(tokens_data)):
+        first = min(visual_row, key=lambda token: token["x0"])
+        if (first["page"], first["y0"]) <= last:
+            return None
+        if TOTAL_LABEL_RE.match(str(first["text"]).strip()):
+            return visual_row
+    return None
+
+
+def validate_totals(rows, tokens_data, tokens_dict) -> list[str] | None:
+    """
+    Cohérence du document : sommes des débits et des crédits extraits comparées aux montants de la ligne
+    de total qui clôt le tableau (même colonne, repérée par le bord droit des montants extraits).
+    Retourne None si le document n'a pas de ligne de total, sinon la liste des écarts (vide si cohérent).
+    """
+    if not isinstance(rows, list):
+        return None
+    total_row = _closing_total_row(rows, tokens_data, tokens_dict)
+    if total_row is None:
+        return None
+    by_id = {token["id"]: token for token in tokens_data}
+    errors = []
+    for field in ("débit", "crédit"):
+        pairs = [row.get(field) for row in rows if isinstance(row, dict)]
+        pairs = [pair for pair in pairs if isinstance(pair, (list, tuple)) and len(pair) == 2]
+        edges = [by_id[token_id]["x1"] for token_id in (resolve_token_id(pair[1], tokens_dict) for pair in pairs)
+                 if token_id in by_id]
+        if not edges:
+            continue
+        column = median(edges)
+        candidates = [token for token in total_row
+                      if abs(token["x1"] - column) <= TOTAL_COLUMN_TOLERANCE and parse_amount(token["text"]) is not None]
+        if not candidates:
+            continue
+        expected = parse_amount(min(candidates, key=lambda token: abs(token["x1"] - column))["text"])
+        extracted = sum(as_amount(pair[0]) or 0.0 for pair in pairs)
+        if abs(extracted - expected) > BALANCE_TOLERANCE:
+            errors.append(f"total {field} : {round(extracted, 2)} extrait au lieu de {expected}")
+    return errors
@@ -0,0 +1,159 @@
+import os
+import re
+import hashlib
+import unicodedata
+import numpy as np
+from dotenv import load_dotenv
+
+from .tokenizer import parse_amount
+from .db_service import save_fingerprint, find_exact_fingerprints, find_fingerprint_candidates, get_extraction_by_id
+from .metrics import timed, inc
+
+load_dotenv()
+
+# Empreinte du contenu extrait, indépendante des octets du PDF (ré-export, ré-impression) :
+#   content : SHA-256 des textes normalisés et des positions quantifiées -> égalité exacte
+#   simhash : SimHash 64 bits des textes (tokens et paires de tokens consécutifs) -> quasi-doublons
+# L'empreinte est calculée à l'extraction : les documents finalisés avant son introduction n'en ont pas
+# et ne sont jamais reconnus comme doublons (jusqu'à une nouvelle extraction).
+FINGERPRINT_ENABLED = os.getenv("FINGERPRINT_ENABLED", "true").lower() == "true"
+POSITION_QUANTUM = float(os.getenv("FINGERPRINT_POSITION_QUANTUM", "8"))  # pt
+# Distance de Hamming maximale entre SimHash pour un quasi-doublon
+FINGERPRINT_MAX_HAMMING = int(os.getenv("FINGERPRINT_MAX_HAMMING", "3"))
+SIMHASH_BITS = 64
+# Le SimHash est indexé par bandes : deux empreintes à distance <= 3 partagent au moins une des 4 bandes
+SIMHASH_BANDS = 4
+
+SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Texte comparable d'un export à l'autre : NFKC, minuscules, espaces réduits, montants canoniques."""
+    text = SPACES_RE.sub(" ", unicodedata.normalize("NFKC", str(text))).strip()
+    amount = parse_amount(text)
+    if amount is not None:
+        return f"{amount:.2f}"
+    return text.lower()
+
+
+def _content_hash(tokens_data: list[dict], normalized: list[str]) -> str:
+    """Textes normalisés et positions quantifiées relativement au coin haut gauche du contenu de chaque page."""
+    origins = {}
+    for token in tokens_data:
+        x0, y0 = origins.get(token["page"], (token["x0"], token["y0"]))
+        origins[token["page"]] = (min(x0, token["x0"]), min(y0, token["y0"]))
+    digest = hashlib.sha256()
+    for token, text in zip(tokens_data, normalized):
+        x0, y0 = origins[token["page"]]
+        column = round((token["x0"] - x0) / POSITION_QUANTUM)
+        row = round((token["y0"] - y0) / POSITION_QUANTUM)
+        digest.update(f"{token['page']}\x1f{column}\x1f{row}\x1f{text}\x1e".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def simhash(features: list[str]) -> int:
+    """SimHash 64 bits : chaque bit vaut 1 si la majorité des empreintes des features l'ont à 1."""
+    if not features:
+        return 0
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "big")
+                       for f in features], dtype=np.uint64)
+    bits = (hashes[:, None] >> np.arange(SIMHASH_BITS, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(features)
+    return sum(1 << i for i in range(SIMHASH_BITS) if votes[i] > 0)
+
+
+def simhash_bands(value: int) -> list[str]:
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    return [f"{band}:{(value >> (band * width)) & ((1 << width) - 1):04x}" for band in range(SIMHASH_BANDS)]
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def compute_fingerprint(tokens_data: list[dict]) -> dict:
+    normalized = [normalize_text(token["text"]) for token in tokens_data]
+    features = normalized + [f"{a} {b}" for a, b in zip(normalized, normalized[1:])]
+    value = simhash(features)
+    return {
+        "content": _content_hash(tokens_data, normalized),
+        "simhash": f"{value:016x}",  # hexadécimal : un entier BSON signé ne contient pas 64 bits non signés
+        "bands": simhash_bands(value),
+        "tokenCount": len(tokens_data)
+    }
+
+
+def remap_final_data(final_data: list[dict], source_raw: list[dict], tokens_data: list[dict]) -> list[dict] | None:
+    """
+    Réécrit finalData d'un document source avec les ids des tokens du nouveau document.
+    Contenu identique : les tokens s'alignent un à un dans l'ordre d'extraction (vérifié sur les textes).
+    Retourne None si l'alignement ou un id échoue.
+    """
+    if len(source_raw) != len(tokens_data):
+        return None
+    mapping = {}
+    for old, new in zip(source_raw, tokens_data):
+        if normalize_text(old["text"]) != normalize_text(new["text"]):
+            return None
+        mapping[str(old["id"])] = (new["id"], old["text"], new["text"])
+
+    remapped = []
+    for row in final_data:
+        if not isinstance(row, dict):
+            return None
+        new_row = {}
+        for field, pair in row.items():
+            if not isinstance(pair, (list, tuple)) or len(pair) != 2 or pair[1] is None:
+                new_row[field] = pair
+                continue
+            target = mapping.get(str(pair[1]))
+            if target is None:
+                return None
+            new_id, old_text, new_text = target
+            # Valeur recopiée du token : on reprend le texte du nouveau document
+            new_row[field] = [new_text if pair[0] == old_text else pair[0], new_id]
+        remapped.append(new_row)
+    return remapped
+
+
+def _example_source(candidate: dict) -> str:
+    """Source d'exemple d'un document : "corrected" s'il a été corrigé ou s'il reprend un document corrigé."""
+    if candidate.get("version") or (candidate.get("meta") or {}).get("source") == "corrected":
+        return "corrected"
+    return "llm"
+
+
+@timed("fingerprint.match")
+def find_duplicate(document_id: str, tokens_data: list[dict]):
+    """
+    Calcule et enregistre l'empreinte du document, puis cherche un document déjà extrait au contenu
+    identique ou proche. Retourne (finalData remappé ou None, meta à enregistrer ou None, quasi-doublons) ;
+    meta = {"duplicateOf": documentId source, "source": source d'exemple du document source}.
+    """
+    if not FINGERPRINT_ENABLED or not tokens_data:
+        return None, None, []
+    fingerprint = compute_fingerprint(tokens_data)
+    save_fingerprint(document_id, fingerprint)
+
+    # Égalité exacte : requête indexée distincte, jamais évincée par la limite des quasi-doublons
+    exact = find_exact_fingerprints(document_id, fingerprint)
+    # Les documents corrigés (ou reprenant un document corrigé), version la plus haute, d'abord
+    for candidate in sorted(exact, key=lambda doc: (_example_source(doc) != "corrected", -(doc.get("version") or 0))):
+        source = get_extraction_by_id(candidate["documentId"])
+        final_data = source.get("finalData") if source else None
+        if not isinstance(final_data, list) or not isinstance(source.get("raw"), list):
+            continue
+        remapped = remap_final_data(final_data, source["raw"], tokens_data)
+        if remapped is not None:
+            inc("duplicate_documents_total", 1, "Documents reconnus par empreinte de contenu", result="exact")
+            return remapped, {"duplicateOf": candidate["documentId"], "source": _example_source(candidate)}, []
+
+    value = int(fingerprint["simhash"], 16)
+    near = [
+        candidate["documentId"] for candidate in find_fingerprint_candidates(document_id, fingerprint)
+        if (candidate.get("fingerprint") or {}).get("simhash")
+        and hamming(value, int(candidate["fingerprint"]["simhash"], 16)) <= FINGERPRINT_MAX_HAMMING
+    ]
+    inc("duplicate_documents_total", 1, "Documents reconnus par empreinte de contenu",
+        result="near" if near else "none")
+    return None, None, near
@@ -13,3 +13,14 @@ def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
         for chunk in iter(lambda: f.read(chunk_size), b""):
             h.update(chunk)
     return h.hexdigest()
+
+
+def sha256_copy(src, dst, chunk_size: int = 1024 * 1024) -> tuple[str, int]:
+    """Copie un flux vers un fichier par blocs en calculant son SHA-256 au passage ; retourne (hash, taille)."""
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: src.read(chunk_size), b""):
+        h.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return h.hexdigest(), size
@@ -0,0 +1,328 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from .db_service import create_job, update_job, find_unfinished_jobs, find_live_job_ids, claim_job, renew_job_lease
+from .metrics import timer, maybe_profile
+
+load_dotenv()
+
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "2"))
+EXTRACTION_QUEUE_SIZE = int(os.getenv("EXTRACTION_QUEUE_SIZE", "20"))
+# Bail d'un job sur son document : un job dont le heartbeat est plus ancien est considéré comme
+# abandonné par son worker (le heartbeat est renouvelé toutes les JOB_STALE_SECONDS / 4 secondes)
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = max(1, JOB_STALE_SECONDS // 4)
+# Durée de conservation en mémoire des événements d'un job terminé (rejouables par /jobs/<id>/events)
+JOB_EVENTS_TTL_SECONDS = int(os.getenv("JOB_EVENTS_TTL_SECONDS", "300"))
+
+# Étapes du pipeline d'extraction, dans l'ordre
+JOB_STAGES = ["tokens", "images", "embeddings", "examples", "llm", "save"]
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+_executor = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extraction")
+_active = {}  # job_id -> Future
+_active_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Levée quand la file d'extraction a atteint EXTRACTION_QUEUE_SIZE."""
+
+
+class LeaseLostError(Exception):
+    """Levée quand le job a été repris par un autre worker (bail expiré) : ses écritures sont refusées."""
+
+
+class JobEvents:
+    """
+    Journal en mémoire des événements d'un job exécuté par ce process (étapes, lignes extraites, fin).
+    Les abonnés relisent le journal à partir d'un index : une reconnexion ne perd aucun événement.
+    """
+
+    TERMINAL = ("done", "failed")
+
+    def __init__(self):
+        self.events = []
+        self.finished_at = None
+        self._condition = threading.Condition()
+
+    def publish(self, event_type: str, data: dict):
+        with self._condition:
+            self.events.append((event_type, data))
+            if event_type in self.TERMINAL:
+                self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    def iter_from(self, last_id: int = -1, heartbeat: float = 15.0):
+        """
+        Génère (id, type, data) à partir de l'événement last_id + 1 jusqu'à l'événement terminal.
+        Génère None toutes les `heartbeat` secondes sans nouvel événement.
+        """
+        next_id = last_id + 1
+        while True:
+            with self._condition:
+                if next_id >= len(self.events):
+                    self._condition.wait(timeout=heartbeat)
+                pending = self.events[next_id:]
+            if not pending:
+                yield None
+                continue
+            for event_type, data in pending:
+                yield next_id, event_type, data
+                next_id += 1
+                if event_type in self.TERMINAL:
+                    return
+
+
+_events = {}  # job_id -> JobEvents
+
+
+class Job:
+    """Contexte passé au pipeline : enregistre la progression de chaque étape dans le document files."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.events = _events.get(job_id) or JobEvents()
+        self.lease_lost = threading.Event()
+        self._finished_stages = set()
+
+    def _publish_stage(self, name: str, status: str):
+        if status in ("done", "skipped"):
+            self._finished_stages.add(name)
+        self.events.publish("stage", {
+            "stage": name,
+            "status": status,
+            "progress": round(100 * len(self._finished_stages) / len(JOB_STAGES))
+        })
+
+    def _update(self, fields: dict):
+        """Écrit l'état du job tant que ce worker détient le bail, sinon LeaseLostError."""
+        if not update_job(self.job_id, fields, OWNER):
+            self.lease_lost.set()
+            raise LeaseLostError(f"Job {self.job_id} repris par un autre worker")
+
+    def ensure_lease(self):
+        """Vérifie le bail juste avant une écriture définitive (finalData) ; LeaseLostError s'il est perdu."""
+        if self.lease_lost.is_set() or not renew_job_lease(self.job_id, OWNER):
+            self.lease_lost.set()
+            raise LeaseLostError(f"Job {self.job_id} repris par un autre worker")
+
+    def emit_row(self, row: dict, window: int = 0):
+        """Publie une ligne comptable dès sa sortie du LLM (avant l'écriture finale en base)."""
+        self.events.publish("row", {"window": window, "row": row})
+
+    def reset_rows(self):
+        """Retire les lignes déjà publiées (document ré-extrait) : le client les efface avant les suivantes."""
+        self.events.publish("rows_reset", {})
+
+    @contextmanager
+    def stage(self, name: str):
+        # Aucune étape (embeddings, LLM payants) ne démarre sans le bail
+        if self.lease_lost.is_set():
+            raise LeaseLostError(f"Job {self.job_id} repris par un autre worker")
+        self._update({
+            "stage": name,
+            f"stages.{name}.status": "running",
+            f"stages.{name}.startedAt": datetime.utcnow()
+        })
+        self._publish_stage(name, "running")
+        start = time.perf_counter()
+        try:
+            with timer(f"stage.{name}"):
+                yield
+        except Exception:
+            self._update({
+                f"stages.{name}.status": "failed",
+                f"stages.{name}.durationMs": round((time.perf_counter() - start) * 1000, 1)
+            })
+            self._publish_stage(name, "failed")
+            raise
+        self._update({
+            f"stages.{name}.status": "done",
+            f"stages.{name}.finishedAt": datetime.utcnow(),
+            f"stages.{name}.durationMs": round((time.perf_counter() - start) * 1000, 1)
+        })
+        self._publish_stage(name, "done")
+
+    def skip(self, name: str):
+        self._update({f"stages.{name}.status": "skipped"})
+        self._publish_stage(name, "skipped")
+
+
+@contextmanager
+def _hold_lease(job: Job):
+    """Renouvelle le bail du job en arrière-plan tant que le pipeline s'exécute."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            if not renew_job_lease(job.job_id, OWNER):
+                print(f"[JOB] {job.job_id} : bail perdu")
+                job.lease_lost.set()
+                return
+
+    thread = threading.Thread(target=renew, name=f"lease-{job.job_id[:12]}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _run(job_id: str, runner, args: tuple):
+    job = Job(job_id)
+    try:
+        job._update({"status": "running", "startedAt": datetime.utcnow()})
+        with _hold_lease(job), maybe_profile(f"job-{job_id[:12]}"):
+            result = runner(job, *args)
+        job._update({"status": "done", "stage": None, "result": result, "finishedAt": datetime.utcnow()})
+        job.events.publish("done", {"jobId": job_id})
+        print(f"[JOB] {job_id} terminé")
+    except LeaseLostError as e:
+        # L'état du job appartient désormais à l'autre worker : ne pas l'écraser
+        print(f"[JOB] {job_id} abandonné : {str(e)}")
+        job.events.publish("failed", {"jobId": job_id, "error": str(e)})
+    except Exception as e:
+        print(f"[JOB] {job_id} échoué : {str(e)}")
+        # Sans effet si le bail a été perdu entre-temps (filtre sur job.owner)
+        update_job(job_id, {"status": "failed", "error": str(e), "finishedAt": datetime.utcnow()}, OWNER)
+        job.events.publish("failed", {"jobId": job_id, "error": str(e)})
+    finally:
+        with _active_lock:
+            _active.pop(job_id, None)
+
+
+def _prune_events():
+    """Oublie les journaux des jobs terminés depuis plus de JOB_EVENTS_TTL_SECONDS."""
+    expired_before = time.monotonic() - JOB_EVENTS_TTL_SECONDS
+    for job_id, events in list(_events.items()):
+        if events.finished_at is not None and events.finished_at < expired_before:
+            _events.pop(job_id, None)
+
+
+def _enqueue(job_id: str, runner, args: tuple):
+    with _active_lock:
+        if job_id in _active:
+            return False
+        if len(_active) >= EXTRACTION_QUEUE_SIZE:
+            raise QueueFullError("File d'extraction pleine")
+        _prune_events()
+        _events[job_id] = JobEvents()
+        _active[job_id] = _executor.submit(_run, job_id, runner, args)
+    return True
+
+
+def get_job_events(job_id: str) -> JobEvents | None:
+    """Journal d'événements du job s'il est (ou a été récemment) exécuté par ce process."""
+    with _active_lock:
+        return _events.get(job_id)
+
+
+def active_job_ids() -> list[str]:
+    """Jobs en file ou en cours dans ce process."""
+    with _active_lock:
+        return list(_active)
+
+
+def live_job_ids() -> list[str]:
+    """
+    Jobs en file ou en cours dans ce process et dans les autres workers (heartbeat récent dans MongoDB) :
+    leurs artefacts ne doivent pas être évincés. Lève l'erreur MongoDB plutôt que de protéger moins.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    return active_job_ids() + find_live_job_ids(stale_before)
+
+
+def submit_job(document_id: str, file_name: str | None, runner, *args) -> str:
+    """
+    Enregistre un job d'extraction dans le document files (créé comme placeholder si absent)
+    et le place dans la file des workers. Le job id est le documentId.
+    Un job déjà en cours pour le même document n'est pas dupliqué, dans ce process comme dans
+    les autres (bail sur le document files) : la demande suit alors le job existant.
+    """
+    job_id = document_id
+    with _active_lock:
+        if job_id in _active:
+            return job_id
+    stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    if not create_job(document_id, file_name, JOB_STAGES, OWNER, stale_before):
+        print(f"[JOB] {job_id} déjà en cours sur un autre worker, attente de son résultat")
+        return job_id
+    try:
+        _enqueue(job_id, runner, (document_id, file_name) + args)
+    except QueueFullError:
+        # Libérer le bail : sinon les demandes suivantes attendraient un job jamais exécuté
+        update_job(job_id, {"status": "failed", "error": "File d'extraction pleine"}, OWNER)
+        raise
+    return job_id
+
+
+def _owner_is_dead(owner: str | None) -> bool:
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+def resume_unfinished_jobs(runner) -> int:
+    """
+    Remet en file les jobs queued/running abandonnés : worker local mort (redémarrage)
+    ou heartbeat plus ancien que JOB_STALE_SECONDS (cf. start_job_reaper). La reprise est réservée de façon
+    atomique pour qu'un seul process la fasse.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    resumed = 0
+    for doc in find_unfinished_jobs():
+        job = doc.get("job", {})
+        owner = job.get("owner")
+        if owner == OWNER:
+            continue
+        heartbeat = job.get("heartbeatAt")
+        if not _owner_is_dead(owner) and heartbeat and heartbeat > stale_before:
+            continue
+        with _active_lock:
+            if len(_active) >= EXTRACTION_QUEUE_SIZE:
+                break  # file pleine : le bail reste à l'ancien worker, repris au prochain passage
+        if not claim_job(doc["documentId"], owner, OWNER):
+            continue
+        try:
+            if _enqueue(doc["documentId"], runner, (doc["documentId"], doc.get("fileName"))):
+                resumed += 1
+        except QueueFullError:
+            update_job(doc["documentId"], {"status": "failed", "error": "File d'extraction pleine lors de la reprise"}, OWNER)
+    if resumed:
+        print(f"[JOB] {resumed} job(s) non terminé(s) remis en file")
+    return resumed
+
+
+def start_job_reaper(runner) -> threading.Thread:
+    """
+    Reprend les jobs abandonnés au démarrage puis toutes les JOB_HEARTBEAT_SECONDS (thread daemon) :
+    un bail expiré est récupéré sans attendre un redémarrage ou un nouvel upload du document.
+    """
+    def loop():
+        while True:
+            try:
+                resume_unfinished_jobs(runner)
+            except Exception as e:
+                print(f"[JOB] Erreur lors de la reprise des jobs : {str(e)}")
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+
+    thread = threading.Thread(target=loop, name="job-reaper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,64 @@
+import json
+
+
+class JSONArrayStreamParser:
+    """
+    Parseur incrémental d'un tableau JSON d'objets reçu morceau par morceau (réponse LLM en streaming).
+    Chaque objet de premier niveau est retourné dès que son accolade fermante est reçue.
+    Le texte avant le "[" (ex. ```json) et après le "]" est ignoré.
+    """
+
+    def __init__(self):
+        self._depth = 0          # profondeur d'imbrication ({ et [) ; 1 = dans le tableau principal
+        self._in_string = False
+        self._escape = False
+        self._done = False
+        self._current = []       # caractères de l'objet en cours
+        self.count = 0           # nombre d'objets émis
+
+    def feed(self, text: str) -> list:
+        objects = []
+        for char in text:
+            if self._done:
+                break
+            if self._depth >= 2:
+                self._current.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"' and self._depth >= 1:
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 0 and char != "[":
+                    continue  # texte parasite avant le tableau
+                self._depth += 1
+                if self._depth == 2:
+                    self._current = [char]
+            elif char in "}]":
+                if self._depth == 0:
+                    continue
+                self._depth -= 1
+                if self._depth == 1 and self._current:
+                    obj = self._decode("".join(self._current))
+                    if obj is not None:
+                        objects.append(obj)
+                        self.count += 1
+                    self._current = []
+                elif self._depth == 0:
+                    self._done = True
+        return objects
+
+    @staticmethod
+    def _decode(text: str):
+        try:
+            obj = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return obj if isinstance(obj, dict) else None
@@ -1,35 +1,135 @@
 import os
 import json
+import random
+import time
+import asyncio
+from functools import lru_cache
 from dotenv import load_dotenv
-from openai import OpenAI
+
+try:
+    import tiktoken
+except ImportError:  # comptage approximatif sans tiktoken
+    tiktoken = None
 
 from .utils import clean_json_output
+from .llm_cache import get_llm_cache, cache_key, LLMCacheMiss, LLM_CACHE_MODE
+from .metrics import timed, timer, inc, observe
+from .json_stream import JSONArrayStreamParser
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("⚠️ OPENAI_API_KEY manquant dans .env")
 
-client = OpenAI(api_key=api_key)
+
+def _require_api_key():
+    if not api_key:
+        raise ValueError("⚠️ OPENAI_API_KEY manquant dans .env")
+    return api_key
+
+
+@lru_cache(maxsize=1)
+def get_client():
+    """Client OpenAI créé au premier appel : l'import du module (coûteux) ne se fait pas au démarrage."""
+    from openai import OpenAI
+    return OpenAI(api_key=_require_api_key())
+
+# Extraction par fenêtres pour les documents longs
+LLM_CHUNK_MAX_TOKENS = int(os.getenv("LLM_CHUNK_MAX_TOKENS", "800"))   # tokens PDF par fenêtre
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+ROW_TOLERANCE = 3  # écart vertical max (pt) entre tokens d'une même ligne visuelle
+
+# Sérialisation des tokens dans le prompt : "lines" (un token par ligne) ou "rows" (par ligne visuelle,
+# prompt plus court). "lines" reste le défaut tant que la précision d'extraction de "rows" n'est pas mesurée.
+LLM_PROMPT_FORMAT = os.getenv("LLM_PROMPT_FORMAT", "lines")
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "12000"))
+# Réponse en streaming : chaque ligne comptable est transmise (on_row) dès qu'elle est complète
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() == "true"
+
+SYSTEM_PROMPT = "Tu es un assistant intelligent d’extraction comptable."
+
+
+@lru_cache(maxsize=1)
+def _retryable_errors():
+    """Erreurs transitoires de l'API pour lesquelles on réessaie."""
+    import openai
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
 
 
-def build_prompt(tokens_dict, examples=None):
-    table_str = "\n".join([f"{tid}: {txt}" for tid, txt in tokens_dict.items()])
+def count_prompt_tokens(text, model="gpt-4-0125-preview"):
+    """Nombre de tokens du prompt (tiktoken si disponible, sinon estimation ~3 caractères/token)."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 3 + 1
+    return len(encoding.encode(text))
 
-    examples_str = ""
-    if examples:
+
+@lru_cache(maxsize=8)
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
+
+
+def serialize_tokens(tokens_dict, tokens_data=None, prompt_format=LLM_PROMPT_FORMAT):
+    """
+    "lines" : une ligne "id: texte" par token.
+    "rows"  : une ligne par ligne visuelle, "a-b: t1 | t2 | ..." où les tokens ont les ids
+              consécutifs a..b ; la structure du tableau est conservée et les ids ne sont
+              plus répétés pour chaque token. Un en-tête sépare les pages.
+    """
+    if prompt_format != "rows" or not tokens_data:
+        return "\n".join([f"{tid}: {txt}" for tid, txt in tokens_dict.items()])
+
+    lines = []
+    page = None
+    for row in group_rows(tokens_data):
+        if row[0]["page"] != page:
+            page = row[0]["page"]
+            lines.append(f"--- page {page + 1} ---")
+        first_id, last_id = row[0]["id"], row[-1]["id"]
+        if [token["id"] for token in row] == list(range(first_id, first_id + len(row))):
+            prefix = f"{first_id}-{last_id}" if len(row) > 1 else f"{first_id}"
+            lines.append(f"{prefix}: " + " | ".join(token["text"] for token in row))
+        else:
+            # Ids non consécutifs : on les écrit explicitement
+            lines.append(" | ".join(f"{token['id']}:{token['text']}" for token in row))
+    return "\n".join(lines)
+
+
+def _examples_block(examples, compact=False):
+    if not examples:
+        return ""
+    if compact:
+        formatted = json.dumps(examples, ensure_ascii=False, separators=(",", ":"))
+    else:
         formatted = json.dumps(examples, indent=2, ensure_ascii=False)
-        examples_str = f"""
+    return f"""
 Voici des exemples d’extractions correctes issues de documents similaires :
 {formatted}
 
 Utilise-les comme guide, mais adapte strictement aux tokens actuels.
 """
 
+
+def _render_prompt(table_str, examples_str, rows_format):
+    if rows_format:
+        intro = ("On te donne les tokens extraits d'un document PDF, regroupés par ligne visuelle. "
+                 "Une ligne \"a-b: t1 | t2 | ...\" contient les tokens t1, t2, ... d'ids a, a+1, ..., b "
+                 "(une ligne \"a: t1\" contient un seul token d'id a) :")
+    else:
+        intro = "On te donne une liste de tokens extraits d'un document PDF :"
+
     return f"""
 Tu es un assistant expert en analyse comptable.
 
-On te donne une liste de tokens extraits d'un document PDF :
+{intro}
 {table_str}
 
 {examples_str}
@@ -48,22 +148,304 @@ Ta mission :
 """
 
 
-def process_tokens(tokens_dict, model="gpt-4-0125-preview", examples=None):
-    prompt = build_prompt(tokens_dict, examples=examples)
+def build_prompt(tokens_dict, examples=None, tokens_data=None, model="gpt-4-0125-preview",
+                 prompt_format=LLM_PROMPT_FORMAT, token_budget=LLM_PROMPT_TOKEN_BUDGET):
+    """
+    Construit le prompt d'extraction. Si le prompt dépasse token_budget, les exemples
+    sont d'abord compactés (JSON sans indentation), puis retirés un à un en partant de la fin.
+    """
+    rows_format = prompt_format == "rows" and bool(tokens_data)
+    table_str = serialize_tokens(tokens_dict, tokens_data, prompt_format)
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "Tu es un assistant intelligent d’extraction comptable."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.2
-    )
+    prompt = _render_prompt(table_str, _examples_block(examples), rows_format)
+    if not examples or count_prompt_tokens(prompt, model) <= token_budget:
+        return prompt
+
+    kept = list(examples)
+    while kept:
+        prompt = _render_prompt(table_str, _examples_block(kept, compact=True), rows_format)
+        if count_prompt_tokens(prompt, model) <= token_budget:
+            break
+        kept.pop()
+    else:
+        prompt = _render_prompt(table_str, "", rows_format)
+    print(f"[LLM] Budget de {token_budget} tokens : {len(kept)}/{len(examples)} exemple(s) conservé(s), format compact")
+    return prompt
 
-    content = response.choices[0].message.content.strip()
-    cleaned = clean_json_output(content)
 
+def _parse_content(content):
+    cleaned = clean_json_output(content)
     try:
         return json.loads(cleaned)
     except json.JSONDecodeError:
         return {"error": "Format JSON invalide", "raw": cleaned}
+
+
+def _cache_lookup(model, messages, temperature, use_cache):
+    """
+    Retourne (clé, contenu en cache). La clé est None si le cache est contourné.
+    En mode replay, un miss lève LLMCacheMiss (aucun appel réseau).
+    """
+    if not use_cache or LLM_CACHE_MODE == "off":
+        return None, None
+    key = cache_key(model, messages, temperature)
+    content = get_llm_cache().get(key)
+    if content is not None:
+        inc("llm_cache_hits_total", 1, "Réponses LLM servies par le cache", model=model)
+    elif LLM_CACHE_MODE == "replay":
+        raise LLMCacheMiss(f"Réponse LLM non enregistrée (clé {key})")
+    return key, content
+
+
+def _cache_store(key, model, content):
+    if key is None:
+        return
+    # Seules les réponses JSON valides sont conservées, une réponse invalide sera redemandée
+    try:
+        json.loads(clean_json_output(content))
+    except json.JSONDecodeError:
+        return
+    get_llm_cache().put(key, model, content)
+
+
+def _record_usage(response, model):
+    """Compteurs de tokens facturés par l'API (prompt / completion)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    inc("llm_tokens_total", usage.prompt_tokens or 0, "Tokens consommés par les appels LLM", model=model, kind="prompt")
+    inc("llm_tokens_total", usage.completion_tokens or 0, "Tokens consommés par les appels LLM", model=model, kind="completion")
+
+
+def _emit_rows(content, on_row):
+    """Transmet les lignes d'une réponse complète (cache, ou mode sans streaming)."""
+    if on_row is not None:
+        for row in JSONArrayStreamParser().feed(content):
+            on_row(row)
+
+
+class _RowStream:
+    """Accumule les deltas d'une réponse en streaming et transmet chaque ligne complète à on_row."""
+
+    def __init__(self, model, on_row):
+        self.model = model
+        self.on_row = on_row
+        self.parser = JSONArrayStreamParser()
+        self.parts = []
+        self.start = time.perf_counter()
+
+    def add_chunk(self, chunk):
+        if chunk.usage is not None:
+            _record_usage(chunk, self.model)
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return
+        delta = chunk.choices[0].delta.content
+        self.parts.append(delta)
+        for row in self.parser.feed(delta):
+            if self.parser.count == 1:
+                observe("duration_seconds", time.perf_counter() - self.start, name="llm.first_row")
+            self.on_row(row)
+
+    @property
+    def content(self):
+        return "".join(self.parts).strip()
+
+
+def _stream_kwargs():
+    return {"stream": True, "stream_options": {"include_usage": True}}
+
+
+def complete(messages, model, temperature=0.2, use_cache=True, on_row=None):
+    """
+    Appel chat.completions derrière le cache de réponses ; retourne le contenu texte.
+    Avec on_row, chaque ligne comptable lui est transmise dès qu'elle est reçue (LLM_STREAMING).
+    """
+    key, content = _cache_lookup(model, messages, temperature, use_cache)
+    if content is not None:
+        _emit_rows(content, on_row)
+        return content
+
+    if on_row is not None and LLM_STREAMING:
+        stream = _RowStream(model, on_row)
+        with timer("llm.api_call"):
+            response = get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **_stream_kwargs()
+            )
+        with timer("llm.stream"):
+            for chunk in response:
+                stream.add_chunk(chunk)
+        content = stream.content
+    else:
+        with timer("llm.api_call"):
+            response = get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature
+            )
+        _record_usage(response, model)
+        content = response.choices[0].message.content.strip()
+        _emit_rows(content, on_row)
+
+    _cache_store(key, model, content)
+    return content
+
+
+@timed("llm.process_tokens")
+def process_tokens(tokens_dict, model="gpt-4-0125-preview", examples=None, use_cache=True, tokens_data=None,
+                   on_row=None):
+    prompt = build_prompt(tokens_dict, examples=examples, tokens_data=tokens_data, model=model)
+
+    content = complete(
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        model=model,
+        temperature=0.2,
+        use_cache=use_cache,
+        on_row=on_row
+    )
+    return _parse_content(content)
+
+def group_rows(tokens_data):
+    """
+    Regroupe les tokens (dans l'ordre d'extraction) en lignes visuelles : même page
+    et y0 à moins de ROW_TOLERANCE du premier token de la ligne.
+    """
+    rows = []
+    for token in tokens_data:
+        if rows:
+            first = rows[-1][0]
+            if token["page"] == first["page"] and abs(token["y0"] - first["y0"]) < ROW_TOLERANCE:
+                rows[-1].append(token)
+                continue
+        rows.append([token])
+    return rows
+
+
+def split_token_windows(tokens_data, max_tokens=LLM_CHUNK_MAX_TOKENS):
+    """
+    Découpe les tokens en fenêtres (listes de tokens) d'au plus max_tokens tokens, sans
+    jamais couper une ligne visuelle (une ligne comptable reste dans une seule fenêtre).
+    """
+    windows = []
+    current = []
+    for row in group_rows(tokens_data):
+        if current and len(current) + len(row) > max_tokens:
+            windows.append(current)
+            current = []
+        current.extend(row)
+    if current:
+        windows.append(current)
+    return windows
+
+
+async def _complete_async(async_client, semaphore, messages, model, temperature, use_cache, label, on_row=None):
+    """
+    Version asynchrone de complete(), avec nouvelles tentatives sur les erreurs transitoires.
+    Les nouvelles tentatives ne concernent que l'ouverture de la requête : une réponse en
+    streaming déjà commencée n'est pas rejouée (les lignes transmises ne sont pas dupliquées).
+    """
+    key, content = _cache_lookup(model, messages, temperature, use_cache)
+    if content is not None:
+        _emit_rows(content, on_row)
+        return content
+
+    streaming = on_row is not None and LLM_STREAMING
+    async with semaphore:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                with timer("llm.api_call"):
+                    response = await async_client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        **(_stream_kwargs() if streaming else {})
+                    )
+                break
+            except _retryable_errors() as e:
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                # Backoff exponentiel avec jitter
+                delay = LLM_RETRY_BASE_DELAY * (2 ** attempt) * (1 + random.random())
+                print(f"[LLM] {label} : {type(e).__name__}, nouvel essai dans {delay:.1f}s")
+                inc("llm_retries_total", 1, "Nouvelles tentatives d'appel LLM", model=model)
+                await asyncio.sleep(delay)
+
+        if streaming:
+            stream = _RowStream(model, on_row)
+            with timer("llm.stream"):
+                async for chunk in response:
+                    stream.add_chunk(chunk)
+            content = stream.content
+
+    if not streaming:
+        _record_usage(response, model)
+        content = response.choices[0].message.content.strip()
+        _emit_rows(content, on_row)
+    _cache_store(key, model, content)
+    return content
+
+
+async def _extract_window(async_client, semaphore, window, model, examples, index, use_cache, on_row, on_window):
+    window_dict = {token["id"]: token["text"] for token in window}
+    prompt = build_prompt(window_dict, examples=examples, tokens_data=window, model=model)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    window_on_row = (lambda row: on_row(row, index)) if on_row is not None else None
+    content = await _complete_async(async_client, semaphore, messages, model, 0.2, use_cache, f"Fenêtre {index}",
+                                    on_row=window_on_row)
+    result = _parse_content(content)
+    if on_window is not None:
+        on_window(index, result)
+    return result
+
+
+async def _extract_windows(windows, model, examples, concurrency, use_cache, on_row=None, on_window=None):
+    from openai import AsyncOpenAI
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # Client asynchrone propre à cet appel (lié à la boucle d'événements courante)
+    async with AsyncOpenAI(api_key=_require_api_key()) as async_client:
+        return await asyncio.gather(*[
+            _extract_window(async_client, semaphore, window, model, examples, index, use_cache, on_row, on_window)
+            for index, window in enumerate(windows)
+        ])
+
+
+def extract_token_windows(windows, model="gpt-4-0125-preview", examples=None, concurrency=LLM_MAX_CONCURRENCY,
+                          use_cache=True, on_row=None, on_window=None):
+    """
+    Résultat parsé de chaque fenêtre (liste de lignes, ou dict d'erreur si le JSON est invalide).
+    on_window(index, résultat) est appelé dès qu'une fenêtre est terminée.
+    """
+    print(f"[LLM] Extraction en {len(windows)} fenêtre(s), concurrence {concurrency}, modèle {model}")
+    return asyncio.run(_extract_windows(windows, model, examples, concurrency, use_cache, on_row, on_window))
+
+
+@timed("llm.process_tokens_chunked")
+def process_tokens_chunked(tokens_data, model="gpt-4-0125-preview", examples=None,
+                           max_tokens=LLM_CHUNK_MAX_TOKENS, concurrency=LLM_MAX_CONCURRENCY, use_cache=True,
+                           on_row=None):
+    """
+    Extraction par fenêtres de lignes, exécutées en parallèle (au plus `concurrency`
+    appels simultanés). Les résultats sont concaténés dans l'ordre des fenêtres, donc
+    dans l'ordre des tokens. Même format de retour que process_tokens.
+    on_row(row, window) reçoit les lignes au fil de l'eau, fenêtres entrelacées.
+    """
+    windows = split_token_windows(tokens_data, max_tokens=max_tokens)
+    window_results = extract_token_windows(windows, model, examples, concurrency, use_cache, on_row)
+
+    results = []
+    for index, window_result in enumerate(window_results):
+        if isinstance(window_result, dict) and "error" in window_result:
+            return {"error": window_result["error"], "raw": window_result["raw"], "window": index}
+        if isinstance(window_result, dict):
+            window_result = [window_result]
+        results.extend(window_result)
+    return results
@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import cProfile
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Fraction des requêtes / jobs profilés avec cProfile (0 = désactivé)
+METRICS_PROFILE_SAMPLE_RATE = float(os.getenv("METRICS_PROFILE_SAMPLE_RATE", "0"))
+METRICS_PROFILE_DIR = os.getenv("METRICS_PROFILE_DIR", "profiles")
+METRICS_PREFIX = "extraction"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_lock = threading.Lock()
+_help = {}
+_types = {}
+_counters = {}    # (nom, labels) -> valeur
+_histograms = {}  # (nom, labels) -> [compteurs par bucket, somme, total]
+
+# Un seul cProfile actif à la fois dans le process (Python 3.12+ refuse un second profileur)
+_profile_lock = threading.Lock()
+
+# Durées mesurées pendant la requête HTTP courante (pour l'en-tête Server-Timing)
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _register(name: str, kind: str, help_text: str):
+    _types.setdefault(name, kind)
+    _help.setdefault(name, help_text)
+
+
+def inc(metric: str, value: float = 1, help_text: str = "", **labels):
+    """Incrémente un compteur (ex. pages, tokens, chunks, tokens LLM)."""
+    with _lock:
+        _register(metric, "counter", help_text)
+        key = (metric, _labels_key(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(metric: str, value: float, help_text: str = "", **labels):
+    """Ajoute une observation à un histogramme de latence (secondes)."""
+    with _lock:
+        _register(metric, "histogram", help_text)
+        key = (metric, _labels_key(labels))
+        bucket_counts, total, count = _histograms.get(key) or ([0] * len(LATENCY_BUCKETS), 0.0, 0)
+        index = bisect_left(LATENCY_BUCKETS, value)
+        if index < len(LATENCY_BUCKETS):
+            bucket_counts[index] += 1
+        _histograms[key] = (bucket_counts, total + value, count + 1)
+
+
+@contextmanager
+def timer(name: str):
+    """
+    Mesure la durée d'un bloc : histogramme extraction_duration_seconds{name=...}
+    et, pendant une requête HTTP, entrée de l'en-tête Server-Timing.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("duration_seconds", elapsed, "Durée des étapes du pipeline et des appels de services", name=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def timed(name: str):
+    """Décorateur : mesure chaque appel de la fonction avec timer(name)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request_timings():
+    _request_timings.set([])
+
+
+def request_timings() -> list[tuple[str, float]]:
+    return list(_request_timings.get() or [])
+
+
+def server_timing_header(timings: list[tuple[str, float]]) -> str:
+    """Valeur de l'en-tête Server-Timing (durées en millisecondes)."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: dict | None = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    body = ",".join(f'{key}="{_escape_label(value)}"' for key, value in items)
+    return "{" + body + "}"
+
+
+def render_prometheus() -> str:
+    """Exporte compteurs et histogrammes au format texte Prometheus."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+        types = dict(_types)
+        helps = dict(_help)
+
+    lines = []
+    for name in sorted(types):
+        full_name = f"{METRICS_PREFIX}_{name}"
+        if helps.get(name):
+            lines.append(f"# HELP {full_name} {helps[name]}")
+        lines.append(f"# TYPE {full_name} {types[name]}")
+        if types[name] == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+            continue
+        for (metric, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{full_name}_bucket{_format_labels(labels, {'le': bound})} {cumulative}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels, {'le': '+Inf'})} {count}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def start_profile() -> cProfile.Profile | None:
+    """
+    Démarre cProfile pour une fraction METRICS_PROFILE_SAMPLE_RATE des appels, sinon None.
+    L'échantillon est ignoré si un autre profil est déjà en cours (requête, job ou outil externe).
+    """
+    if METRICS_PROFILE_SAMPLE_RATE <= 0 or random.random() >= METRICS_PROFILE_SAMPLE_RATE:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        inc("profiles_skipped_total", 1, "Profils non démarrés car un autre profileur est actif")
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # "Another profiling tool is already active" (sys.monitoring, Python 3.12+)
+        _profile_lock.release()
+        inc("profiles_skipped_total", 1, "Profils non démarrés car un autre profileur est actif")
+        return None
+    return profiler
+
+
+def stop_profile(profiler: cProfile.Profile | None, label: str):
+    """Arrête le profil et l'enregistre dans METRICS_PROFILE_DIR (lisible avec pstats / snakeviz)."""
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+    Path(METRICS_PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+    safe_label = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)
+    path = Path(METRICS_PROFILE_DIR) / f"{int(time.time() * 1000)}-{safe_label}.prof"
+    profiler.dump_stats(str(path))
+    print(f"[METRICS] Profil enregistré : {path}")
+
+
+@contextmanager
+def maybe_profile(label: str):
+    """Profile le bloc pour une fraction des appels (cf. start_profile)."""
+    profiler = start_profile()
+    try:
+        yield
+    finally:
+        stop_profile(profiler, label)
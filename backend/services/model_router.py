@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+from .llm_service import process_tokens, process_tokens_chunked, extract_token_windows, split_token_windows, LLM_CHUNK_MAX_TOKENS
+from .extraction_validator import validate_row, validate_totals, row_token_ids
+from .metrics import timed, inc, observe
+
+load_dotenv()
+
+# Routage par niveau de modèle : le modèle rapide extrait tout le document, chaque ligne est
+# vérifiée (cf. extraction_validator) et seules les pages en échec repassent par le grand modèle.
+# Les totaux débit / crédit sont ensuite comparés à la ligne de total du document, si elle existe :
+# un écart fait ré-extraire tout le document par le grand modèle.
+LLM_ROUTING = os.getenv("LLM_ROUTING", "true").lower() == "true"
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4o-mini")
+LLM_STRONG_MODEL = os.getenv("LLM_STRONG_MODEL", "gpt-4-0125-preview")
+
+
+def _windows(tokens_data):
+    if len(tokens_data) > LLM_CHUNK_MAX_TOKENS:
+        return split_token_windows(tokens_data)
+    return [tokens_data]
+
+
+class _PageTracker:
+    """
+    Lignes d'un niveau de modèle rangées par page au fil du streaming (page du token compte, sinon
+    de la ligne précédente de la fenêtre). Une page est close quand chacune de ses fenêtres est terminée
+    ou a produit une ligne d'une page suivante : elle est alors envoyée à on_row, sauf si une de ses
+    lignes échoue à validate_row et que hold_failing est vrai (page retenue pour le grand modèle).
+    Une page envoyée est définitive.
+    """
+
+    def __init__(self, windows, tokens_dict, page_of, window_of, on_row, hold_failing=True):
+        self.tokens_dict = tokens_dict
+        self.page_of = page_of
+        self.window_of = window_of
+        self.on_row = on_row
+        self.hold_failing = hold_failing
+        self.window_pages = [sorted({token["page"] for token in window}) for window in windows]
+        self.windows_of_page = {}
+        for index, pages in enumerate(self.window_pages):
+            for page in pages:
+                self.windows_of_page.setdefault(page, []).append(index)
+        self.current = [pages[0] if pages else 0 for pages in self.window_pages]
+        self.finished = set()
+        self.rows = {}        # (fenêtre, page) -> lignes
+        self.failing = set()  # (fenêtre, page) : ligne invalide ou JSON invalide
+        self.emitted = {}     # page -> lignes envoyées
+        self.invalid_json = 0
+        self._lock = threading.Lock()
+
+    def _page(self, row, window):
+        ids = row_token_ids(row, self.tokens_dict)
+        return self.page_of[ids[0]] if ids else self.current[window]
+
+    def _send(self, row, window):
+        ids = row_token_ids(row, self.tokens_dict)
+        self.on_row(row, self.window_of.get(ids[0], window) if ids else window)
+
+    def add(self, row, window):
+        """Ligne reçue en streaming (on_row des appels LLM)."""
+        with self._lock:
+            page = self._page(row, window)
+            self.current[window] = max(self.current[window], page)
+            if page in self.emitted:
+                # Ligne tardive (sortie du modèle hors de l'ordre des pages) : la page n'est plus ré-extraite
+                self.emitted[page].append(row)
+                self._send(row, window)
+                return
+            self.rows.setdefault((window, page), []).append(row)
+            if validate_row(row, self.tokens_dict):
+                self.failing.add((window, page))
+            self._flush()
+
+    def window_done(self, window, result):
+        """Fenêtre terminée : son résultat parsé fait foi pour les pages pas encore envoyées."""
+        with self._lock:
+            if window in self.finished:
+                return
+            self.finished.add(window)
+            pages = [page for page in self.window_pages[window] if page not in self.emitted]
+            for page in pages:
+                self.rows.pop((window, page), None)
+                self.failing.discard((window, page))
+            if isinstance(result, dict) and "error" in result:
+                self.invalid_json += 1
+                self.failing |= {(window, page) for page in pages}
+            else:
+                self.current[window] = self.window_pages[window][0] if self.window_pages[window] else 0
+                for row in [result] if isinstance(result, dict) else result:
+                    page = self._page(row, window)
+                    self.current[window] = page
+                    if page in self.emitted:
+                        continue  # déjà reçue en streaming et envoyée
+                    self.rows.setdefault((window, page), []).append(row)
+                    if validate_row(row, self.tokens_dict):
+                        self.failing.add((window, page))
+            self._flush()
+
+    def _flush(self):
+        if self.on_row is None:
+            return
+        for page, windows in sorted(self.windows_of_page.items()):
+            if page in self.emitted:
+                continue
+            if not all(window in self.finished or self.current[window] > page for window in windows):
+                continue
+            if self.hold_failing and any((window, page) in self.failing for window in windows):
+                continue
+            self.emitted[page] = []
+            for window in windows:
+                for row in self.rows.get((window, page), []):
+                    self.emitted[page].append(row)
+                    self._send(row, window)
+
+    def result(self, tier):
+        """(lignes par page, pages en échec non envoyées) une fois toutes les fenêtres terminées."""
+        rows_by_page = {}
+        for page, windows in self.windows_of_page.items():
+            rows = self.emitted.get(page)
+            if rows is None:
+                rows = [row for window in windows for row in self.rows.get((window, page), [])]
+            if rows:
+                rows_by_page[page] = rows
+        failing = {page for _, page in self.failing if page not in self.emitted}
+        invalid = sum(1 for rows in rows_by_page.values() for row in rows if validate_row(row, self.tokens_dict))
+        valid = sum(len(rows) for rows in rows_by_page.values()) - invalid
+        inc("llm_invalid_json_total", self.invalid_json, "Réponses LLM au JSON invalide", tier=tier)
+        inc("llm_rows_total", valid, "Lignes extraites par niveau de modèle", tier=tier, result="valid")
+        inc("llm_rows_total", invalid, "Lignes extraites par niveau de modèle", tier=tier, result="invalid")
+        return rows_by_page, failing
+
+
+def _run_tier(tier, model, windows, examples, tracker):
+    """Extraction des fenêtres par un modèle ; chaque ligne et chaque fenêtre terminée passent par tracker."""
+    start = time.perf_counter()
+    streaming = tracker.on_row is not None  # sans destinataire, appels sans streaming
+    if len(windows) == 1:
+        window_dict = {token["id"]: token["text"] for token in windows[0]}
+        results = [process_tokens(window_dict, model=model, examples=examples, tokens_data=windows[0],
+                                  on_row=(lambda row: tracker.add(row, 0)) if streaming else None)]
+    else:
+        results = extract_token_windows(windows, model, examples, on_row=tracker.add if streaming else None,
+                                        on_window=tracker.window_done)
+    for index, result in enumerate(results):
+        tracker.window_done(index, result)  # sans effet pour une fenêtre déjà signalée
+    observe("duration_seconds", time.perf_counter() - start, name=f"llm.tier.{tier}")
+    inc("llm_tier_calls_total", len(windows), "Appels LLM par niveau de modèle", tier=tier, model=model)
+    inc("llm_pages_total", len({token["page"] for window in windows for token in window}),
+        "Pages extraites par niveau de modèle", tier=tier)
+    return results
+
+
+def _in_page_order(rows_by_page):
+    return [row for page in sorted(rows_by_page) for row in rows_by_page[page]]
+
+
+def _run_strong(tokens_data, tokens_dict, page_of, window_of, examples, on_row):
+    """Ré-extraction par le grand modèle ; ses lignes sont définitives et envoyées page par page."""
+    windows = _windows(tokens_data)
+    tracker = _PageTracker(windows, tokens_dict, page_of, window_of, on_row, hold_failing=False)
+    results = _run_tier("strong", LLM_STRONG_MODEL, windows, examples, tracker)
+    for index, result in enumerate(results):
+        if isinstance(result, dict) and "error" in result:
+            return {"error": result["error"], "raw": result["raw"], "window": index}
+    rows_by_page, _ = tracker.result("strong")
+    return rows_by_page
+
+
+def _check_totals(rows, tokens_data, tokens_dict, tier):
+    errors = validate_totals(rows, tokens_data, tokens_dict)
+    result = "absent" if errors is None else ("mismatch" if errors else "ok")
+    inc("llm_totals_checks_total", 1, "Contrôles des totaux débit / crédit du document", tier=tier, result=result)
+    return errors
+
+
+@timed("llm.extract_rows")
+def extract_rows(tokens_dict, tokens_data, examples=None, on_row=None, on_reset=None):
+    """
+    Extraction des lignes comptables avec routage : modèle rapide, validation déterministe,
+    puis grand modèle pour les seules pages en échec. Même format de retour que process_tokens.
+    on_row(row, window) reçoit les lignes d'une page dès que ses fenêtres l'ont terminée et qu'elle est
+    validée ; une page en échec n'est envoyée qu'une fois ré-extraite (jamais les deux versions).
+    Si les totaux du document sont incohérents, tout est ré-extrait : on_reset() signale alors que les
+    lignes déjà envoyées sont retirées.
+    """
+    if not LLM_ROUTING or LLM_FAST_MODEL == LLM_STRONG_MODEL or not tokens_data:
+        # Un seul niveau : comportement historique
+        if len(tokens_data) > LLM_CHUNK_MAX_TOKENS:
+            return process_tokens_chunked(tokens_data, model=LLM_STRONG_MODEL, examples=examples, on_row=on_row)
+        return process_tokens(tokens_dict, model=LLM_STRONG_MODEL, examples=examples, tokens_data=tokens_data,
+                              on_row=on_row)
+
+    windows = _windows(tokens_data)
+    page_of = {token["id"]: token["page"] for token in tokens_data}
+    window_of = {token["id"]: index for index, window in enumerate(windows) for token in window}
+
+    tracker = _PageTracker(windows, tokens_dict, page_of, window_of, on_row)
+    _run_tier("fast", LLM_FAST_MODEL, windows, examples, tracker)
+    rows_by_page, failing_pages = tracker.result("fast")
+    page_count = len(set(page_of.values()))
+    if failing_pages:
+        print(f"[LLM] {len(failing_pages)}/{page_count} page(s) en échec avec {LLM_FAST_MODEL}, "
+              f"nouvelle extraction par {LLM_STRONG_MODEL}")
+        strong_rows = _run_strong([token for token in tokens_data if token["page"] in failing_pages],
+                                  tokens_dict, page_of, window_of, examples, on_row)
+        if "error" in strong_rows:
+            return strong_rows
+        for page in failing_pages:
+            rows_by_page[page] = strong_rows.get(page, [])
+
+    rows = _in_page_order(rows_by_page)
+    if not _check_totals(rows, tokens_data, tokens_dict, "routed") or len(failing_pages) == page_count:
+        inc("llm_documents_total", 1, "Documents extraits avec routage de modèles",
+            escalated="true" if failing_pages else "false")
+        return rows
+
+    # Totaux incohérents : l'erreur ne se localise pas sur une page, tout le document repasse par le grand modèle
+    inc("llm_documents_total", 1, "Documents extraits avec routage de modèles", escalated="document")
+    print(f"[LLM] Totaux débit / crédit incohérents, nouvelle extraction du document par {LLM_STRONG_MODEL}")
+    if on_reset is not None:
+        on_reset()
+    strong_rows = _run_strong(tokens_data, tokens_dict, page_of, window_of, examples, on_row)
+    if "error" in strong_rows:
+        return strong_rows
+    rows = _in_page_order(strong_rows)
+    _check_totals(rows, tokens_data, tokens_dict, "strong")
+    return rows
@@ -1,104 +1,133 @@
-import re
 import pdfplumber
-import json
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-def extract_pdf_words_boxes(pdf_path, max_gap=10):
-    data = []
-    uid_counter = 1  # Compteur global pour attribuer un id unique
+from .tokenizer import merge_number_tokens
+from .metrics import timed, inc
+
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+# En dessous de ce nombre de pages, le parsing reste dans le process courant
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "8"))
+
+_pool = None
+_pool_lock = threading.Lock()
 
+
+def _merge_page_words(words, page_num, max_gap=10):
+    """
+    Fusionne les mots d'une page formant un même nombre (ex. "1" "234,56" → "1 234,56").
+    Les ids sont attribués plus tard, à partir de l'offset global de la page.
+    """
+    return [
+        {"id": None, "text": text, "x0": x0, "y0": y0, "x1": x1, "y1": y1, "page": page_num}
+        for text, x0, y0, x1, y1 in merge_number_tokens(words, max_gap)
+    ]
+
+
+def _clean_page_tables(tables, page_num):
+    page_tables = []
+    for table_index, table in enumerate(tables):
+        cleaned_table = []
+        for row in table:
+            cleaned_row = [cell.strip() if cell else "" for cell in row]
+            cleaned_table.append(cleaned_row)
+        page_tables.append({
+            "page": page_num,
+            "table_index": table_index,
+            "rows": cleaned_table
+        })
+    return page_tables
+
+
+def _parse_pages(pdf_path, page_numbers, max_gap=10, with_words=True, with_tables=True):
+    """
+    Parse une plage de pages : chaque page est ouverte une seule fois et sert
+    à la fois aux mots et aux tableaux. Exécuté dans un process du pool.
+    """
+    results = []
     with pdfplumber.open(pdf_path) as pdf:
-        for page_num, page in enumerate(pdf.pages):
-            words = page.extract_words()
-            merged = []
-            i = 0
-            while i < len(words):
-                word = words[i]
-                text = word["text"]
-
-                # Cas 1: Token faisant partie d'un nombre avec plusieurs groupes de chiffres
-                if re.match(r"^-?\d{1,3}$", text):  # Début potentiel d'un nombre (ex. "1", "14", "444")
-                    number_parts = [text]
-                    start_word = word
-                    j = i + 1
-                    # Continuer à collecter les tokens qui forment un nombre
-                    while j < len(words):
-                        next_word = words[j]
-                        next_text = next_word["text"]
-                        close_enough = int(next_word["x0"]) - int(word["x1"]) < max_gap
-                        same_line = abs(int(next_word["top"]) - int(word["top"])) < 3
-
-                        if not (close_enough and same_line):
-                            break
-
-                        # Ajouter les groupes de 3 chiffres ou la partie décimale
-                        if re.match(r"^\d{3}$", next_text) or re.match(r"^\d{1,3}[,.]\d{1,2}-?$", next_text):
-                            number_parts.append(next_text)
-                            word = next_word  # Mettre à jour le dernier mot utilisé
-                            j += 1
-                        else:
-                            break
-
-                    # Vérifier si les parties collectées forment un nombre valide
-                    full_number = " ".join(number_parts)
-                    if re.match(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$", full_number):
-                        merged.append({
-                            "id": uid_counter,
-                            "text": full_number,
-                            "x0": int(start_word["x0"]),
-                            "y0": int(start_word["top"]),
-                            "x1": int(word["x1"]),
-                            "y1": int(word["bottom"]),
-                            "page": page_num
-                        })
-                        uid_counter += 1
-                        i = j  # Sauter tous les tokens utilisés
-                        continue
-
-                # Cas 2: Token déjà complet (ex. "123,45" ou "123 456,78")
-                if re.match(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$", text):
-                    merged.append({
-                        "id": uid_counter,
-                        "text": text,
-                        "x0": int(word["x0"]),
-                        "y0": int(word["top"]),
-                        "x1": int(word["x1"]),
-                        "y1": int(word["bottom"]),
-                        "page": page_num
-                    })
-                    uid_counter += 1
-                    i += 1
-                    continue
-
-                # Mot normal
-                merged.append({
-                    "id": uid_counter,
-                    "text": text,
-                    "x0": int(word["x0"]),
-                    "y0": int(word["top"]),
-                    "x1": int(word["x1"]),
-                    "y1": int(word["bottom"]),
-                    "page": page_num
-                })
-                uid_counter += 1
-                i += 1
-
-            data.extend(merged)
+        for page_num in page_numbers:
+            page = pdf.pages[page_num]
+            words = _merge_page_words(page.extract_words(), page_num, max_gap) if with_words else []
+            tables = _clean_page_tables(page.extract_tables(), page_num) if with_tables else []
+            page.close()  # libérer le cache de layout de la page
+            results.append((page_num, words, tables))
+    return results
 
-    return data
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS)
+        return _pool
 
 
-def get_tokens_ids(data, tokens_json="tokens.json"):
-    tokens_dict = {}
-    for item in data:
-        token_id = item["id"]
-        tokens_dict[token_id] = item["text"]
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
 
-    # Sauvegarde dans un JSON (si tu veux le garder)
-    with open(tokens_json, "w", encoding="utf-8") as f:
-        json.dump(tokens_dict, f, indent=2, ensure_ascii=False)
 
-    return tokens_dict
+def get_page_count(pdf_path) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+@timed("pdf.parse")
+def parse_pdf(pdf_path, max_gap=10, with_words=True, with_tables=True):
+    """
+    Moteur de parsing unique : une seule passe par page pour les tokens et les tableaux,
+    pages réparties sur un pool de process pour les documents longs.
+    Retourne (tokens, tables) ; les ids des tokens sont attribués dans l'ordre des pages,
+    donc identiques quel que soit le découpage entre workers.
+    """
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF file '{pdf_path}' not found.")
+
+    page_count = get_page_count(pdf_path)
+
+    workers = min(PDF_PARSE_WORKERS, page_count)
+    if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+        pages = _parse_pages(pdf_path, range(page_count), max_gap, with_words, with_tables)
+    else:
+        # Plages contiguës de pages, une par worker
+        batch_size = -(-page_count // workers)
+        batches = [range(start, min(start + batch_size, page_count)) for start in range(0, page_count, batch_size)]
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(_parse_pages, pdf_path, batch, max_gap, with_words, with_tables) for batch in batches]
+            pages = [page for future in futures for page in future.result()]
+        except BrokenProcessPool as e:
+            print(f"[WARN] Pool de parsing indisponible ({str(e)}), parsing séquentiel")
+            _reset_pool()
+            pages = _parse_pages(pdf_path, range(page_count), max_gap, with_words, with_tables)
+
+    data = []
+    all_tables = []
+    uid_counter = 1  # Compteur global pour attribuer un id unique
+    for _, words, tables in sorted(pages, key=lambda page: page[0]):
+        for token in words:
+            token["id"] = uid_counter
+            uid_counter += 1
+        data.extend(words)
+        all_tables.extend(tables)
+
+    inc("pdf_pages_total", page_count, "Pages PDF parsées")
+    inc("pdf_tokens_total", len(data), "Tokens extraits des PDF")
+    return data, all_tables
+
+
+def extract_pdf_words_boxes(pdf_path, max_gap=10):
+    data, _ = parse_pdf(pdf_path, max_gap=max_gap, with_tables=False)
+    return data
+
+
+def get_tokens_ids(data):
+    """Dictionnaire id -> texte des tokens (les tokens sont déjà conservés par token_store)."""
+    return {item["id"]: item["text"] for item in data}
 
 ###fonctions pour le RAG
 
@@ -107,23 +136,7 @@ def extract_pdf_tables(pdf_path: str) -> list[dict]:
     Extract tables from a PDF file.
     Returns a list of dictionaries, each containing page number, table index, and rows.
     """
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"PDF file '{pdf_path}' not found.")
-    
-    all_tables = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for page_num, page in enumerate(pdf.pages):
-            tables = page.extract_tables()
-            for table_index, table in enumerate(tables):
-                cleaned_table = []
-                for row in table:
-                    cleaned_row = [cell.strip() if cell else "" for cell in row]
-                    cleaned_table.append(cleaned_row)
-                all_tables.append({
-                    "page": page_num,
-                    "table_index": table_index,
-                    "rows": cleaned_table
-                })
+    _, all_tables = parse_pdf(pdf_path, with_words=False)
     return all_tables
 
 def normalize_table_rows(rows: list[list[str]]) -> list[list[str]]:
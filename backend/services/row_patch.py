@@ -0,0 +1,56 @@
+import json
+from difflib import SequenceMatcher
+
+# Patchs ligne à ligne au format JSON-patch (RFC 6902 restreint) sur une liste de lignes :
+#   {"op": "add",     "path": "/i", "value": row}
+#   {"op": "remove",  "path": "/i"}
+#   {"op": "replace", "path": "/i", "value": row}
+#   {"op": "replace", "path": "",   "value": data}   (document entier, si ce n'est pas une liste)
+
+
+def _row_key(row) -> str:
+    return json.dumps(row, sort_keys=True, ensure_ascii=False)
+
+
+def diff_rows(old, new) -> list[dict]:
+    """
+    Patch qui transforme old en new. Les opérations sont émises de la fin vers le début
+    de la liste : chaque index reste valide par rapport à old lors de l'application.
+    """
+    if not isinstance(old, list) or not isinstance(new, list):
+        return [] if old == new else [{"op": "replace", "path": "", "value": new}]
+
+    matcher = SequenceMatcher(None, [_row_key(r) for r in old], [_row_key(r) for r in new], autojunk=False)
+    patch = []
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+        common = min(i2 - i1, j2 - j1)
+        # Lignes en trop dans old (supprimées en partant de la fin)
+        for i in range(i2 - 1, i1 + common - 1, -1):
+            patch.append({"op": "remove", "path": f"/{i}"})
+        # Lignes en plus dans new (insérées en partant de la fin)
+        for k in range(j2 - 1, j1 + common - 1, -1):
+            patch.append({"op": "add", "path": f"/{i1 + common}", "value": new[k]})
+        for k in range(common - 1, -1, -1):
+            patch.append({"op": "replace", "path": f"/{i1 + k}", "value": new[j1 + k]})
+    return patch
+
+
+def apply_patch(data, patch: list[dict]):
+    """Applique un patch produit par diff_rows (retourne une nouvelle liste)."""
+    result = list(data) if isinstance(data, list) else data
+    for op in patch:
+        if op["path"] == "":
+            result = op["value"]
+            continue
+        index = int(op["path"][1:])
+        if op["op"] == "add":
+            result.insert(index, op["value"])
+        elif op["op"] == "remove":
+            del result[index]
+        elif op["op"] == "replace":
+            result[index] = op["value"]
+        else:
+            raise ValueError(f"Opération de patch inconnue : {op['op']}")
+    return result
@@ -1,18 +1,38 @@
 import numpy as np
-from pymongo import MongoClient
 from dotenv import load_dotenv
 import os
-from services.db_service import get_extraction_by_id
+import threading
+import time
+from datetime import timedelta
+from bson import ObjectId
+from services.db_service import get_examples, embeddings as embeddings_collection
+from services.vector_index import SimilarityIndex, save_snapshot, load_snapshot
+from services.vector_codec import decode_embedding, EMBEDDING_FIELDS
+from services.metrics import timed
 
 # Load environment variables
 load_dotenv()
-MONGODB_URI = os.getenv("MONGODB_URI")
-MONGODB_DB = os.getenv("MONGODB_DB", "pdf_extraction")
 
-# Initialize MongoDB client
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
-embeddings_collection = db.embeddings
+# Configuration de l'index de similarité
+SIMILARITY_INDEX_MODE = os.getenv("SIMILARITY_INDEX_MODE", "flat")  # "flat" ou "ivf"
+SIMILARITY_IVF_NLIST = int(os.getenv("SIMILARITY_IVF_NLIST", "256"))
+SIMILARITY_IVF_NPROBE = int(os.getenv("SIMILARITY_IVF_NPROBE", "8"))
+SIMILARITY_IVF_MIN_SIZE = int(os.getenv("SIMILARITY_IVF_MIN_SIZE", "50000"))
+# Intervalle de resynchronisation avec la collection (embeddings écrits par d'autres workers)
+SIMILARITY_INDEX_REFRESH_SECONDS = float(os.getenv("SIMILARITY_INDEX_REFRESH_SECONDS", "60"))
+# Chaque resynchronisation relit aussi les _id un peu plus anciens que le dernier vu : un bulk
+# concurrent peut valider un _id inférieur après coup. Les chunks déjà indexés sont ignorés.
+SIMILARITY_INDEX_REFRESH_OVERLAP_SECONDS = float(os.getenv("SIMILARITY_INDEX_REFRESH_OVERLAP_SECONDS", "300"))
+# Instantané local de l'index (fichier mappé en mémoire) : au démarrage, seuls les embeddings
+# plus récents sont relus dans MongoDB. Réécrit quand VECTOR_SNAPSHOT_MIN_NEW chunks ont été ajoutés.
+VECTOR_SNAPSHOT_DIR = os.getenv("VECTOR_SNAPSHOT_DIR", "vector_snapshots")  # "" pour désactiver
+VECTOR_SNAPSHOT_MIN_NEW = int(os.getenv("VECTOR_SNAPSHOT_MIN_NEW", "1000"))
+
+_index = None
+_index_lock = threading.Lock()
+_last_object_id = None
+_last_refresh = 0.0
+_snapshot_size = 0  # chunks couverts par le dernier instantané
 
 def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
     """
@@ -28,42 +48,128 @@ def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
         return 0.0
     return dot_product / (norm_vec1 * norm_vec2)
 
-def get_most_similar_document_ids(query_embeddings: list[list[float]], exclude_doc_id: str | None = None, top_k: int = 3) -> list[str]:
+def _load_embeddings(query: dict):
     """
-    Retrieve the top-k most similar document IDs from the embeddings collection
-    by comparing the query embeddings, excluding the specified document if provided.
+    Charge dans l'index les embeddings correspondant à la requête, groupés par document.
+    Suivi par chunk (document_id, chunk_id) : les chunks déjà indexés (instantané, index_document_embeddings,
+    resynchronisation précédente) sont ignorés, ceux d'un document partiellement chargé sont ajoutés.
     """
-    # Fetch all embeddings from the collection
-    all_docs = list(embeddings_collection.find({}, {"document_id": 1, "embedding": 1, "_id": 0}))
+    global _last_object_id
+    grouped = {}
+    cursor = embeddings_collection.find(query, {"document_id": 1, "chunk_id": 1, **EMBEDDING_FIELDS}).sort("_id", 1)
+    for doc in cursor:
+        if _last_object_id is None or doc["_id"] > _last_object_id:
+            _last_object_id = doc["_id"]
+        if doc.get("embedding") is not None and not _index.has_chunk(doc["document_id"], doc.get("chunk_id", 0)):
+            vectors, chunk_ids = grouped.setdefault(doc["document_id"], ([], []))
+            vectors.append(decode_embedding(doc))
+            chunk_ids.append(doc.get("chunk_id", 0))
+    for document_id, (vectors, chunk_ids) in grouped.items():
+        _index.add(document_id, np.stack(vectors), chunk_ids)
+
+def _refresh_query() -> dict:
+    """Embeddings postérieurs au dernier _id chargé, moins SIMILARITY_INDEX_REFRESH_OVERLAP_SECONDS."""
+    if _last_object_id is None:
+        return {}
+    since = _last_object_id.generation_time - timedelta(seconds=SIMILARITY_INDEX_REFRESH_OVERLAP_SECONDS)
+    return {"_id": {"$gt": ObjectId.from_datetime(since)}}
 
-    # Find top-k most similar documents
-    doc_scores = {}  # Map document_id to max similarity score
-    for query_emb in query_embeddings:
-        for doc in all_docs:
-            doc_id = doc["document_id"]
-            if exclude_doc_id and doc_id == exclude_doc_id:
-                continue
-            embedding = doc.get("embedding")
-            if embedding:
-                score = cosine_similarity(query_emb, embedding)
-                doc_scores[doc_id] = max(doc_scores.get(doc_id, -1), score)
+def _maybe_save_snapshot():
+    """Publie un nouvel instantané si assez de chunks ont été ajoutés depuis le précédent."""
+    global _snapshot_size
+    new_chunks = len(_index) - _snapshot_size
+    if not VECTOR_SNAPSHOT_DIR or new_chunks <= 0 or (_snapshot_size and new_chunks < VECTOR_SNAPSHOT_MIN_NEW):
+        return
+    try:
+        save_snapshot(_index, VECTOR_SNAPSHOT_DIR, str(_last_object_id) if _last_object_id is not None else None)
+        _snapshot_size = len(_index)
+    except OSError as e:
+        print(f"Erreur lors de l'écriture de l'instantané de vecteurs : {str(e)}")
 
-    # Sort documents by max score and get top_k IDs
-    top_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+def _new_index() -> SimilarityIndex:
+    return SimilarityIndex(
+        mode=SIMILARITY_INDEX_MODE,
+        nlist=SIMILARITY_IVF_NLIST,
+        nprobe=SIMILARITY_IVF_NPROBE,
+        ivf_min_size=SIMILARITY_IVF_MIN_SIZE
+    )
+
+def rebuild_vector_snapshot() -> SimilarityIndex:
+    """Recharge tout l'index depuis la collection et publie un nouvel instantané (après migration)."""
+    global _index, _last_refresh, _last_object_id, _snapshot_size
+    with _index_lock:
+        _index = _new_index()
+        _last_object_id = None
+        _snapshot_size = 0
+        _load_embeddings({})
+        _last_refresh = time.monotonic()
+        _maybe_save_snapshot()
+    return _index
+
+def reset_similarity_index():
+    """Oublie l'index du process : il sera rechargé (instantané puis collection) au prochain appel."""
+    global _index, _last_refresh, _last_object_id, _snapshot_size
+    with _index_lock:
+        _index = None
+        _last_object_id = None
+        _last_refresh = 0.0
+        _snapshot_size = 0
+
+def get_similarity_index() -> SimilarityIndex:
+    """
+    Retourne l'index de similarité du process, chargé une seule fois depuis la collection
+    puis resynchronisé de façon incrémentale (nouveaux _id, chunks pas encore indexés).
+    """
+    global _index, _last_refresh, _last_object_id, _snapshot_size
+    with _index_lock:
+        if _index is None:
+            start = time.perf_counter()
+            _index = _new_index()
+            last_snapshot_id = load_snapshot(VECTOR_SNAPSHOT_DIR, _index) if VECTOR_SNAPSHOT_DIR else None
+            if last_snapshot_id is not None:
+                _last_object_id = ObjectId(last_snapshot_id)
+                _snapshot_size = len(_index)
+            _load_embeddings(_refresh_query())
+            _last_refresh = time.monotonic()
+            print(f"Index de similarité chargé : {len(_index)} chunks ({_snapshot_size} depuis l'instantané), "
+                  f"{_index.document_count} documents en {time.perf_counter() - start:.2f}s")
+            _maybe_save_snapshot()
+        elif time.monotonic() - _last_refresh > SIMILARITY_INDEX_REFRESH_SECONDS:
+            _load_embeddings(_refresh_query())
+            _last_refresh = time.monotonic()
+            _maybe_save_snapshot()
+    return _index
+
+def index_document_embeddings(document_id: str, embedding_vectors: list[list[float]]):
+    """Ajoute à l'index les embeddings qui viennent d'être stockés par store_embeddings (chunk_id à partir de 1)."""
+    get_similarity_index().add(document_id, embedding_vectors, range(1, len(embedding_vectors) + 1))
+
+@timed("similarity.search")
+def get_most_similar_document_ids(query_embeddings: list[list[float]], exclude_doc_id: str | None = None, top_k: int = 3) -> list[str]:
+    """
+    Retrieve the top-k most similar document IDs from the in-memory similarity index
+    by comparing the query embeddings, excluding the specified document if provided.
+    """
+    top_docs = get_similarity_index().search(query_embeddings, exclude_doc_id=exclude_doc_id, top_k=top_k)
     top_doc_ids = [doc_id for doc_id, _ in top_docs]
 
     return top_doc_ids
 
+@timed("similarity.examples")
 def get_similar_examples(doc_ids: list[str], top_k_per_doc: int = 3) -> list[dict]:
     """
     Retrieve the first top_k_per_doc examples from finalData for each similar document ID.
+    Lecture groupée dans le store d'exemples ; les documents corrigés passent en premier,
+    puis l'ordre de similarité est conservé.
     """
+    stored = get_examples(doc_ids)
+    ranked = sorted(
+        (doc_id for doc_id in doc_ids if doc_id in stored),
+        key=lambda doc_id: stored[doc_id].get("source") != "corrected"
+    )
     examples = []
-    for doc_id in doc_ids:
-        extraction = get_extraction_by_id(doc_id)
-        final_data = extraction.get("finalData", []) if extraction else []
-        # Take the first top_k_per_doc objects
-        selected_examples = final_data[:top_k_per_doc]
+    for doc_id in ranked:
+        selected_examples = stored[doc_id]["rows"][:top_k_per_doc]
         examples.extend(selected_examples)
-        print(f"Retrieved {len(selected_examples)} examples from doc_id {doc_id}")
-    return examples
\ No newline at end of file
+        print(f"Retrieved {len(selected_examples)} examples from doc_id {doc_id} ({stored[doc_id].get('source')})")
+    return examples
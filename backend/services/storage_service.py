@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from dotenv import load_dotenv
+
+from .hash_service import sha256_copy
+from .artifact_store import manifest_path, delete_artifacts
+from .metrics import inc
+
+load_dotenv()
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Budget disque des artefacts dérivés (images, tokens) : au-delà, les documents les moins récemment
+# utilisés sont évincés. Les PDF sources ne sont jamais supprimés (ils permettent de tout régénérer).
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", str(2 * 1024 ** 3)))
+STORAGE_MAX_AGE_DAYS = float(os.getenv("STORAGE_MAX_AGE_DAYS", "30"))
+STORAGE_GC_INTERVAL_SECONDS = int(os.getenv("STORAGE_GC_INTERVAL_SECONDS", "3600"))
+# Fichiers temporaires d'upload abandonnés (process tué pendant l'écriture)
+STALE_UPLOAD_SECONDS = 3600
+
+DOCUMENT_PREFIX_RE = re.compile(r"^([0-9a-f]{64})")
+
+
+def _upload_tmp_dir() -> Path:
+    return Path(UPLOAD_DIR) / "tmp"
+
+
+def upload_path(document_id: str) -> Path:
+    """
+    Chemin du PDF d'un document : uploads/<2 premiers caractères>/<hash>.pdf.
+    Les PDF déposés avant le partitionnement (uploads/<hash>.pdf) restent lisibles.
+    """
+    path = Path(UPLOAD_DIR) / document_id[:2] / f"{document_id}.pdf"
+    legacy_path = Path(UPLOAD_DIR) / f"{document_id}.pdf"
+    if not path.exists() and legacy_path.exists():
+        return legacy_path
+    return path
+
+
+def spool_upload(stream, chunk_size: int = UPLOAD_CHUNK_SIZE) -> tuple[str, Path]:
+    """
+    Écrit un upload par blocs dans un fichier temporaire (uploads/tmp) en calculant son SHA-256 au passage.
+    Retourne (documentId, chemin temporaire), à passer ensuite à store_upload ou discard_upload.
+    """
+    tmp_dir = _upload_tmp_dir()
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            document_id, _ = sha256_copy(stream, out, chunk_size)
+    except BaseException:
+        discard_upload(tmp_path)
+        raise
+    return document_id, Path(tmp_path)
+
+
+def store_upload(document_id: str, tmp_path: Path) -> Path:
+    """Renomme atomiquement l'upload dans le stockage adressé par contenu (un contenu déjà stocké n'est pas réécrit)."""
+    path = upload_path(document_id)
+    try:
+        if path.exists():
+            discard_upload(tmp_path)
+        else:
+            size = os.path.getsize(tmp_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+            inc("upload_bytes_total", size, "Octets de PDF stockés")
+    except BaseException:
+        discard_upload(tmp_path)
+        raise
+    return path
+
+
+def discard_upload(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def touch_document(document_id: str):
+    """Marque les artefacts d'un document comme utilisés (date de modification du manifeste)."""
+    try:
+        os.utime(manifest_path(document_id))
+    except FileNotFoundError:
+        pass
+
+
+def _derived_files(data_dir: Path, image_dir: Path) -> dict[str, list[Path]]:
+    """Artefacts dérivés regroupés par documentId : images des pages et dossier de tokens."""
+    groups = {}
+    for directory in (image_dir, data_dir):
+        if not directory.exists():
+            continue
+        for entry in directory.iterdir():
+            match = DOCUMENT_PREFIX_RE.match(entry.name)
+            if match:
+                groups.setdefault(match.group(1), []).append(entry)
+    return groups
+
+
+def _size_and_mtime(path: Path) -> tuple[int, float]:
+    if path.is_dir():
+        size, mtime = 0, path.stat().st_mtime
+        for child in path.rglob("*"):
+            if child.is_file():
+                stat = child.stat()
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+        return size, mtime
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime
+
+
+def _evict(document_id: str, paths: list[Path]):
+    # Manifeste d'abord : get_artifacts ne référence plus des fichiers en cours de suppression
+    delete_artifacts(document_id)
+    for path in paths:
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _remove_stale_uploads():
+    tmp_dir = _upload_tmp_dir()
+    if not tmp_dir.exists():
+        return
+    cutoff = time.time() - STALE_UPLOAD_SECONDS
+    for path in tmp_dir.glob("*.part"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def collect_garbage(data_dir, image_dir, max_bytes: int = STORAGE_MAX_BYTES,
+                    max_age_days: float = STORAGE_MAX_AGE_DAYS, protected=()) -> dict:
+    """
+    Évince les artefacts dérivés (images, tokens, manifeste) des documents inutilisés depuis
+    max_age_days, puis des moins récemment utilisés jusqu'à repasser sous max_bytes.
+    Les documents de `protected` (jobs en cours) sont conservés ; tout reste régénérable depuis le PDF
+    (images rendues par /pages, tokens reconstruits par /tokens).
+    """
+    _remove_stale_uploads()
+    documents = []
+    for document_id, paths in _derived_files(Path(data_dir), Path(image_dir)).items():
+        size, last_used = 0, 0.0
+        for path in paths:
+            try:
+                path_size, mtime = _size_and_mtime(path)
+            except FileNotFoundError:
+                continue
+            size += path_size
+            last_used = max(last_used, mtime)
+        try:
+            last_used = max(last_used, manifest_path(document_id).stat().st_mtime)
+        except FileNotFoundError:
+            pass
+        documents.append((last_used, document_id, size, paths))
+
+    documents.sort()
+    total = sum(size for _, _, size, _ in documents)
+    expire_before = time.time() - max_age_days * 86400
+    evicted, freed = 0, 0
+    for last_used, document_id, size, paths in documents:
+        if total <= max_bytes and last_used >= expire_before:
+            break
+        if document_id in protected:
+            continue
+        _evict(document_id, paths)
+        total -= size
+        freed += size
+        evicted += 1
+
+    if evicted:
+        inc("storage_evicted_documents_total", evicted, "Documents dont les artefacts dérivés ont été évincés")
+        inc("storage_evicted_bytes_total", freed, "Octets d'artefacts dérivés évincés")
+        print(f"[GC] {evicted} document(s) évincé(s), {freed / 1024 ** 2:.1f} Mo libérés")
+    return {"evicted": evicted, "freedBytes": freed, "remainingBytes": total}
+
+
+def start_storage_gc(data_dir, image_dir, protected_ids=lambda: ()) -> threading.Thread:
+    """Lance le ramasse-miettes périodique (thread daemon, toutes les STORAGE_GC_INTERVAL_SECONDS)."""
+    def loop():
+        while True:
+            try:
+                collect_garbage(data_dir, image_dir, protected=set(protected_ids()))
+            except Exception as e:
+                print(f"[GC] Erreur lors du nettoyage du stockage : {str(e)}")
+            time.sleep(STORAGE_GC_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=loop, name="storage-gc", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import hashlib
+from collections import Counter
+from dotenv import load_dotenv
+
+from .tokenizer import parse_amount
+from .llm_service import group_rows
+from .db_service import store_template, get_templates
+from .metrics import timed, inc
+
+load_dotenv()
+
+# Gabarits de mise en page appris sur les documents corrigés : un document dont la mise en page
+# correspond est extrait sans appel au LLM (colonnes en x, une ligne comptable par numéro de compte).
+TEMPLATE_ENABLED = os.getenv("TEMPLATE_ENABLED", "true").lower() == "true"
+TEMPLATE_MIN_CONFIDENCE = float(os.getenv("TEMPLATE_MIN_CONFIDENCE", "0.95"))
+# Part des valeurs de finalData qu'un gabarit doit reproduire sur son document d'origine
+TEMPLATE_MIN_ACCURACY = float(os.getenv("TEMPLATE_MIN_ACCURACY", "0.98"))
+ALIGN_TOLERANCE = 6.0        # écart (pt) toléré sur le bord d'alignement d'une colonne
+HEADER_MIN_SIMILARITY = 0.6  # Jaccard minimal entre les en-têtes du gabarit et du document
+MAX_ANCHOR_SHAPES = 4
+
+WORD_RE = re.compile(r"[^\W\d_]{2,}")
+
+
+def text_shape(text: str) -> str:
+    """Forme d'un texte : chiffres -> 9, lettres -> A ("411000" -> "999999")."""
+    return re.sub(r"[^\W\d_]", "A", re.sub(r"\d", "9", text))
+
+
+def _same_value(value, token_text: str, mode: str) -> bool:
+    if mode == "text":
+        return value == token_text
+    amount = parse_amount(token_text)
+    return isinstance(value, (int, float)) and amount is not None and abs(value - amount) < 0.005
+
+
+def _render_value(token_text: str, mode: str):
+    if mode == "text":
+        return token_text
+    return parse_amount(token_text)
+
+
+def _header(rows: list[list[dict]], first_data_row: int) -> list[str]:
+    """Mots (en minuscules) des lignes de la première page situées avant la première ligne comptable."""
+    words = set()
+    for row in rows[:first_data_row]:
+        if row[0]["page"] != 0:
+            break
+        for token in row:
+            words.update(word.lower() for word in WORD_RE.findall(token["text"]))
+    return sorted(words)
+
+
+def _jaccard(a, b) -> float:
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def _learn_field(pairs: list[tuple]) -> dict | None:
+    """Colonne d'un champ : bord d'alignement (gauche/droite), plage en x, forme des valeurs."""
+    modes = ("text", "number")
+    mode = next((m for m in modes if all(_same_value(value, token["text"], m) for value, token in pairs)), None)
+    if mode is None:
+        return None
+    # Montants alignés à droite, libellés / comptes à gauche : le bord le plus stable sert de référence
+    spread_left = max(t["x0"] for _, t in pairs) - min(t["x0"] for _, t in pairs)
+    spread_right = max(t["x1"] for _, t in pairs) - min(t["x1"] for _, t in pairs)
+    edge = "x1" if spread_right < spread_left else "x0"
+    return {
+        "mode": mode,
+        "edge": edge,
+        "lo": min(t[edge] for _, t in pairs) - ALIGN_TOLERANCE,
+        "hi": max(t[edge] for _, t in pairs) + ALIGN_TOLERANCE,
+        "numeric": all(parse_amount(t["text"]) is not None for _, t in pairs),
+        "shapes": sorted({text_shape(t["text"]) for _, t in pairs})
+    }
+
+
+def _field_for(template: dict, token: dict) -> str | None:
+    """Champ dont la colonne contient le bord d'alignement du token (le plus proche si plusieurs)."""
+    best, best_distance = None, None
+    for name, column in template["columns"].items():
+        position = token[column["edge"]]
+        if column["lo"] <= position <= column["hi"]:
+            distance = abs(position - (column["lo"] + column["hi"]) / 2)
+            if best is None or distance < best_distance:
+                best, best_distance = name, distance
+    return best
+
+
+def apply_template(template: dict, tokens_data: list[dict]) -> tuple[list[dict], float]:
+    """
+    Extraction déterministe [valeur, id] selon le gabarit. Retourne (lignes, confiance) :
+    la confiance baisse avec les montants non attribués, les conflits de colonne et un en-tête différent.
+    """
+    anchor_field = template["anchorField"]
+    anchor = template["columns"][anchor_field]
+    rows, assigned, errors = [], 0, 0
+    first_data_row = None
+    visual_rows = group_rows(tokens_data)
+    for row_index, row in enumerate(visual_rows):
+        anchors = [t for t in row if text_shape(t["text"]) in anchor["shapes"] and _field_for(template, t) == anchor_field]
+        if not anchors:
+            continue  # titre, en-tête, total : pas une ligne comptable
+        if first_data_row is None:
+            first_data_row = row_index
+        if len(anchors) > 1:
+            errors += 1
+        values = {anchor_field: anchors[0]}
+        for token in row:
+            if token is anchors[0]:
+                continue
+            field = _field_for(template, token)
+            if field is None or field == anchor_field:
+                # Un montant hors colonne : mise en page différente ; un libellé est ignoré
+                errors += parse_amount(token["text"]) is not None
+                continue
+            if field in values or (template["columns"][field]["numeric"] and parse_amount(token["text"]) is None):
+                errors += 1
+                continue
+            values[field] = token
+        assigned += len(values)
+
+        extracted = {}
+        for field in template["fieldOrder"]:
+            token = values.get(field)
+            if token is None:
+                extracted[field] = list(template["defaults"].get(field, [None, None]))
+            else:
+                token_id = int(token["id"]) if template["idType"] == "int" else str(token["id"])
+                extracted[field] = [_render_value(token["text"], template["columns"][field]["mode"]), token_id]
+        rows.append(extracted)
+
+    if not rows:
+        return [], 0.0
+    header_similarity = _jaccard(template["header"], _header(visual_rows, first_data_row))
+    if header_similarity < HEADER_MIN_SIMILARITY:
+        return rows, 0.0
+    return rows, header_similarity * (1 - errors / (assigned + errors))
+
+
+def _accuracy(rows: list[dict], final_data: list[dict]) -> float:
+    if len(rows) != len(final_data):
+        return 0.0
+    total = matches = 0
+    for extracted, expected in zip(rows, final_data):
+        for field, pair in expected.items():
+            total += 1
+            matches += extracted.get(field) == list(pair)
+    return matches / total if total else 0.0
+
+
+def learn_template(final_data: list[dict], tokens_data: list[dict]) -> dict | None:
+    """
+    Apprend un gabarit à partir d'un finalData corrigé et des bboxes de ses tokens.
+    Retourne None si la mise en page n'est pas régulière (colonnes ambiguës, valeurs non
+    reproductibles, pas de champ d'ancrage) ou si le gabarit ne reproduit pas finalData.
+    """
+    if not final_data or not all(isinstance(row, dict) for row in final_data):
+        return None
+    tokens = {str(t["id"]): t for t in tokens_data}
+    field_order = list(final_data[0].keys())
+
+    pairs, defaults, id_types = {field: [] for field in field_order}, {}, set()
+    for row in final_data:
+        for field in field_order:
+            value, token_id = (list(row.get(field) or [None, None]) + [None, None])[:2]
+            if token_id is None:
+                defaults.setdefault(field, Counter())[json.dumps(value)] += 1
+                continue
+            token = tokens.get(str(token_id))
+            if token is None:
+                return None
+            id_types.add(type(token_id).__name__)
+            pairs[field].append((value, token))
+    if len(id_types) != 1:
+        return None
+
+    columns = {}
+    for field, field_pairs in pairs.items():
+        if field_pairs:
+            column = _learn_field(field_pairs)
+            if column is None:
+                return None
+            columns[field] = column
+
+    # Champ d'ancrage : présent sur chaque ligne, token distinct par ligne, peu de formes (ex. numéro de compte)
+    anchor_field = next((
+        field for field in field_order
+        if len(pairs[field]) == len(final_data)
+        and len({token["id"] for _, token in pairs[field]}) == len(final_data)
+        and len(columns[field]["shapes"]) <= MAX_ANCHOR_SHAPES
+        and not columns[field]["numeric"]
+    ), None)
+    if anchor_field is None:
+        return None
+
+    template = {
+        "anchorField": anchor_field,
+        "fieldOrder": field_order,
+        "columns": columns,
+        # Valeur la plus fréquente d'un champ vide (0 pour débit/crédit, None ailleurs)
+        "defaults": {field: [json.loads(counts.most_common(1)[0][0]), None] for field, counts in defaults.items()},
+        "idType": "int" if id_types == {"int"} else "str",
+        "header": []
+    }
+    # En-tête : lignes précédant la première ligne comptable du document d'origine
+    visual_rows = group_rows(tokens_data)
+    first_anchor_id = pairs[anchor_field][0][1]["id"]
+    first_data_row = next(i for i, row in enumerate(visual_rows) if any(t["id"] == first_anchor_id for t in row))
+    template["header"] = _header(visual_rows, first_data_row)
+
+    rows, _ = apply_template(template, tokens_data)
+    template["accuracy"] = _accuracy(rows, final_data)
+    if template["accuracy"] < TEMPLATE_MIN_ACCURACY:
+        return None
+    layout = json.dumps([template["header"], field_order, anchor_field,
+                         {f: [c["edge"], round(c["lo"]), c["shapes"]] for f, c in columns.items()}])
+    template["templateId"] = hashlib.sha256(layout.encode("utf-8")).hexdigest()
+    return template
+
+
+def learn_document_template(document_id: str, final_data: list[dict], tokens_data: list[dict]) -> dict | None:
+    """Apprend et enregistre le gabarit d'un document corrigé (rien si la mise en page est irrégulière)."""
+    template = learn_template(final_data, tokens_data)
+    if template is None:
+        inc("templates_learned_total", 1, "Gabarits de mise en page appris", result="rejected")
+        return None
+    store_template(template, document_id)
+    inc("templates_learned_total", 1, "Gabarits de mise en page appris", result="stored")
+    return template
+
+
+@timed("template.match")
+def extract_with_templates(document_ids: list[str], tokens_data: list[dict]):
+    """
+    Essaie les gabarits appris sur les documents similaires ; retourne (lignes, templateId, confiance)
+    pour le meilleur gabarit au-dessus de TEMPLATE_MIN_CONFIDENCE, sinon None (extraction par le LLM).
+    """
+    if not TEMPLATE_ENABLED or not document_ids or not tokens_data:
+        return None
+    best = None
+    for template in get_templates(document_ids):
+        rows, confidence = apply_template(template, tokens_data)
+        if rows and (best is None or confidence > best[2]):
+            best = (rows, template["templateId"], confidence)
+    if best is None or best[2] < TEMPLATE_MIN_CONFIDENCE:
+        inc("template_matches_total", 1, "Documents extraits par gabarit ou renvoyés au LLM", result="miss")
+        return None
+    inc("template_matches_total", 1, "Documents extraits par gabarit ou renvoyés au LLM", result="hit")
+    return best
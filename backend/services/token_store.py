@@ -0,0 +1,72 @@
+import json
+import gzip
+from pathlib import Path
+
+from . import artifact_writer
+
+# Format colonnaire des tokens : un fichier gzip par page, une liste par champ
+TOKEN_FORMAT_VERSION = 1
+TOKEN_FIELDS = ["id", "text", "x0", "y0", "x1", "y1"]
+
+
+def _page_file(tokens_dir: Path, page: int) -> Path:
+    return tokens_dir / f"page-{page:04d}.json.gz"
+
+
+def to_page_columns(tokens_data: list[dict], page_count: int) -> list[dict]:
+    """Regroupe les tokens par page en colonnes parallèles (id, text, x0, y0, x1, y1)."""
+    pages = [{"page": page, **{field: [] for field in TOKEN_FIELDS}} for page in range(page_count)]
+    for token in tokens_data:
+        columns = pages[token["page"]]
+        for field in TOKEN_FIELDS:
+            columns[field].append(token[field])
+    return pages
+
+
+def save_token_pages(tokens_data: list[dict], tokens_dir: Path, page_count: int) -> Path:
+    """
+    Écrit les tokens au format colonnaire : index.json (nombre de tokens par page)
+    et page-NNNN.json.gz par page. Le gzip est déterministe (mtime=0) pour des ETag stables.
+    L'écriture est confiée à artifact_writer : les fichiers sont lisibles dès le retour.
+    """
+    pages = to_page_columns(tokens_data, page_count)
+    files = []
+    for columns in pages:
+        payload = json.dumps(columns, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        files.append((_page_file(tokens_dir, columns["page"]), gzip.compress(payload, mtime=0)))
+
+    index = {
+        "version": TOKEN_FORMAT_VERSION,
+        "fields": TOKEN_FIELDS,
+        "pages": [{"page": columns["page"], "count": len(columns["id"])} for columns in pages]
+    }
+    # L'index est écrit en dernier : sa présence signifie que toutes les pages sont complètes
+    files.append((tokens_dir / "index.json", json.dumps(index).encode("utf-8")))
+    artifact_writer.submit(files)
+    return tokens_dir
+
+
+def token_page_path(tokens_dir: Path, page: int) -> Path | None:
+    """Chemin du fichier gzip d'une page, ou None si la page n'existe pas."""
+    path = _page_file(tokens_dir, page)
+    return path if artifact_writer.exists(path) else None
+
+
+def load_token_index(tokens_dir: Path) -> dict:
+    return json.loads(artifact_writer.read_bytes(tokens_dir / "index.json"))
+
+
+def load_token_page(tokens_dir: Path, page: int) -> dict:
+    return json.loads(gzip.decompress(artifact_writer.read_bytes(_page_file(tokens_dir, page))))
+
+
+def load_tokens(tokens_dir: Path) -> list[dict]:
+    """Reconstruit la liste de tokens (dicts id/text/x0/y0/x1/y1/page) depuis le format colonnaire."""
+    tokens_data = []
+    for entry in load_token_index(tokens_dir)["pages"]:
+        columns = load_token_page(tokens_dir, entry["page"])
+        for values in zip(*(columns[field] for field in TOKEN_FIELDS)):
+            token = dict(zip(TOKEN_FIELDS, values))
+            token["page"] = columns["page"]
+            tokens_data.append(token)
+    return tokens_data
@@ -0,0 +1,87 @@
+import re
+import numpy as np
+
+# Motifs précompilés (mêmes expressions que l'ancienne boucle de extract_pdf_words_boxes)
+NUMBER_HEAD_RE = re.compile(r"^-?\d{1,3}$")                    # "1", "14", "-444"
+THOUSANDS_GROUP_RE = re.compile(r"^\d{3}$")                    # "234"
+DECIMAL_PART_RE = re.compile(r"^\d{1,3}[,.]\d{1,2}-?$")        # "567,89", "12.5-"
+FULL_NUMBER_RE = re.compile(r"^-?\d{1,3}( \d{3})*[,.]\d{1,2}-?$")
+
+SAME_LINE_TOLERANCE = 3
+
+
+def parse_amount(text: str):
+    """"1 234,56" -> 1234.56 ; "12.5-" -> -12.5 ; None si le texte n'est pas un montant."""
+    if not FULL_NUMBER_RE.match(text):
+        return None
+    negative = text.startswith("-") or text.endswith("-")
+    value = float(text.strip("-").replace(" ", "").replace(",", "."))
+    return -value if negative else value
+
+# États de l'automate
+SCAN, COLLECT, EMIT_NUMBER, EMIT_WORD = range(4)
+
+
+def _word_columns(words):
+    """Colonnes entières (troncature comme int()) x0, top, x1, bottom des mots d'une page."""
+    coords = np.array([(w["x0"], w["top"], w["x1"], w["bottom"]) for w in words], dtype=np.float64)
+    return coords.astype(np.int64)
+
+
+def merge_number_tokens(words, max_gap=10):
+    """
+    Fusionne les mots d'une page formant un même nombre (ex. "1" "234,56" → "1 234,56").
+    Retourne des tuples compacts (text, x0, y0, x1, y1).
+
+    Automate :
+      SCAN        mot courant ; un début de nombre passe en COLLECT, sinon EMIT_WORD
+      COLLECT     ajoute les groupes de 3 chiffres / parties décimales du mot suivant
+                  tant qu'il est proche et sur la même ligne
+      EMIT_NUMBER émet le nombre fusionné s'il est valide, sinon EMIT_WORD
+      EMIT_WORD   émet le mot courant seul
+    Le test proche/même ligne est calculé pour toutes les paires adjacentes en une fois.
+    """
+    n = len(words)
+    if n == 0:
+        return []
+
+    texts = [w["text"] for w in words]
+    columns = _word_columns(words)
+    x0, top, x1, bottom = (column.tolist() for column in columns.T)
+    # linked[k] : le mot k+1 peut prolonger un nombre qui se termine au mot k
+    linked = ((columns[1:, 0] - columns[:-1, 2]) < max_gap) & \
+             (np.abs(columns[1:, 1] - columns[:-1, 1]) < SAME_LINE_TOLERANCE)
+    linked = linked.tolist()
+
+    merged = []
+    i = 0
+    state = SCAN
+    while i < n:
+        if state == SCAN:
+            last = i
+            state = COLLECT if NUMBER_HEAD_RE.match(texts[i]) else EMIT_WORD
+
+        elif state == COLLECT:
+            j = i + 1
+            while j < n and linked[j - 1] and (THOUSANDS_GROUP_RE.match(texts[j]) or DECIMAL_PART_RE.match(texts[j])):
+                j += 1
+            last = j - 1
+            state = EMIT_NUMBER
+
+        elif state == EMIT_NUMBER:
+            full_number = " ".join(texts[i:last + 1])
+            if FULL_NUMBER_RE.match(full_number):
+                merged.append((full_number, x0[i], top[i], x1[last], bottom[last]))
+                i = last + 1
+                state = SCAN
+            else:
+                state = EMIT_WORD
+
+        else:  # EMIT_WORD
+            # Si une collecte a échoué, l'ancienne boucle gardait la bbox du dernier mot
+            # collecté : conservé tel quel pour une sortie identique.
+            merged.append((texts[i], x0[last], top[last], x1[last], bottom[last]))
+            i += 1
+            state = SCAN
+
+    return merged
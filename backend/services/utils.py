@@ -1,9 +1,15 @@
 # utils.py
+import os
 import re
 import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pdf2image import convert_from_path
-from PIL import Image
+
+from .metrics import timed, inc
+
+# Nombre de pages rendues en parallèle (un process pdftoppm par page)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
 
 def clean_json_output(raw_text: str):
     cleaned = re.sub(r"^```json", "", raw_text)
@@ -20,22 +26,50 @@ def save_json(data, path="outputs/results.json"):
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
 
-def convert_pdf_to_images(pdf_path: Path, out_dir: Path, dpi: int = 200, img_format: str = "jpg") -> list[Path]:
-    pages = convert_from_path(str(pdf_path), dpi=dpi)
-    image_paths = []
+def page_image_path(pdf_path: Path, out_dir: Path, page_number: int, img_format: str = "jpg") -> Path:
+    """Chemin de l'image d'une page (numérotée à partir de 1)."""
+    return out_dir / f"{pdf_path.stem}_page-{page_number:04d}.{img_format}"
+
+@timed("pdf.render_page")
+def render_pdf_page(pdf_path: Path, out_dir: Path, page_number: int, dpi: int = 200, img_format: str = "jpg") -> Path:
+    """
+    Rend une seule page directement sur disque (pdftoppm écrit le fichier, aucune image
+    PIL en mémoire). Une page déjà rendue est réutilisée.
+    """
+    img_path = page_image_path(pdf_path, out_dir, page_number, img_format)
+    if img_path.exists():
+        return img_path
+
+    from pdf2image import convert_from_path  # import différé : accélère le démarrage des workers
+
     out_dir.mkdir(parents=True, exist_ok=True)
-    pil_format = "JPEG" if img_format.lower() in ("jpg", "jpeg") else "PNG"
+    # Rendu dans un dossier temporaire puis renommage atomique (rendus concurrents possibles)
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        rendered = convert_from_path(
+            str(pdf_path), dpi=dpi, first_page=page_number, last_page=page_number,
+            fmt=img_format, output_folder=tmp_dir, output_file="page",
+            single_file=True, paths_only=True
+        )
+        os.replace(rendered[0], img_path)
+    inc("pdf_pages_rendered_total", 1, "Pages PDF rendues en image")
+    return img_path
 
-    for idx, page in enumerate(pages):
-        img_name = f"{pdf_path.stem}_page-{idx+1:04d}.{img_format}"
-        img_path = out_dir / img_name
-        page.save(str(img_path), pil_format)
-        image_paths.append(img_path)
+@timed("pdf.render_document")
+def convert_pdf_to_images(pdf_path: Path, out_dir: Path, dpi: int = 200, img_format: str = "jpg",
+                          page_count: int | None = None, workers: int = RENDER_WORKERS) -> list[Path]:
+    """
+    Rend les pages une par une sur un pool de threads : au plus `workers` pages
+    sont en cours de rendu, la mémoire ne dépend donc pas du nombre de pages.
+    """
+    if page_count is None:
+        from pdf2image import pdfinfo_from_path
 
-        # Afficher la taille de l'image générée
-        with Image.open(img_path) as im:
-            print(f"[TAILLE] Image générée {img_name} : {im.size} (largeur x hauteur)")
+        page_count = pdfinfo_from_path(str(pdf_path))["Pages"]
 
-        print(f"[INFO] {pdf_path.name} - Page {idx+1} convertie -> {img_path.name}")
+    def render(page_number):
+        img_path = render_pdf_page(pdf_path, out_dir, page_number, dpi=dpi, img_format=img_format)
+        print(f"[INFO] {pdf_path.name} - Page {page_number} convertie -> {img_path.name}")
+        return img_path
 
-    return image_paths
\ No newline at end of file
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(render, range(1, page_count + 1)))
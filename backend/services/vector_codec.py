@@ -0,0 +1,57 @@
+import os
+import numpy as np
+from bson.binary import Binary
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Format de stockage des embeddings dans MongoDB :
+#   "int8"    BinData de int8 + facteur d'échelle par vecteur (1 octet par dimension)
+#   "float16" BinData de float16 (2 octets par dimension)
+#   "float32" tableau BSON de doubles (format historique, 8 octets par dimension)
+EMBEDDING_STORAGE_FORMAT = os.getenv("EMBEDDING_STORAGE_FORMAT", "int8")
+VECTOR_FORMATS = ("int8", "float16", "float32")
+# Cache d'embeddings (embedding_cache) : un hit doit rester équivalent au vecteur renvoyé par l'API,
+# pas de quantification int8 (float16 ou float32 seulement)
+CACHE_FORMATS = ("float16", "float32")
+EMBEDDING_CACHE_FORMAT = os.getenv("EMBEDDING_CACHE_FORMAT", "float16")
+
+
+def encode_embedding(vector, storage_format: str = EMBEDDING_STORAGE_FORMAT) -> dict:
+    """
+    Champs à enregistrer pour un vecteur : embedding (+ embedding_format et embedding_scale si binaire).
+    int8 : quantification symétrique, scale = max(|v|) / 127, v ≈ q * scale.
+    """
+    if storage_format not in VECTOR_FORMATS:
+        raise ValueError(f"Format de vecteur inconnu : {storage_format}")
+    if storage_format == "float32":
+        return {"embedding": [float(x) for x in vector]}
+
+    array = np.asarray(vector, dtype=np.float32)
+    if storage_format == "float16":
+        return {"embedding": Binary(array.astype("<f2").tobytes()), "embedding_format": "float16",
+                "embedding_scale": 1.0}
+
+    peak = float(np.abs(array).max()) if array.size else 0.0
+    scale = peak / 127 if peak > 0 else 1.0
+    quantized = np.clip(np.rint(array / scale), -127, 127).astype(np.int8)
+    return {"embedding": Binary(quantized.tobytes()), "embedding_format": "int8", "embedding_scale": scale}
+
+
+def decode_embedding(doc: dict) -> np.ndarray | None:
+    """Vecteur float32 d'un document embeddings / embedding_cache, quel que soit son format de stockage."""
+    embedding = doc.get("embedding")
+    if embedding is None:
+        return None
+    storage_format = doc.get("embedding_format")
+    if storage_format is None:
+        return np.asarray(embedding, dtype=np.float32)  # tableau de doubles (format historique)
+    if storage_format == "float16":
+        return np.frombuffer(embedding, dtype="<f2").astype(np.float32)
+    if storage_format == "int8":
+        return np.frombuffer(embedding, dtype=np.int8).astype(np.float32) * np.float32(doc["embedding_scale"])
+    raise ValueError(f"Format de vecteur inconnu : {storage_format}")
+
+
+# Champs à projeter pour pouvoir décoder un vecteur
+EMBEDDING_FIELDS = {"embedding": 1, "embedding_format": 1, "embedding_scale": 1}
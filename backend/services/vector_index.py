@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import time
+import shutil
+import threading
+from pathlib import Path
+import numpy as np
+
+# Lignes du segment mappé converties en float32 à la fois pendant une recherche (mémoire bornée)
+SEARCH_BLOCK_ROWS = 65536
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normalise chaque ligne (norme L2). Les vecteurs nuls restent nuls (similarité 0)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _chunk_scores(queries: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """Similarité maximale de chaque vecteur avec les requêtes (un produit matriciel par bloc)."""
+    if vectors.dtype == np.float32:
+        return (queries @ vectors.T).max(axis=0)
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+        scores[start:start + len(block)] = (queries @ block.T).max(axis=0)
+    return scores
+
+
+class SimilarityIndex:
+    """
+    In-memory similarity index over chunk embeddings.
+    Stores a pre-normalized float32 matrix and a parallel document code column, so a
+    query is a single matmul followed by a per-document max and an argpartition top-k.
+    In "ivf" mode a k-means coarse quantizer restricts the scan to the nprobe closest lists.
+    The corpus may start from a read-only base segment (memory-mapped float16 snapshot, see
+    load_snapshot) ; vectors added afterwards go to the in-memory float32 segment.
+    Chunks are keyed by (document_id, chunk_id) when given, so a chunk is never added twice.
+    """
+
+    def __init__(self, mode: str = "flat", nlist: int = 256, nprobe: int = 8, ivf_min_size: int = 50000):
+        if mode not in ("flat", "ivf"):
+            raise ValueError(f"Mode d'index inconnu : {mode}")
+        self.mode = mode
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_min_size = ivf_min_size
+
+        self._lock = threading.Lock()
+        self._train_lock = threading.Lock()  # un seul entraînement à la fois
+        self._dim = None
+        self._size = 0
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._codes = np.empty(0, dtype=np.int32)
+        self._chunks = np.empty(0, dtype=np.int32)  # chunk_id de chaque vecteur (0 si inconnu)
+        self._doc_ids: list[str] = []           # code -> document_id
+        self._doc_codes: dict[str, int] = {}    # document_id -> code
+        self._chunk_keys: set[tuple[int, int]] = set()  # (code, chunk_id) déjà indexés
+
+        # Segment de base en lecture seule (instantané mappé, float16 normalisé)
+        self._base_vectors = np.empty((0, 0), dtype=np.float16)
+        self._base_codes = np.empty(0, dtype=np.int32)
+        self._base_chunks = np.empty(0, dtype=np.int32)
+        self._base_lists = np.empty(0, dtype=np.int32)
+
+        # Quantificateur grossier (mode ivf)
+        self._centroids = None
+        self._lists = np.empty(0, dtype=np.int32)
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self._base_codes) + self._size
+
+    @property
+    def document_count(self) -> int:
+        return len(self._doc_ids)
+
+    def has_document(self, document_id: str) -> bool:
+        with self._lock:
+            return document_id in self._doc_codes
+
+    def has_chunk(self, document_id: str, chunk_id: int) -> bool:
+        with self._lock:
+            code = self._doc_codes.get(document_id)
+            return code is not None and (code, int(chunk_id)) in self._chunk_keys
+
+    def attach_base(self, vectors: np.ndarray, codes: np.ndarray, doc_ids: list[str], chunk_ids: np.ndarray):
+        """
+        Utilise des vecteurs normalisés (typiquement un np.memmap float16) comme segment de base,
+        sans copie : les pages sont lues à la demande pendant les recherches. L'index doit être vide.
+        """
+        with self._lock:
+            if len(self._doc_ids) or self._size:
+                raise ValueError("Le segment de base doit être attaché à un index vide")
+            self._dim = vectors.shape[1]
+            self._vectors = np.empty((0, self._dim), dtype=np.float32)
+            self._base_vectors = vectors
+            self._base_codes = np.asarray(codes, dtype=np.int32)
+            self._base_chunks = np.asarray(chunk_ids, dtype=np.int32)
+            self._base_lists = np.zeros(len(codes), dtype=np.int32)
+            self._doc_ids = list(doc_ids)
+            self._doc_codes = {document_id: code for code, document_id in enumerate(self._doc_ids)}
+            self._chunk_keys = {key for key in zip(self._base_codes.tolist(), self._base_chunks.tolist()) if key[1]}
+
+    def export(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, list[str]]:
+        """Vecteurs normalisés (float16), codes document, chunk_ids et documentIds de tout l'index (pour save_snapshot)."""
+        with self._lock:
+            vectors = np.concatenate([np.asarray(self._base_vectors, dtype=np.float16).reshape(-1, self._dim or 0),
+                                      self._vectors[:self._size].astype(np.float16)])
+            codes = np.concatenate([self._base_codes, self._codes[:self._size]])
+            chunks = np.concatenate([self._base_chunks, self._chunks[:self._size]])
+            return vectors, codes, chunks, list(self._doc_ids)
+
+    def add(self, document_id: str, vectors: list[list[float]], chunk_ids: list[int] | None = None):
+        """
+        Ajoute les vecteurs d'un document (normalisés une seule fois, à l'insertion).
+        Avec chunk_ids, les chunks déjà présents dans l'index sont ignorés.
+        """
+        if vectors is None or len(vectors) == 0:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        matrix = _normalize_rows(matrix)
+        chunks = np.zeros(len(matrix), dtype=np.int32) if chunk_ids is None else np.asarray(chunk_ids, dtype=np.int32)
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = matrix.shape[1]
+                self._vectors = np.empty((0, self._dim), dtype=np.float32)
+            elif matrix.shape[1] != self._dim:
+                raise ValueError(f"Dimension {matrix.shape[1]} incompatible avec l'index ({self._dim})")
+
+            code = self._doc_codes.get(document_id)
+            if chunk_ids is not None and code is not None:
+                new = np.array([(code, chunk) not in self._chunk_keys for chunk in chunks.tolist()], dtype=bool)
+                matrix, chunks = matrix[new], chunks[new]
+                if not len(matrix):
+                    return
+            if code is None:
+                code = len(self._doc_ids)
+                self._doc_ids.append(document_id)
+                self._doc_codes[document_id] = code
+            if chunk_ids is not None:
+                self._chunk_keys.update((code, chunk) for chunk in chunks.tolist())
+
+            start, end = self._size, self._size + len(matrix)
+            self._reserve(end)
+            self._vectors[start:end] = matrix
+            self._codes[start:end] = code
+            self._chunks[start:end] = chunks
+            if self._centroids is not None:
+                self._lists[start:end] = self._assign_lists(matrix)
+            self._size = end
+
+    def _reserve(self, capacity: int):
+        # Croissance géométrique : un ajout incrémental reste en O(nombre de nouveaux vecteurs)
+        if capacity <= len(self._vectors):
+            return
+        new_capacity = max(capacity, 2 * len(self._vectors), 1024)
+        vectors = np.empty((new_capacity, self._dim), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        codes = np.empty(new_capacity, dtype=np.int32)
+        codes[:self._size] = self._codes[:self._size]
+        chunks = np.zeros(new_capacity, dtype=np.int32)
+        chunks[:self._size] = self._chunks[:self._size]
+        lists = np.zeros(new_capacity, dtype=np.int32)
+        lists[:self._size] = self._lists[:self._size]
+        self._vectors, self._codes, self._chunks, self._lists = vectors, codes, chunks, lists
+
+    def _assign_lists(self, matrix: np.ndarray) -> np.ndarray:
+        return np.argmax(matrix @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _rows(self, positions: np.ndarray) -> np.ndarray:
+        """Vecteurs float32 aux positions données (segment de base puis segment en mémoire)."""
+        base_size = len(self._base_codes)
+        positions = np.sort(positions)
+        in_base = positions[positions < base_size]
+        return np.concatenate([
+            np.asarray(self._base_vectors[in_base], dtype=np.float32).reshape(-1, self._dim),
+            self._vectors[positions[positions >= base_size] - base_size]
+        ])
+
+    def train(self, iterations: int = 10, sample_size: int = 100000, seed: int = 0):
+        """Entraîne le quantificateur grossier (k-means sphérique) sur un échantillon de l'index."""
+        with self._lock:
+            total = len(self._base_codes) + self._size
+            if total == 0:
+                return
+            rng = np.random.default_rng(seed)
+            sample = self._rows(rng.choice(total, size=min(total, sample_size), replace=False))
+            nlist = min(self.nlist, len(sample))
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                empty = ~np.any(sums, axis=1)
+                sums[empty] = centroids[empty]  # garder les centroïdes sans membres
+                centroids = _normalize_rows(sums)
+            self._centroids = centroids
+            for start in range(0, len(self._base_codes), SEARCH_BLOCK_ROWS):
+                block = np.asarray(self._base_vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+                self._base_lists[start:start + len(block)] = self._assign_lists(block)
+            self._lists[:self._size] = self._assign_lists(self._vectors[:self._size])
+            self._trained_size = total
+
+    def _maybe_train(self):
+        if self.mode != "ivf":
+            return
+        # Décision et entraînement sous _train_lock : deux recherches concurrentes n'entraînent pas deux fois
+        with self._train_lock:
+            with self._lock:
+                total = len(self._base_codes) + self._size
+                trained = self._centroids is not None
+            if total < self.ivf_min_size:
+                return
+            # Ré-entraîner quand le corpus a doublé depuis le dernier entraînement
+            if not trained or total >= 2 * self._trained_size:
+                self.train()
+
+    def search(self, query_vectors: list[list[float]], exclude_doc_id: str | None = None, top_k: int = 3) -> list[tuple[str, float]]:
+        """
+        Retourne les top_k (document_id, score) où score est la similarité cosinus maximale
+        entre un chunk requête et un chunk du document.
+        """
+        if query_vectors is None or len(query_vectors) == 0 or top_k <= 0:
+            return []
+        self._maybe_train()
+
+        with self._lock:
+            n = self._size
+            if n + len(self._base_codes) == 0:
+                return []
+            segments = [(self._base_vectors, self._base_codes, self._base_lists),
+                        (self._vectors[:n], self._codes[:n], self._lists[:n])]
+            centroids = self._centroids
+            doc_ids = list(self._doc_ids)
+            exclude_code = self._doc_codes.get(exclude_doc_id) if exclude_doc_id is not None else None
+
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        queries = _normalize_rows(queries)
+
+        probes = None
+        if self.mode == "ivf" and centroids is not None:
+            probes = np.unique(np.argsort(-(queries @ centroids.T), axis=1)[:, :self.nprobe])
+
+        scores, matched_codes = [], []
+        for vectors, codes, lists in segments:
+            if probes is not None:
+                candidates = np.flatnonzero(np.isin(lists, probes))
+                vectors = vectors[candidates]
+                codes = codes[candidates]
+            if len(codes):
+                scores.append(_chunk_scores(queries, vectors))
+                matched_codes.append(codes)
+        if not scores:
+            return []
+        chunk_scores = np.concatenate(scores)
+        codes = np.concatenate(matched_codes)
+
+        # Max par document
+        doc_scores = np.full(len(doc_ids), -np.inf, dtype=np.float32)
+        np.maximum.at(doc_scores, codes, chunk_scores)
+        if exclude_code is not None:
+            doc_scores[exclude_code] = -np.inf
+
+        valid = np.flatnonzero(np.isfinite(doc_scores))
+        if len(valid) == 0:
+            return []
+        k = min(top_k, len(valid))
+        top = valid[np.argpartition(-doc_scores[valid], k - 1)[:k]]
+        top = top[np.argsort(-doc_scores[top], kind="stable")]
+        return [(doc_ids[code], float(doc_scores[code])) for code in top]
+
+
+# Instantané local de l'index : <dir>/CURRENT désigne le dernier sous-dossier complet
+# (vectors.npy float16 normalisés, codes.npy int32, chunks.npy int32, meta.json), remplacé atomiquement.
+
+SNAPSHOT_NAME_RE = re.compile(r"^(\d+)-\d+$")  # <horodatage ms>-<pid>, instantané complet
+STALE_SNAPSHOT_TMP_SECONDS = 3600
+
+
+def _snapshot_time(name: str) -> int | None:
+    match = SNAPSHOT_NAME_RE.match(name)
+    return int(match.group(1)) if match else None
+
+
+def save_snapshot(index: SimilarityIndex, directory, last_object_id: str | None) -> Path:
+    """
+    Écrit l'index dans un dossier temporaire, le renomme en instantané complet puis le publie (CURRENT).
+    Seuls les instantanés complets plus anciens sont supprimés : ceux qu'un autre process est en train
+    d'écrire (dossiers *.tmp-<pid>) ou de publier ne sont pas touchés.
+    """
+    directory = Path(directory)
+    vectors, codes, chunks, doc_ids = index.export()
+    timestamp = int(time.time() * 1000)
+    name = f"{timestamp}-{os.getpid()}"
+    path = directory / name
+    tmp_path = directory / f"{name}.tmp-{os.getpid()}"
+    tmp_path.mkdir(parents=True)
+    try:
+        np.save(tmp_path / "vectors.npy", vectors)
+        np.save(tmp_path / "codes.npy", codes)
+        np.save(tmp_path / "chunks.npy", chunks)
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"documents": doc_ids, "lastObjectId": last_object_id, "count": len(codes)}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    # Un instantané plus récent publié entre-temps par un autre process reste le courant
+    try:
+        current = _snapshot_time((directory / "CURRENT").read_text(encoding="utf-8").strip())
+    except FileNotFoundError:
+        current = None
+    if current is None or current <= timestamp:
+        pointer = directory / f"CURRENT.{os.getpid()}.tmp"
+        pointer.write_text(name, encoding="utf-8")
+        os.replace(pointer, directory / "CURRENT")
+
+    stale_before = time.time() - STALE_SNAPSHOT_TMP_SECONDS
+    for old in directory.iterdir():
+        if not old.is_dir():
+            continue
+        old_time = _snapshot_time(old.name)
+        # Dossiers temporaires d'un process interrompu, ou instantanés complets plus anciens que celui-ci
+        stale_tmp = old_time is None and ".tmp-" in old.name and old.stat().st_mtime < stale_before
+        if stale_tmp or (old_time is not None and old_time < timestamp):
+            # Un autre process peut encore mapper l'ancien instantané (Windows refuse la suppression)
+            shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+def load_snapshot(directory, index: SimilarityIndex) -> str | None:
+    """
+    Attache le dernier instantané à un index vide (np.load en mmap : aucune copie ni décodage).
+    Retourne le dernier ObjectId couvert (str), ou None s'il n'y a pas d'instantané lisible.
+    """
+    directory = Path(directory)
+    try:
+        path = directory / (directory / "CURRENT").read_text(encoding="utf-8").strip()
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        codes = np.load(path / "codes.npy")
+        # Instantané sans chunks.npy (antérieur au suivi par chunk) : rechargement complet, puis réécriture
+        chunks = np.load(path / "chunks.npy")
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+    if len(codes) == 0 or len(codes) != len(vectors) or len(chunks) != len(codes):
+        return None
+    index.attach_base(vectors, codes, meta["documents"], chunks)
+    return meta.get("lastObjectId")
@@ -0,0 +1,55 @@
+"""Découpage des lignes de tableau (services.chunking_service.split_text)."""
+import random
+import string
+
+import pytest
+
+from services.chunking_service import split_text
+
+WORDS = ["411000", "Clients", "|", "1 234,56", "TVA collectée", "Fournisseurs", "0,00", "Total classe 4"]
+
+
+def _text(rng, unique=False):
+    # unique : mots numérotés et mots longs aléatoires, pour retrouver sans ambiguïté la position d'un chunk
+    parts = []
+    for i in range(rng.randint(0, 120)):
+        if rng.random() < 0.9:
+            parts.append(rng.choice(WORDS) + (str(i) if unique else ""))
+        else:
+            parts.append("".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(150, 450))))
+        parts.append(rng.choice([" ", " ", " | ", "\n", "\n\n", "  "]))
+    return "".join(parts)
+
+
+def _reassemble(text, chunks, chunk_overlap):
+    """Texte reconstruit à partir des chunks : chacun reprend au plus chunk_overlap caractères du précédent."""
+    rebuilt, position = "", 0
+    for chunk in chunks:
+        start = text.find(chunk, max(0, position - chunk_overlap))
+        assert start >= 0, chunk
+        rebuilt += text[max(start, position):start + len(chunk)]
+        position = start + len(chunk)
+    return rebuilt
+
+
+@pytest.mark.parametrize("seed", range(200))
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(200, 50), (40, 10), (25, 0)])
+def test_round_trip(seed, chunk_size, chunk_overlap):
+    # Chunks : sous-chaînes dans l'ordre, de taille bornée, qui recouvrent tout le texte non blanc
+    text = _text(random.Random(seed), unique=True)
+    chunks = split_text(text, chunk_size, chunk_overlap)
+    assert all(chunk and chunk == chunk.strip() and len(chunk) <= chunk_size for chunk in chunks)
+    assert "".join(_reassemble(text, chunks, chunk_overlap).split()) == "".join(text.split())
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_langchain(seed):
+    text_splitters = pytest.importorskip("langchain_text_splitters")
+    text = _text(random.Random(seed))
+    splitter = text_splitters.RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=50)
+    assert split_text(text) == splitter.split_text(text)
+
+
+@pytest.mark.parametrize("text, expected", [("", []), ("   ", []), ("  411000 | Clients ", ["411000 | Clients"])])
+def test_short_text(text, expected):
+    assert split_text(text) == expected
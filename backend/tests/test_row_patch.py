@@ -0,0 +1,57 @@
+"""Patchs de corrections (services.row_patch) : apply_patch(old, diff_rows(old, new)) == new."""
+import random
+
+import pytest
+
+from services.row_patch import apply_patch, diff_rows
+
+
+def _row(rng):
+    return {"compte": str(rng.randint(100, 120)), "libelle": rng.choice(["Clients", "TVA", "Banque"]),
+            "debit": rng.choice(["", "10,00", "1 234,56"]), "credit": rng.choice(["", "5,00"])}
+
+
+def _edit(rng, rows):
+    """Corrections d'un utilisateur : lignes modifiées, ajoutées, supprimées ou déplacées."""
+    rows = [dict(row) for row in rows]
+    for _ in range(rng.randint(0, 6)):
+        action = rng.choice(["replace", "add", "remove", "move"])
+        if action == "add" or not rows:
+            rows.insert(rng.randint(0, len(rows)), _row(rng))
+        elif action == "remove":
+            del rows[rng.randrange(len(rows))]
+        elif action == "replace":
+            rows[rng.randrange(len(rows))]["debit"] = rng.choice(["", "0,01", "99,99"])
+        else:
+            rows.insert(rng.randint(0, len(rows) - 1), rows.pop(rng.randrange(len(rows))))
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_round_trip(seed):
+    rng = random.Random(seed)
+    old = [_row(rng) for _ in range(rng.randint(0, 15))]
+    new = _edit(rng, old)
+    patch = diff_rows(old, new)
+    assert apply_patch(old, patch) == new
+    assert diff_rows(new, new) == []
+
+
+def test_apply_does_not_modify_input():
+    old = [{"compte": "1"}, {"compte": "2"}]
+    apply_patch(old, diff_rows(old, [{"compte": "2"}]))
+    assert old == [{"compte": "1"}, {"compte": "2"}]
+
+
+@pytest.mark.parametrize("old, new", [
+    ({"rows": []}, [{"compte": "1"}]),
+    ([{"compte": "1"}], None),
+    ("texte", "autre"),
+])
+def test_round_trip_non_list(old, new):
+    assert apply_patch(old, diff_rows(old, new)) == new
+
+
+def test_unknown_operation():
+    with pytest.raises(ValueError):
+        apply_patch([], [{"op": "move", "path": "/0"}])
@@ -0,0 +1,54 @@
+"""
+Fusion des nombres (services.tokenizer) comparée à l'ancienne boucle de référence de benchmarks.bench_tokenizer.
+
+    cd backend
+    python -m pytest -q
+"""
+import random
+
+import pytest
+
+from benchmarks.bench_tokenizer import reference_merge, synthetic_page
+from services.tokenizer import merge_number_tokens
+
+
+def _word(text, x0, top, width=None):
+    width = 4.7 * len(text) if width is None else width
+    return {"text": text, "x0": x0, "top": top, "x1": x0 + width, "bottom": top + 9.1}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_reference_on_synthetic_pages(seed):
+    page = synthetic_page(random.Random(seed))
+    assert merge_number_tokens(page) == reference_merge(page)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_reference_on_random_words(seed):
+    # Mots courts tirés au hasard, écarts et décalages verticaux autour des seuils (max_gap, même ligne)
+    rng = random.Random(seed)
+    vocabulary = ["1", "-1", "12", "123", "-123", "1234", "000", "456", "12,5", "99.25", "7,00-", "1,234",
+                  "0,5", ",00", "Total", "TVA", "-", ""]
+    words = []
+    x, top = 0.0, 40.0
+    for _ in range(rng.randint(0, 40)):
+        words.append(_word(rng.choice(vocabulary), x, top + rng.choice([0.0, 1.9, 2.9, 3.0, -3.0])))
+        x = words[-1]["x1"] + rng.choice([0.0, 2.4, 9.4, 9.99, 10.0, 10.6, 25.0])
+        if rng.random() < 0.1:
+            x, top = 0.0, top + 12.0
+    assert merge_number_tokens(words) == reference_merge(words)
+
+
+@pytest.mark.parametrize("max_gap", [0, 3, 10, 20])
+def test_max_gap(max_gap):
+    page = synthetic_page(random.Random(max_gap), rows=10)
+    assert merge_number_tokens(page, max_gap=max_gap) == reference_merge(page, max_gap=max_gap)
+
+
+def test_merges_thousands_groups():
+    words = [_word("1", 0, 10), _word("234", 7, 10), _word("567,89", 25, 10), _word("Total", 80, 10)]
+    assert [token[0] for token in merge_number_tokens(words)] == ["1 234 567,89", "Total"]
+
+
+def test_empty_page():
+    assert merge_number_tokens([]) == []
@@ -0,0 +1,100 @@
+"""
+Migration des embeddings existants vers le format de stockage compact (cf. services.vector_codec).
+
+    cd backend
+    python -m tools.migrate_embeddings [--format int8|float16|float32] [--collection all] \\
+        [--batch-size 500] [--dry-run] [--snapshot]
+
+Format cible par défaut : EMBEDDING_STORAGE_FORMAT pour embeddings, EMBEDDING_CACHE_FORMAT pour
+embedding_cache (jamais int8 : un hit du cache doit valoir le vecteur de l'API).
+
+Les documents sont relus par lots triés sur _id (reprise possible après interruption : les documents
+déjà au format cible ne sont plus sélectionnés). --snapshot reconstruit ensuite l'instantané local
+mappé en mémoire de l'index de similarité.
+"""
+import sys
+import time
+import argparse
+
+import bson
+from pymongo import UpdateOne
+
+from services import db_service
+from services.vector_codec import (decode_embedding, encode_embedding, EMBEDDING_FIELDS, EMBEDDING_STORAGE_FORMAT,
+                                   EMBEDDING_CACHE_FORMAT, VECTOR_FORMATS, CACHE_FORMATS)
+
+COLLECTIONS = {"embeddings": db_service.embeddings, "embedding_cache": db_service.embedding_cache}
+DEFAULT_FORMATS = {"embeddings": EMBEDDING_STORAGE_FORMAT, "embedding_cache": EMBEDDING_CACHE_FORMAT}
+
+
+def _pending_query(storage_format: str, lossless_only: bool = False) -> dict:
+    if lossless_only:
+        # Entrées int8 du cache non réencodées (précision perdue) : remplacées au prochain calcul
+        excluded = ["int8"] if storage_format == "float32" else ["int8", storage_format]
+        query = {"embedding_format": {"$nin": excluded}, "embedding": {"$ne": None}}
+        if storage_format == "float32":
+            query["embedding_format"]["$exists"] = True
+        return query
+    if storage_format == "float32":
+        return {"embedding_format": {"$exists": True}}
+    return {"embedding_format": {"$ne": storage_format}, "embedding": {"$ne": None}}
+
+
+def migrate_collection(collection, storage_format: str, batch_size: int, dry_run: bool,
+                       lossless_only: bool = False) -> dict:
+    """Réencode les vecteurs d'une collection ; retourne le nombre de documents et les octets avant/après."""
+    stats = {"documents": 0, "bytesBefore": 0, "bytesAfter": 0}
+    query = _pending_query(storage_format, lossless_only)
+    last_id = None
+    while True:
+        page_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        docs = list(collection.find(page_query, {"_id": 1, **EMBEDDING_FIELDS}).sort("_id", 1).limit(batch_size))
+        if not docs:
+            return stats
+        operations = []
+        for doc in docs:
+            vector = decode_embedding(doc)
+            encoded = encode_embedding(vector, storage_format)
+            stats["documents"] += 1
+            stats["bytesBefore"] += len(bson.encode({k: v for k, v in doc.items() if k != "_id"}))
+            stats["bytesAfter"] += len(bson.encode(encoded))
+            operations.append(UpdateOne({"_id": doc["_id"]}, db_service.embedding_update({}, vector, storage_format)))
+        if not dry_run:
+            db_service._bulk_write(collection, operations, batch_size)
+        last_id = docs[-1]["_id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=VECTOR_FORMATS, default=None,
+                        help="format cible (défaut : celui configuré pour chaque collection)")
+    parser.add_argument("--collection", choices=["all", *COLLECTIONS], default="all")
+    parser.add_argument("--batch-size", type=int, default=db_service.MONGODB_BULK_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="mesurer sans écrire")
+    parser.add_argument("--snapshot", action="store_true", help="reconstruire l'instantané local de l'index")
+    args = parser.parse_args()
+
+    names = list(COLLECTIONS) if args.collection == "all" else [args.collection]
+    for name in names:
+        storage_format = args.format or DEFAULT_FORMATS[name]
+        if name == "embedding_cache" and storage_format not in CACHE_FORMATS:
+            print(f"{name} : format {storage_format} ignoré (cache en {'/'.join(CACHE_FORMATS)} uniquement)")
+            continue
+        start = time.perf_counter()
+        stats = migrate_collection(COLLECTIONS[name], storage_format, args.batch_size, args.dry_run,
+                                   lossless_only=name == "embedding_cache")
+        ratio = stats["bytesBefore"] / stats["bytesAfter"] if stats["bytesAfter"] else 0
+        print(f"{name} : {stats['documents']} vecteur(s) {'à migrer' if args.dry_run else 'migré(s)'} vers {storage_format}, "
+              f"{stats['bytesBefore'] / 2 ** 20:.1f} Mo -> {stats['bytesAfter'] / 2 ** 20:.1f} Mo "
+              f"(x{ratio:.1f}) en {time.perf_counter() - start:.1f}s")
+    if args.snapshot and not args.dry_run:
+        from services.similarity_service import rebuild_vector_snapshot, VECTOR_SNAPSHOT_DIR
+
+        index = rebuild_vector_snapshot()
+        print(f"Instantané reconstruit dans {VECTOR_SNAPSHOT_DIR or '(désactivé)'} : "
+              f"{len(index)} chunks, {index.document_count} documents")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -77,45 +77,66 @@ async function extractData() {
     const progressBar = document.getElementById('progress-bar');
     progressPopup.classList.remove('hidden');
 
-    const steps = [
-        { message: 'Requête envoyée au modèle', progress: 20 },
-        { message: 'Extraction faite', progress: 40 },
-        { message: 'Conversion en images faite', progress: 60 },
-        { message: 'Classification des tokens', progress: 80 },
-        { message: 'Reconstruction du tableau', progress: 100 }
-    ];
+    // Libellés des étapes du job d'extraction (cf. JOB_STAGES côté backend)
+    const stageMessages = {
+        tokens: 'Extraction des tokens',
+        images: 'Conversion en images',
+        embeddings: 'Calcul des embeddings',
+        examples: 'Recherche de documents similaires',
+        llm: 'Classification des tokens',
+        save: 'Reconstruction du tableau'
+    };
 
     try {
-        let stepIndex = 0;
-        const updateProgress = () => {
-            if (stepIndex < steps.length) {
-                progressMessages.textContent = steps[stepIndex].message;
-                progressBar.value = steps[stepIndex].progress;
-                stepIndex++;
-            }
-        };
-
-        updateProgress();
+        progressMessages.textContent = 'Envoi du fichier';
+        progressBar.value = 0;
         console.log('Début de la requête fetch vers http://localhost:5001/extract');
 
-        const response = await fetch('http://localhost:5001/extract', {
+        const submitResponse = await fetch('http://localhost:5001/extract', {
             method: 'POST',
             body: formData
         });
-        console.log('Réponse reçue, statut :', response.status);
+        console.log('Réponse reçue, statut :', submitResponse.status);
 
-        if (!response.ok) {
-            const errorText = await response.text();
-            console.error('Erreur HTTP :', response.status, errorText);
-            alert(`Erreur lors de l'extraction : Statut ${response.status} - ${errorText}`);
+        if (!submitResponse.ok) {
+            const errorText = await submitResponse.text();
+            console.error('Erreur HTTP :', submitResponse.status, errorText);
+            alert(`Erreur lors de l'extraction : Statut ${submitResponse.status} - ${errorText}`);
             progressPopup.classList.add('hidden');
             return;
         }
 
-        updateProgress();
-        const data = await response.json();
+        let data = await submitResponse.json();
+        const jobId = data.jobId;
+        console.log(`Job d'extraction soumis : ${jobId} (${data.status})`);
+
+        // Document déjà connu : le résultat est renvoyé directement
+        if (data.status !== 'done') {
+            const onProgress = (status) => {
+                progressMessages.textContent = stageMessages[status.stage] || 'En attente d\'un worker';
+                progressBar.value = status.progress;
+            };
+            // Lignes reçues au fil de l'extraction : le tableau se remplit avant la fin du job
+            const onRows = (rows) => {
+                tableData = rows;
+                renderTable();
+                progressPopup.classList.add('hidden');
+            };
+            // Suivre la progression du job jusqu'à la fin (SSE, sinon interrogation périodique)
+            const job = window.EventSource
+                ? await followJob(jobId, onProgress, onRows).catch(() => pollJob(jobId, onProgress))
+                : await pollJob(jobId, onProgress);
+            if (job.status !== 'done') {
+                console.error('Job en échec :', job);
+                alert(`Erreur lors de l'extraction : ${job.error || 'job en échec'}`);
+                progressPopup.classList.add('hidden');
+                return;
+            }
+
+            const response = await fetch(`http://localhost:5001/jobs/${jobId}/result`);
+            data = await response.json();
+        }
         console.log('Données JSON reçues de l\'API :', data);
-        updateProgress();
 
         // Récupérer l'ID du document (ajuster selon la structure réelle de la réponse)
         documentId = data.documentId || (data.length > 0 && data[0].documentId) || '';
@@ -128,15 +149,9 @@ async function extractData() {
         tableData = data.data || (Array.isArray(data) ? data : []);
         images = (data.images || []).map(img => img.replace(/\\/g, '/'));
         pageDimensions = Array(images.length).fill({ width: 595, height: 842 });
-        updateProgress();
 
-        const pdfFilename = file.name.split('.')[0];
-        const tokensJsonPath = `data/${pdfFilename}.json`;
-        const tokensResponse = await fetch(tokensJsonPath);
-        const tokensData = await tokensResponse.json();
-        tokensPerPage = groupTokensByPage(tokensData);
-        console.log('tokensPerPage assigné :', tokensPerPage);
-        updateProgress();
+        // Les tokens sont chargés page par page, à l'affichage (cf. loadPageTokens)
+        tokensPerPage = [];
 
         updateSelectedIds();
 
@@ -159,6 +174,71 @@ async function extractData() {
     }
 }
 
+// Suivre /jobs/<id>/events (Server-Sent Events) : progression des étapes et lignes extraites.
+// Les lignes sont regroupées par fenêtre d'extraction pour conserver l'ordre du document.
+function followJob(jobId, onProgress, onRows) {
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`http://localhost:5001/jobs/${jobId}/events`);
+        const windows = [];
+        let received = false;
+        let renderScheduled = false;
+
+        source.addEventListener('stage', (event) => {
+            received = true;
+            onProgress(JSON.parse(event.data));
+        });
+        source.addEventListener('row', (event) => {
+            received = true;
+            const { window: windowIdx, row } = JSON.parse(event.data);
+            (windows[windowIdx] = windows[windowIdx] || []).push(row);
+            // Un rendu par frame au plus, même si les lignes arrivent en rafale
+            if (!renderScheduled) {
+                renderScheduled = true;
+                requestAnimationFrame(() => {
+                    renderScheduled = false;
+                    onRows(windows.flatMap(rows => rows || []));
+                });
+            }
+        });
+        source.addEventListener('rows_reset', () => {
+            // Document ré-extrait : les lignes reçues jusque-là sont remplacées
+            windows.length = 0;
+            onRows([]);
+        });
+        const finish = (status) => (event) => {
+            source.close();
+            const data = JSON.parse(event.data);
+            resolve({ status, error: data.error });
+        };
+        source.addEventListener('done', finish('done'));
+        source.addEventListener('failed', finish('failed'));
+        source.onerror = () => {
+            // Avant le premier événement : flux indisponible, repli sur pollJob ;
+            // ensuite EventSource se reconnecte seul (Last-Event-ID)
+            if (!received) {
+                source.close();
+                reject(new Error('Flux d\'événements indisponible'));
+            }
+        };
+    });
+}
+
+// Interroger /jobs/<id> jusqu'à ce que le job soit terminé ou en échec
+async function pollJob(jobId, onProgress, intervalMs = 1000) {
+    while (true) {
+        const response = await fetch(`http://localhost:5001/jobs/${jobId}`);
+        if (!response.ok) {
+            throw new Error(`Statut du job indisponible : ${response.status}`);
+        }
+        const status = await response.json();
+        onProgress(status);
+        if (status.status === 'done' || status.status === 'failed') {
+            return status;
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+}
+
 // Mettre à jour l'ensemble des IDs présents dans tableData
 function updateSelectedIds() {
     selectedIds.clear();
@@ -182,18 +262,24 @@ function updateSelectedIds() {
     console.log('selectedIds mis à jour depuis la réponse LLM :', Array.from(selectedIds));
 }
 
-// Grouper les tokens par page
-function groupTokensByPage(tokens) {
-    const pages = {};
-    for (const tok of tokens) {
-        const pageNum = tok.page || 0;
-        pages[pageNum] = pages[pageNum] || [];
-        pages[pageNum].push({
-            ...tok,
-            id: String(tok.id)
-        });
+// Charger les tokens d'une page (format colonnaire servi par /tokens/<documentId>/<page>)
+async function loadPageTokens(pageIdx) {
+    const response = await fetch(`http://localhost:5001/tokens/${documentId}/${pageIdx}`);
+    if (!response.ok) {
+        throw new Error(`Tokens de la page ${pageIdx} indisponibles : ${response.status}`);
     }
-    return Object.keys(pages).sort((a, b) => a - b).map(k => pages[k]);
+    const columns = await response.json();
+    tokensPerPage[pageIdx] = columns.id.map((id, k) => ({
+        id: String(id),
+        text: columns.text[k],
+        x0: columns.x0[k],
+        y0: columns.y0[k],
+        x1: columns.x1[k],
+        y1: columns.y1[k],
+        page: columns.page
+    }));
+    console.log(`Tokens de la page ${pageIdx} chargés :`, tokensPerPage[pageIdx].length);
+    return tokensPerPage[pageIdx];
 }
 
 // Vérifier la formule solde = solde_an + débit - crédit avec alternance
@@ -341,6 +427,17 @@ function renderTable() {
 // Dessiner l'image avec les bboxes
 function drawImage(pageIdx) {
     console.log(`Début de drawImage pour page ${pageIdx}, images[${pageIdx}] :`, images[pageIdx]);
+    if (documentId && !tokensPerPage[pageIdx]) {
+        // Tokens de la page pas encore chargés : les récupérer puis redessiner
+        loadPageTokens(pageIdx)
+            .then(() => drawImage(pageIdx))
+            .catch(error => {
+                console.error(error);
+                tokensPerPage[pageIdx] = [];
+                drawImage(pageIdx);
+            });
+        return;
+    }
     const canvas = document.getElementById('image-canvas');
     const ctx = canvas.getContext('2d');
     const img = new Image();